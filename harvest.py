@@ -1,8 +1,57 @@
 import datetime
-import csv
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
-from oaipmh.client import Client
+from lxml import etree
+
+from oaipmh.archive import BlobArchive
+from oaipmh.client import Client, RetryPolicy
 from oaipmh.metadata import MetadataRegistry, oai_dc_reader
+from oaipmh.sinks import ProgressSink, canAppend, openSink
+from oaipmh.state import FileStore
+
+# keep deleted records, records without a type and articles; the other
+# records are skipped before their metadata is read
+ARTICLE_XPATH = etree.XPath(
+    "oai:header/@status = 'deleted'"
+    " or not(oai:metadata/oai_dc:dc/dc:type)"
+    " or oai:metadata/oai_dc:dc/dc:type[1] = 'info:eu-repo/semantics/article'",
+    namespaces={'oai': 'http://www.openarchives.org/OAI/2.0/',
+                'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/',
+                'dc': 'http://purl.org/dc/elements/1.1/'})
+
+
+# only read the fields we use, the filter has already checked the type
+READ_FIELDS = ['identifier', 'date', 'source', 'rights', 'ispartof', 'creator', 'title']
+COLUMNS = ['identifiers', 'date', 'source', 'rights', 'partof', 'creators', 'title']
+
+# the raw pages are kept here, so they can be parsed again with reprocess.py
+ARCHIVE = 'harvest-archive'
+
+# these get the records the harvest always wrote, without deleted records and
+# records that have no metadata
+SELECTED_EXTENSIONS = ('.csv', '.tsv')
+
+
+def article_filter(record_node):
+    # the filter runs in the parse processes, a compiled XPath can't be sent there
+    return ARTICLE_XPATH(record_node)
+
+
+def selects_records(output):
+    return output.lower().endswith(SELECTED_EXTENSIONS)
+
+
+def selected(record):
+    # skipped after they are harvested, so they still move the watermark on
+    header, metadata, about = record
+    return not header.isDeleted() and metadata is not None
+
+
+def create_registry():
+    registry = MetadataRegistry()
+    registry.registerReader('oai_dc', oai_dc_reader)
+    return registry
 
 
 def main():
@@ -10,48 +59,48 @@ def main():
 
     # from_date = '2022-07-13T22:00:00Z'
     # from_date = datetime.datetime.strptime(from_date, "%Y-%m-%dT%H:%M:%SZ")
-    until_date = datetime.datetime.now()
-    from_date = until_date - datetime.timedelta(hours=6)
-    registry = MetadataRegistry()
-    registry.registerReader('oai_dc', oai_dc_reader)
-    client = Client(URL, registry)
-
-    with open('harvest.csv', 'w', newline='') as f:
-        fieldnames = ['identifiers', 'date', 'source', 'rights', 'partof', 'creators', 'title']
-        writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter=' ', quotechar='"')
-        writer.writeheader()
-
-        records = client.listRecords(metadataPrefix='oai_dc', from_=from_date, until=until_date, set='publication')
-        # to make it more robust, we would have to check if the list isn't empty
-        for num, record in enumerate(records):
-            print('%0.6d %s' % (num, record[0].identifier()))
-            # check if item has been deleted
-            # deleted items have 'header status=deleted' and no metadata
-            # if not deleted, get metadata: title, creator, date, type, source, identifier
-            # field 'ispartof' is not included in the module, so we hacked it in
-
-            if record[0].isDeleted():
-                print("item deleted")
-            elif record[1] is not None:
-                fields = record[1].getMap()
-                pubtype = fields['type']
-                # continue if pubtype is not present or if it's an article
-                if not pubtype or pubtype[0] == 'info:eu-repo/semantics/article':
-                    identifiers = fields['identifier']
-                    itemdate = fields['date']
-                    source = fields['source']
-                    rights = fields['rights']
-                    partof = fields['ispartof']
-                    creator = fields['creator']
-                    title = fields['title']
-                    print(identifiers)
-                    print(" by ")
-                    print(creator)
-                    print(" is part of")
-                    print(partof)
-                    writer.writerow({'identifiers': identifiers, 'date': itemdate, 'source': source,
-                                     'rights': rights, 'partof': partof, 'creators': creator,
-                                     'title': title})
+    # only used the first time, after that we continue where we left off; it is saved in
+    # the state file, so an interrupted first harvest is resumed from the same date
+    from_date = datetime.datetime.utcnow() - datetime.timedelta(hours=6)
+    registry = create_registry()
+    retry_policy = RetryPolicy(timeout=60)
+    client = Client(URL, registry, keep_alive=True, retry_policy=retry_policy)
+    client.updateCompression()
+    client.updateGranularity()
+    store = FileStore('harvest-state.json')
+    # pages that are received again, after a retry or in an overlapping run, are stored once
+    client.setArchive(BlobArchive(ARCHIVE, create=True))
+
+    # .csv or .tsv with the articles only, or .jsonl, .jsonl.gz or .jsonl.zst (with zstandard)
+    # for compressed shards of a million records, or with pyarrow .parquet or .arrow; these
+    # have the deleted records too, with deleted set to true. A .sqlite file is a mirror that
+    # is kept up to date by every run, deleted records are left in it as tombstones
+    output = sys.argv[1] if len(sys.argv) > 1 else 'harvest.csv'
+    select = selects_records(output)
+    # resume an interrupted harvest instead of starting over; the run appends to the output,
+    # overwriting it would lose the records written before the interruption, which aren't
+    # harvested again. .parquet and .arrow can't be appended to, so a harvest into them starts
+    # over from the watermark
+    checkpoints = canAppend(output)
+    if checkpoints:
+        client.setCheckpointStore(store)
+    args = client.incrementalArguments('oai_dc', store, set='publication', from_=from_date)
+    append = client.resumesList('ListRecords', **args)
+
+    # parse the pages in other processes while the next ones are downloaded
+    with ProcessPoolExecutor() as pool, ProgressSink(openSink(output, READ_FIELDS, COLUMNS, append=append)) as sink:
+        client.setParsePool(pool)
+        if checkpoints:
+            # the records written so far have to be on disk before the harvest can resume past them
+            client.setBeforeCheckpoint(sink.sync)
+        records = client.listRecordsIncremental('oai_dc', store, set='publication', from_=from_date,
+                                                fields=READ_FIELDS, filter=article_filter)
+        for record in records:
+            if select and not selected(record):
+                continue
+            sink.write(record)
+
+    print('%d retries, waited %0.1f seconds' % (retry_policy.retries, retry_policy.waited))
 
 
 if __name__ == '__main__':
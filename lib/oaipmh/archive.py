@@ -0,0 +1,366 @@
+# Released under the BSD license (see LICENSE.txt)
+"""Archives of captured OAI-PMH pages.
+
+A page archive is a directory with one file per page and an index,
+mapping.txt, that holds the request key and the file name of every page
+on two lines. This is the layout of the captured pages the tests use, so
+those can be opened as archives too.
+
+Pages are memory-mapped when they are served, so replaying a harvest
+reads them at disk speed without loading the archive up front.
+
+A blob archive keeps the pages compressed and stores them by content,
+so a page that is received more than once, for instance when a request
+is retried or harvested again by an overlapping run, is only stored
+once.
+"""
+from __future__ import absolute_import
+
+import gzip
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import threading
+
+try:
+    from urllib.parse import urlencode, parse_qsl
+except ImportError:
+    from urllib import urlencode
+    from urlparse import parse_qsl
+
+from oaipmh import transport
+from oaipmh.state import replace, writeAtomically
+
+INDEX = 'mapping.txt'
+BLOB_INDEX = 'index.txt'
+BLOBS = 'blobs'
+# the responseDate of a page, which is different in every response
+RESPONSE_DATE = re.compile(
+    br'<(?:[\w.-]+:)?responseDate\b[^>]*>[^<]*</(?:[\w.-]+:)?responseDate>')
+# bytes at the start of a page to look for the responseDate in
+HEAD_SIZE = 4096
+
+class Error(Exception):
+    pass
+
+def pageKey(args):
+    """Get the key of the page for the request arguments in args.
+
+    Unlike the keys of harvest state, the verb and resumption token are
+    part of the key, every page of a list has its own.
+    """
+    return urlencode(sorted(args.items()))
+
+def firstPages(keys, verb='ListRecords'):
+    """Get the arguments of the first pages of the lists of verb in keys.
+
+    These are the requests with which the lists were started, they are
+    generated in the order of keys.
+    """
+    for key in keys:
+        args = dict(parse_qsl(key, keep_blank_values=True))
+        if args.get('verb') == verb and 'resumptionToken' not in args:
+            del args['verb']
+            yield args
+
+class PageDigest(object):
+    """SHA-256 digest of the content of a page, its responseDate left out.
+
+    Two responses to the same request have the same content when the
+    data didn't change, but they always have another responseDate. The
+    page is given in chunks to update; its head is kept until the
+    responseDate, which comes right after the root element, has been
+    found or HEAD_SIZE bytes have been seen.
+    """
+    def __init__(self):
+        self._sha256 = hashlib.sha256()
+        self._head = b''
+
+    def update(self, chunk):
+        if self._head is None:
+            self._sha256.update(chunk)
+            return
+        self._head += chunk
+        if (len(self._head) >= HEAD_SIZE or
+            RESPONSE_DATE.search(self._head) is not None):
+            self._updateHead()
+
+    def _updateHead(self):
+        self._sha256.update(RESPONSE_DATE.sub(b'', self._head, 1))
+        self._head = None
+
+    def hexdigest(self):
+        if self._head is not None:
+            self._updateHead()
+        return self._sha256.hexdigest()
+
+def openArchive(path):
+    """Open the blob archive or page archive at path.
+    """
+    if os.path.exists(os.path.join(path, BLOB_INDEX)):
+        return BlobArchive(path)
+    return PageArchive(path)
+
+class Archive(object):
+    """Base class of the archives, a directory of pages with an index.
+
+    The directory is made if create is true, otherwise it has to exist.
+    The index maps request keys to where the pages are.
+    """
+    def __init__(self, path, create=False):
+        self._path = path
+        self._lock = threading.Lock()
+        if create and not os.path.isdir(path):
+            os.makedirs(path)
+        if not os.path.isdir(path):
+            raise Error("No page archive at: %s" % path)
+        self._index = self._readIndex()
+
+    def _readIndex(self):
+        raise NotImplementedError
+
+    def keys(self):
+        with self._lock:
+            return sorted(self._index.keys())
+
+    def requests(self, verb='ListRecords'):
+        """Get the arguments of the lists of verb that were captured.
+        """
+        with self._lock:
+            keys = list(self._index.keys())
+        return list(firstPages(keys, verb))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, args):
+        return pageKey(args) in self._index
+
+    def tee(self, args, chunks):
+        """Generate chunks, adding them as the page for args at the end.
+
+        The chunks are written to a temporary file as they pass, so the
+        page is never kept in memory. If chunks isn't generated to the
+        end, nothing is added.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self._path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write, finish = self._pageWriter(f)
+                for chunk in chunks:
+                    write(chunk)
+                    yield chunk
+                entry = finish()
+                f.flush()
+                os.fsync(f.fileno())
+            self._addFile(pageKey(args), tmp_path, entry)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def lookup(self, args):
+        """Get the index entry of the page for args.
+        """
+        key = pageKey(args)
+        with self._lock:
+            entry = self._index.get(key)
+        if entry is None:
+            raise Error("No page archived for request: %s" % key)
+        return entry
+
+class PageArchive(Archive):
+    """Directory of captured pages, indexed by request key.
+    """
+    def _readIndex(self):
+        index = {}
+        try:
+            f = open(os.path.join(self._path, INDEX), 'r')
+        except IOError:
+            return index
+        with f:
+            while 1:
+                request = f.readline()
+                response = f.readline()
+                # a pair that was cut off by a crash ends the index
+                if not request.endswith('\n') or not response.endswith('\n'):
+                    break
+                index[request.strip()] = response.strip()
+        return index
+
+    def path(self, args):
+        """Get the path of the page for args.
+        """
+        return os.path.join(self._path, self.lookup(args))
+
+    def map(self, args):
+        """Memory-map the page for args.
+
+        Empty pages can't be mapped, b'' is returned for these. The
+        caller closes the map.
+        """
+        with open(self.path(args), 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, args):
+        """Get the page for args as bytes.
+        """
+        page = self.map(args)
+        try:
+            return page[:]
+        finally:
+            if page:
+                page.close()
+
+    def chunks(self, args, size=transport.CHUNK_SIZE):
+        """Generate the page for args in chunks, straight from the map.
+        """
+        page = self.map(args)
+        try:
+            for i in range(0, len(page), size):
+                yield page[i:i + size]
+        finally:
+            if page:
+                page.close()
+
+    def add(self, args, data):
+        """Add the page data for args, replacing an earlier capture.
+
+        The page is written to its file before the index names it, so
+        the index never points at a page that isn't complete.
+        """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        for chunk in self.tee(args, [data]):
+            pass
+
+    def _pageWriter(self, f):
+        return f.write, lambda: None
+
+    def _addFile(self, key, tmp_path, entry):
+        with self._lock:
+            filename = self._index.get(key)
+            if filename is None:
+                filename = str(len(self._index)).zfill(5) + '.xml'
+            replace(tmp_path, os.path.join(self._path, filename))
+            if key not in self._index:
+                with open(os.path.join(self._path, INDEX), 'a') as f:
+                    f.write('%s\n%s\n' % (key, filename))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._index[key] = filename
+
+class BlobArchive(Archive):
+    """Archive of pages, compressed and stored by content.
+
+    A page is stored gzipped under the PageDigest of its content, as
+    blobs/<first two digits>/<digest>.gz; pages that only differ in
+    their responseDate are stored once, as the first of them that was
+    added. The index, index.txt, has
+    a line with the request key and the digest for every page that was
+    added; when a request is added again the last line counts. Blobs are
+    written before they are indexed, and the index is only appended to,
+    so a crash can at most lose the last page.
+    """
+    def __init__(self, path, create=False, compresslevel=6):
+        Archive.__init__(self, path, create)
+        self._compresslevel = compresslevel
+        # the number of pages that were already stored when added
+        self.duplicates = 0
+
+    def _readIndex(self):
+        index = {}
+        try:
+            f = open(os.path.join(self._path, BLOB_INDEX), 'r')
+        except IOError:
+            return index
+        with f:
+            for line in f:
+                # a line that was cut off by a crash ends the index
+                if not line.endswith('\n'):
+                    break
+                key, digest = line.rstrip('\n').split('\t')
+                index[key] = digest
+        return index
+
+    def blobPath(self, digest):
+        return os.path.join(self._path, BLOBS, digest[:2], digest + '.gz')
+
+    def path(self, args):
+        """Get the path of the blob of the page for args.
+        """
+        return self.blobPath(self.lookup(args))
+
+    def read(self, args):
+        """Get the page for args as bytes.
+        """
+        with gzip.open(self.path(args), 'rb') as f:
+            return f.read()
+
+    def chunks(self, args, size=transport.CHUNK_SIZE):
+        """Generate the page for args in chunks, decompressed as it is read.
+        """
+        with gzip.open(self.path(args), 'rb') as f:
+            while 1:
+                chunk = f.read(size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def add(self, args, data):
+        """Add the page data for args, replacing an earlier capture.
+        """
+        key = pageKey(args)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        page_digest = PageDigest()
+        page_digest.update(data)
+        digest = page_digest.hexdigest()
+        blob_path = self.blobPath(digest)
+        with self._lock:
+            if os.path.exists(blob_path):
+                self.duplicates += 1
+            else:
+                self._makeBlobDirectory(blob_path)
+                writeAtomically(blob_path, gzip.compress(
+                    data, self._compresslevel))
+            self._indexDigest(key, digest)
+
+    def _pageWriter(self, f):
+        page_digest = PageDigest()
+        compressed = gzip.GzipFile(filename='', fileobj=f, mode='wb',
+                                   compresslevel=self._compresslevel)
+        def write(chunk):
+            page_digest.update(chunk)
+            compressed.write(chunk)
+        def finish():
+            compressed.close()
+            return page_digest.hexdigest()
+        return write, finish
+
+    def _addFile(self, key, tmp_path, digest):
+        blob_path = self.blobPath(digest)
+        with self._lock:
+            if os.path.exists(blob_path):
+                # tee removes the temporary file
+                self.duplicates += 1
+            else:
+                self._makeBlobDirectory(blob_path)
+                replace(tmp_path, blob_path)
+            self._indexDigest(key, digest)
+
+    def _makeBlobDirectory(self, blob_path):
+        directory = os.path.dirname(blob_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _indexDigest(self, key, digest):
+        if self._index.get(key) != digest:
+            with open(os.path.join(self._path, BLOB_INDEX), 'a') as f:
+                f.write('%s\t%s\n' % (key, digest))
+                f.flush()
+                os.fsync(f.fileno())
+            self._index[key] = digest
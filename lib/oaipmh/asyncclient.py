@@ -0,0 +1,320 @@
+from __future__ import absolute_import
+
+import asyncio
+import base64
+import sys
+from io import BytesIO
+from http.client import HTTPMessage
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlsplit, urljoin
+
+from oaipmh import client, transport
+
+LIST_VERBS = client.LIST_VERBS
+RETRY_ERRORS = client.RETRY_ERRORS + (asyncio.TimeoutError,
+                                      asyncio.IncompleteReadError)
+
+class AsyncClient(client.BaseClient):
+    """OAI-PMH client for asyncio.
+
+    The verb methods mirror those of Client. listIdentifiers, listRecords
+    and listSets return asynchronous iterators, the other verbs return
+    awaitables. Waiting for a 503 Retry-After does not block the event
+    loop, so a single process can harvest many repositories at once:
+
+      async def harvest(url):
+          async with AsyncClient(url, registry) as client:
+              async for header, metadata, about in client.listRecords(
+                      metadataPrefix='oai_dc'):
+                  ...
+
+      loop.run_until_complete(asyncio.gather(*map(harvest, urls)))
+    """
+    def __init__(self, base_url, metadata_registry=None, credentials=None,
+                 force_http_get=False, retry_policy=None):
+        client.BaseClient.__init__(self, metadata_registry)
+        self._base_url = base_url
+        self._force_http_get = force_http_get
+        self._retry_policy = retry_policy or client.RetryPolicy()
+        self._compression = []
+        self._connections = {}
+        if credentials is not None:
+            self._credentials = base64.b64encode(
+                ('%s:%s' % credentials).encode('utf-8')).decode('ascii')
+        else:
+            self._credentials = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def handleVerb(self, verb, kw):
+        options = client.popRecordOptions(verb, kw)
+        self.prepareArguments(verb, kw)
+        if verb in LIST_VERBS:
+            return self.listGenerator(verb, kw, **options)
+        return self.handleSingleVerb(verb, kw, **options)
+
+    async def handleSingleVerb(self, verb, kw, **options):
+        tree = await self.makeRequestErrorHandling(verb=verb, **kw)
+        method_name = verb + '_impl'
+        return getattr(self, method_name)(kw, tree, **options)
+
+    async def listGenerator(self, verb, kw, fields=None, filter=None,
+                            skipped=None):
+        tree = await self.makeRequestErrorHandling(verb=verb, **kw)
+        while 1:
+            result, token = self.buildBatch(verb, kw, tree, fields, filter,
+                                            skipped)
+            for item in result:
+                yield item
+            if token is None:
+                break
+            tree = await self.makeRequestErrorHandling(
+                verb=verb, resumptionToken=token)
+
+    def buildBatch(self, verb, args, tree, fields=None, filter=None,
+                   skipped=None):
+        namespaces = self.getNamespaces()
+        if verb == 'ListRecords':
+            return self.buildRecords(
+                args['metadataPrefix'], namespaces,
+                self._metadata_registry, tree, fields, filter, skipped)
+        elif verb == 'ListIdentifiers':
+            return self.buildIdentifiers(namespaces, tree, filter)
+        return self.buildSets(namespaces, tree)
+
+    async def updateGranularity(self):
+        """Update the granularity setting dependent on that the server says.
+        """
+        identify = await self.identify()
+        self.setGranularity(identify.granularity())
+
+    async def updateCompression(self):
+        """Update the compression setting dependent on what the server says.
+        """
+        identify = await self.identify()
+        self._compression = transport.acceptedEncodings(
+            identify.compression())
+
+    async def makeRequestErrorHandling(self, **kw):
+        xml = await self.makeRequest(**kw)
+        return self.parseErrorHandling(xml, kw)
+
+    async def makeRequest(self, **kw):
+        headers = {'User-Agent': 'pyoai'}
+        if self._credentials is not None:
+            headers['Authorization'] = 'Basic ' + self._credentials
+        if self._compression:
+            headers['Accept-Encoding'] = ', '.join(self._compression)
+        if self._force_http_get:
+            url = '%s?%s' % (self._base_url, urlencode(kw))
+            data = None
+        else:
+            url = self._base_url
+            data = urlencode(kw).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return await self.retrieveWaiting(url, data, headers)
+
+    async def retrieveWaiting(self, url, data, headers):
+        """Get text from URL, retrying as the retry policy allows.
+
+        Waiting is done with asyncio.sleep, so it doesn't block the loop.
+        """
+        policy = self._retry_policy
+        tries = 0
+        waited = 0.0
+        while 1:
+            tries += 1
+            try:
+                return await self.retrieve(url, data, headers)
+            except RETRY_ERRORS:
+                delay = policy.nextDelay(sys.exc_info()[1], tries, waited)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                waited += delay
+
+    async def retrieve(self, url, data, headers):
+        """Get text from URL, following redirects.
+
+        Raises HTTPError for error status codes, like urllib.
+        """
+        for i in range(transport.MAX_REDIRECTS + 1):
+            status, reason, msg, body = await self.open(url, data, headers)
+            location = msg.get('Location')
+            if status in transport.REDIRECT_CODES and location:
+                url = urljoin(url, location)
+                if status not in (307, 308):
+                    data = None
+                    headers = headers.copy()
+                    headers.pop('Content-Type', None)
+                continue
+            if status >= 400:
+                raise HTTPError(url, status, reason, msg, BytesIO(body))
+            return body
+        raise HTTPError(url, status, "Too many redirects", msg, BytesIO())
+
+    async def open(self, url, data, headers):
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        selector = path or '/'
+        if query:
+            selector += '?' + query
+        connection = self._connections.get((scheme, netloc))
+        if connection is None:
+            connection = AsyncConnection(scheme, netloc)
+            self._connections[(scheme, netloc)] = connection
+        if data is None:
+            method = 'GET'
+        else:
+            method = 'POST'
+        request = connection.request(method, selector, data, headers)
+        timeout = self._retry_policy.timeout
+        if timeout is not None:
+            request = asyncio.wait_for(request, timeout)
+        return await request
+
+    async def close(self):
+        """Close the connections held by this client.
+        """
+        connections, self._connections = self._connections, {}
+        for connection in connections.values():
+            await connection.close()
+
+class AsyncConnection(object):
+    """A keep-alive HTTP/1.1 connection on asyncio streams.
+
+    Requests on the connection are made one at a time.
+    """
+    def __init__(self, scheme, netloc):
+        split = urlsplit('//' + netloc)
+        self._ssl = scheme == 'https'
+        self._host = split.hostname
+        self._port = split.port or (self._ssl and 443 or 80)
+        self._netloc = netloc
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def request(self, method, selector, data, headers):
+        """Make a request, returning status, reason, headers and body.
+
+        The body is decompressed according to its Content-Encoding.
+        """
+        async with self._lock:
+            reused = self._writer is not None
+            if not reused:
+                await self._connect()
+            try:
+                return await self._exchange(method, selector, data, headers)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+            # the server dropped an idle keep-alive connection, try again
+            await self._connect()
+            return await self._exchange(method, selector, data, headers)
+
+    async def close(self):
+        writer = self._writer
+        self._disconnect()
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+            self._host, self._port, ssl=self._ssl or None)
+
+    def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _exchange(self, method, selector, data, headers):
+        try:
+            return await self._request(method, selector, data, headers)
+        except BaseException:
+            # after a timeout, a cancellation or a bad response the rest
+            # of the response could be read as the response to the next
+            # request, so the connection can't be used again
+            self._disconnect()
+            raise
+
+    async def _request(self, method, selector, data, headers):
+        lines = ['%s %s HTTP/1.1' % (method, selector),
+                 'Host: %s' % self._netloc]
+        for name, value in headers.items():
+            lines.append('%s: %s' % (name, value))
+        if data is not None:
+            lines.append('Content-Length: %s' % len(data))
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if data is not None:
+            self._writer.write(data)
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by server")
+        parts = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        version, status = parts[0], int(parts[1])
+        reason = len(parts) > 2 and parts[2] or ''
+        msg = HTTPMessage()
+        while 1:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            msg[name.strip()] = value.strip()
+
+        keep_alive = version != 'HTTP/1.0'
+        if msg.get('Connection', '').lower() == 'close':
+            keep_alive = False
+        decompressor = transport.getDecompressor(msg.get('Content-Encoding'))
+        chunks = []
+        if method != 'HEAD' and status not in (204, 304):
+            async for chunk in self._readBody(msg):
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                chunks.append(chunk)
+            if decompressor is not None:
+                chunks.append(decompressor.flush())
+            if (msg.get('Transfer-Encoding') is None and
+                msg.get('Content-Length') is None):
+                # body was delimited by closing the connection
+                keep_alive = False
+        if not keep_alive:
+            self._disconnect()
+        return status, reason, msg, b''.join(chunks)
+
+    async def _readBody(self, msg):
+        reader = self._reader
+        if msg.get('Transfer-Encoding', '').lower() == 'chunked':
+            while 1:
+                size_line = await reader.readline()
+                size = int(size_line.split(b';')[0].strip(), 16)
+                if size == 0:
+                    # skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n',
+                                                            b''):
+                        pass
+                    return
+                yield await reader.readexactly(size)
+                await reader.readline()
+        length = msg.get('Content-Length')
+        if length is not None:
+            remaining = int(length)
+            while remaining > 0:
+                chunk = await reader.readexactly(
+                    min(remaining, transport.CHUNK_SIZE))
+                remaining -= len(chunk)
+                yield chunk
+            return
+        while 1:
+            chunk = await reader.read(transport.CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
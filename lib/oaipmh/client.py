@@ -13,16 +13,78 @@ except ImportError:
     from urllib import urlencode
 
 import sys
+import re
 import base64
+import copy
+import datetime
 from lxml import etree
 import time
 import codecs
+import threading
+import random
+import socket
+import email.utils
+from six.moves import queue, http_client
 
-from oaipmh import common, metadata, validation, error
+from oaipmh import common, metadata, validation, error, transport, state, \
+     archive
 from oaipmh.datestamp import datestamp_to_datetime, datetime_to_datestamp
 
 WAIT_DEFAULT = 120 # two minutes
 WAIT_MAX = 5
+BACKOFF_BASE = 5 # seconds
+# status codes and errors after which a request is tried again
+RETRY_CODES = (429, 502, 503, 504)
+RETRY_ERRORS = (urllib2.URLError, socket.error, http_client.HTTPException)
+PREFETCH_POLL = 0.1 # seconds
+PARSE_DEPTH = 4 # pages
+QUEUE_SIZE = 500 # records per worker, a few pages
+WATERMARK_OVERLAP = datetime.timedelta(minutes=10)
+LIST_VERBS = ['ListIdentifiers', 'ListRecords', 'ListSets']
+# arguments that select what is read from the response, per verb; they
+# are not sent to the server
+RECORD_OPTIONS = {
+    'GetRecord': ['fields'],
+    'ListIdentifiers': ['filter'],
+    'ListRecords': ['fields', 'filter', 'skipped'],
+    }
+
+NS_OAIPMH = 'http://www.openarchives.org/OAI/2.0/'
+NS_OAIPMH_RECORD = '{%s}record' % NS_OAIPMH
+NS_OAIPMH_ERROR = '{%s}error' % NS_OAIPMH
+NS_OAIPMH_TOKEN = '{%s}resumptionToken' % NS_OAIPMH
+NAMESPACES = {'oai': NS_OAIPMH}
+
+def compileXPath(path):
+    """Compile an XPath expression using the OAI-PMH namespace.
+    """
+    return etree.XPath(path, namespaces=NAMESPACES, smart_strings=False)
+
+# compiled once, as they are evaluated for every page, record or header
+token_xpath = compileXPath('string(/oai:OAI-PMH/*/oai:resumptionToken/text())')
+error_xpath = compileXPath('/oai:OAI-PMH/oai:error')
+record_xpath = compileXPath('/oai:OAI-PMH/*/oai:record')
+record_header_xpath = compileXPath('oai:header')
+record_metadata_xpath = compileXPath('oai:metadata')
+identifiers_header_xpath = compileXPath(
+    '/oai:OAI-PMH/oai:ListIdentifiers/oai:header')
+set_xpath = compileXPath('/oai:OAI-PMH/oai:ListSets/oai:set')
+identifier_xpath = compileXPath('string(oai:identifier/text())')
+datestamp_xpath = compileXPath('string(oai:datestamp/text())')
+setspec_xpath = compileXPath('oai:setSpec/text()')
+deleted_xpath = compileXPath("@status = 'deleted'")
+record_datestamp_xpath = compileXPath(
+    'string(oai:header/oai:datestamp/text())')
+setspec_string_xpath = compileXPath('string(oai:setSpec/text())')
+setname_string_xpath = compileXPath('string(oai:setName/text())')
+
+# the start of a resumptionToken element, with its text if it has any
+TOKEN_PATTERN = re.compile(
+    br'<(?:[\w.-]+:)?resumptionToken\b[^>]*?(?:/>|>([^<]*)<)')
+# the control characters that are not allowed in XML 1.0, deleting these
+# from the bytes is much cheaper than running an expression over every page
+BAD_BYTES = bytes(bytearray(list(range(0x00, 0x09)) + [0x0b, 0x0c] +
+                            list(range(0x0e, 0x20))))
 
 class Error(Exception):
     pass
@@ -34,12 +96,23 @@ class BaseClient(common.OAIPMH):
             metadata_registry or metadata.global_metadata_registry)
         self._ignore_bad_character_hack = 0
         self._day_granularity = False
+        self._prefetch = 0
+        self._streaming = False
+        self._checkpoint_store = None
+        self._before_checkpoint = None
+        self._detach = False
+        self._detach_copy = False
+        self._parse_pool = None
+        self._parse_depth = PARSE_DEPTH
 
     def updateGranularity(self):
         """Update the granularity setting dependent on that the server says.
         """
-        identify = self.identify()
-        granularity = identify.granularity()
+        self.setGranularity(self.identify().granularity())
+
+    def setGranularity(self, granularity):
+        """Set the granularity setting to the granularity of the server.
+        """
         if granularity == 'YYYY-MM-DD':
             self._day_granularity = True
         elif granularity == 'YYYY-MM-DDThh:mm:ssZ':
@@ -48,6 +121,54 @@ class BaseClient(common.OAIPMH):
             raise Error("Non-standard granularity on server: %s" % granularity)
 
     def handleVerb(self, verb, kw):
+        """Make the request for verb with the arguments in kw.
+
+        Besides the OAI-PMH arguments getRecord and listRecords take
+        fields, a list of the metadata fields to read. Only these fields
+        are read and end up in the map of the metadata; the reader of
+        the metadata format needs to support this, as MetadataReader
+        does.
+
+        listRecords and listIdentifiers take filter, a callable such as
+        a compiled etree.XPath that is called with each oai:record, or
+        oai:header for listIdentifiers, element. Records for which it
+        returns a false value, or an empty list, are skipped before
+        their header and metadata are read. listRecords also takes
+        skipped, a callable that is called with the datestamp of each
+        record the filter skipped.
+        """
+        options = popRecordOptions(verb, kw)
+        self.prepareArguments(verb, kw)
+        return self.dispatchVerb(verb, kw, options)
+
+    def dispatchVerb(self, verb, kw, options):
+        """Make the request for verb with the request arguments in kw.
+        """
+        if verb == 'ListRecords' and self._parse_pool is not None:
+            return self.pipelineRecords(kw, **options)
+        if verb == 'ListRecords' and self._streaming:
+            return self.streamRecords(kw, **options)
+        # now call underlying implementation
+        method_name = verb + '_impl'
+        return getattr(self, method_name)(
+            kw, self.makeFirstRequest(verb, kw), **options)
+
+    def makeFirstRequest(self, verb, kw):
+        """Make the first request for verb, resuming from a checkpoint.
+        """
+        token = self.checkpointToken(verb, kw)
+        if token is not None:
+            try:
+                return self.makeRequestErrorHandling(verb=verb,
+                                                     resumptionToken=token)
+            except error.BadResumptionTokenError:
+                # the token has expired, start again
+                pass
+        return self.makeRequestErrorHandling(verb=verb, **kw)
+
+    def prepareArguments(self, verb, kw):
+        """Validate the arguments in kw and turn them into request arguments.
+        """
         # validate kw first
         validation.validateArguments(verb, kw)
         # encode datetimes as datestamps
@@ -68,11 +189,6 @@ class BaseClient(common.OAIPMH):
             # until is None but is explicitly in kw, remove it
             del kw['until']
 
-        # now call underlying implementation
-        method_name = verb + '_impl'
-        return getattr(self, method_name)(
-            kw, self.makeRequestErrorHandling(verb=verb, **kw))
-
     def getNamespaces(self):
         """Get OAI namespaces.
         """
@@ -90,35 +206,187 @@ class BaseClient(common.OAIPMH):
         This is a hack to get around well-formedness errors of
         input sources which *should* be in UTF-8 but for some reason
         aren't completely.
+
+        Bytes that are not UTF-8 are replaced, characters that are not
+        allowed in XML are dropped and the rest is parsed with a
+        recovering parser, which also gets past other errors.
         """
         self._ignore_bad_character_hack = true_or_false
 
+    def setPrefetch(self, depth):
+        """Set the number of resumption pages to fetch ahead.
+
+        With a depth above 0 listRecords, listIdentifiers and listSets
+        fetch and parse the next pages in a background thread while
+        the current page is being processed, keeping at most depth
+        parsed pages waiting. 0, the default, fetches pages on demand.
+        """
+        self._prefetch = depth
+
+    def setStreaming(self, true_or_false):
+        """Set to parse ListRecords responses incrementally.
+
+        In streaming mode the response is parsed while it is read, and
+        each record is returned as soon as it is complete. Records are
+        removed from the parsed page once the next one is requested,
+        so memory use depends on the size of a record instead of the
+        size of a page. Pages are fetched on demand. Lazy metadata reads
+        its remaining fields before the record is removed.
+        """
+        self._streaming = true_or_false
+
+    def setDetach(self, true_or_false, copy=False):
+        """Set to stop headers and metadata from keeping the page alive.
+
+        Headers and metadata refer to their element, and through it keep
+        the whole parsed page in memory for as long as they live. When
+        detaching, the element references are dropped once a record has
+        been read, so element() returns None and lazy metadata reads all
+        its fields straight away. With copy true the record is copied
+        out of the page before it is read instead, which keeps element()
+        working at the cost of the copy.
+        """
+        self._detach = true_or_false
+        self._detach_copy = copy
+
+    def setParsePool(self, pool, depth=PARSE_DEPTH):
+        """Set a pool of processes to parse ListRecords pages in.
+
+        pool is a concurrent.futures.ProcessPoolExecutor, or None to
+        parse in the consuming thread again; the client doesn't shut it
+        down. With a pool, listRecords fetches pages in a background
+        thread and hands the raw pages to the pool, which parses them
+        and reads their records. The resumption token is found in the
+        raw page, so the next page is fetched while the previous ones
+        are parsed, and at most depth pages are fetched ahead of the
+        consumer. Records are generated in page order, detached (see
+        setDetach). This takes precedence over streaming.
+
+        The metadata readers and filter are sent to the pool, so they
+        have to be picklable. MetadataReader is; a compiled
+        etree.XPath is not, call it from a module level function.
+        """
+        self._parse_pool = pool
+        self._parse_depth = depth
+
+    def setCheckpointStore(self, store):
+        """Set the store in which list requests are checkpointed.
+
+        store is a state.FileStore or state.SQLiteStore, or None to
+        stop checkpointing. Once all results of a page of listRecords,
+        listIdentifiers or listSets have been processed, the resumption
+        token of the next page is saved in the store, together with the
+        request arguments. A list request with the same arguments,
+        until excepted, resumes from the saved token instead of
+        starting at the first page; if the server no longer accepts the
+        token the list is started again. The checkpoint is removed when
+        the list is complete.
+        """
+        self._checkpoint_store = store
+
+    def setBeforeCheckpoint(self, hook):
+        """Set a function to call before harvest state is saved.
+
+        hook is called without arguments before a checkpoint is saved
+        or removed, and before listRecordsIncremental moves the
+        watermark; None to stop calling it. The records generated so far
+        count as processed once the state is saved, so if they are
+        written somewhere, hook should make sure they are on disk, for
+        instance with the sync of a sink.
+        """
+        self._before_checkpoint = hook
+
+    def withoutCheckpoints(self):
+        """Get a copy of the client that doesn't checkpoint list requests.
+        """
+        other = copy.copy(self)
+        other._checkpoint_store = None
+        return other
+
+    def requestKey(self, verb, args):
+        """Get the key under which state of a request is stored.
+        """
+        return state.requestKey('', verb, args)
+
+    def checkpointKey(self, verb, args):
+        return 'checkpoint:' + self.requestKey(verb, args)
+
+    def checkpointToken(self, verb, args):
+        """Get the checkpointed resumption token of a request, or None.
+        """
+        if self._checkpoint_store is None or verb not in LIST_VERBS:
+            return None
+        checkpoint = self._checkpoint_store.get(
+            self.checkpointKey(verb, args))
+        if checkpoint is None:
+            return None
+        return checkpoint['token']
+
+    def resumesList(self, verb, **kw):
+        """Tell whether a list request resumes from a checkpoint.
+
+        kw are the arguments of the request, as listRecords,
+        listIdentifiers or listSets take them.
+        """
+        kw = dict(kw)
+        popRecordOptions(verb, kw)
+        self.prepareArguments(verb, kw)
+        return self.checkpointToken(verb, kw) is not None
+
+    def checkpointer(self, verb, args):
+        """Get a function that checkpoints the token of the next page.
+
+        Returns None if there is no checkpoint store. The function
+        removes the checkpoint when it is called with None.
+        """
+        store = self._checkpoint_store
+        if store is None:
+            return None
+        key = self.checkpointKey(verb, args)
+        args = dict(args)
+        before_checkpoint = self._before_checkpoint
+        def checkpoint(token):
+            if before_checkpoint is not None:
+                before_checkpoint()
+            if token is None:
+                store.delete(key)
+            else:
+                store.set(key, {'args': args, 'token': token})
+        return checkpoint
+
     def parse(self, xml):
         """Parse the XML to a lxml tree.
         """
+        if isinstance(xml, six.text_type):
+            xml = xml.encode('utf-8')
+        if not self._ignore_bad_character_hack:
+            return etree.XML(xml)
         # XXX this is only safe for UTF-8 encoded content,
         # and we're basically hacking around non-wellformedness anyway,
         # but oh well
-        if self._ignore_bad_character_hack:
-            xml = six.text_type(xml, 'UTF-8', 'replace')
-            # also get rid of character code 12
-            xml = xml.replace(chr(12), '?')
-            xml = xml.encode('UTF-8')
-        if six.PY3:
-            if hasattr(xml, "encode"):
-                xml = xml.encode("utf-8")
-            # xml = xml.encode("utf-8")
-        return etree.XML(xml)
+        parser = recoveringParser()
+        try:
+            for chunk in cleanChunks(sliceChunks(xml)):
+                parser.feed(chunk)
+        except:
+            # reset the parser for the next document
+            try:
+                parser.close()
+            except etree.XMLSyntaxError:
+                pass
+            raise
+        return parser.close()
 
     # implementation of the various methods, delegated here by
     # handleVerb method
 
-    def GetRecord_impl(self, args, tree):
+    def GetRecord_impl(self, args, tree, fields=None):
         records, token = self.buildRecords(
             args['metadataPrefix'],
             self.getNamespaces(),
             self._metadata_registry,
-            tree
+            tree,
+            fields
             )
         assert token is None
         return records[0]
@@ -151,15 +419,17 @@ class BaseClient(common.OAIPMH):
             deletedRecord, granularity, compression)
         return identify
 
-    def ListIdentifiers_impl(self, args, tree):
+    def ListIdentifiers_impl(self, args, tree, filter=None):
         namespaces = self.getNamespaces()
         def firstBatch():
-            return self.buildIdentifiers(namespaces, tree)
+            return self.buildIdentifiers(namespaces, tree, filter)
         def nextBatch(token):
             tree = self.makeRequestErrorHandling(verb='ListIdentifiers',
                                                  resumptionToken=token)
-            return self.buildIdentifiers(namespaces, tree)
-        return ResumptionListGenerator(firstBatch, nextBatch)
+            return self.buildIdentifiers(namespaces, tree, filter)
+        return ResumptionListGenerator(
+            firstBatch, nextBatch, self._prefetch,
+            self.checkpointer('ListIdentifiers', args))
 
     def ListMetadataFormats_impl(self, args, tree):
         namespaces = self.getNamespaces()
@@ -180,22 +450,25 @@ class BaseClient(common.OAIPMH):
 
         return metadataFormats
 
-    def ListRecords_impl(self, args, tree):
+    def ListRecords_impl(self, args, tree, fields=None, filter=None,
+                         skipped=None):
         namespaces = self.getNamespaces()
         metadata_prefix = args['metadataPrefix']
         metadata_registry = self._metadata_registry
         def firstBatch():
             return self.buildRecords(
                 metadata_prefix, namespaces,
-                metadata_registry, tree)
+                metadata_registry, tree, fields, filter, skipped)
         def nextBatch(token):
             tree = self.makeRequestErrorHandling(
                 verb='ListRecords',
                 resumptionToken=token)
             return self.buildRecords(
                 metadata_prefix, namespaces,
-                metadata_registry, tree)
-        return ResumptionListGenerator(firstBatch, nextBatch)
+                metadata_registry, tree, fields, filter, skipped)
+        return ResumptionListGenerator(
+            firstBatch, nextBatch, self._prefetch,
+            self.checkpointer('ListRecords', args))
 
     def ListSets_impl(self, args, tree):
         namespaces = self.getNamespaces()
@@ -206,192 +479,996 @@ class BaseClient(common.OAIPMH):
                 verb='ListSets',
                 resumptionToken=token)
             return self.buildSets(namespaces, tree)
-        return ResumptionListGenerator(firstBatch, nextBatch)
+        return ResumptionListGenerator(
+            firstBatch, nextBatch, self._prefetch,
+            self.checkpointer('ListSets', args))
+
+    # incremental harvesting
+
+    def listRecordsIncremental(self, metadataPrefix, store, set=None,
+                               from_=None, overlap=WATERMARK_OVERLAP,
+                               fields=None, filter=None):
+        """Generate the records changed since the previous harvest.
+
+        The highest datestamp of the records harvested is kept in store,
+        a state.FileStore or state.SQLiteStore, as the watermark of the
+        repository, metadataPrefix and set. A harvest starts at the
+        watermark minus overlap, to pick up records that were added
+        with a datestamp just before it; with day granularity overlap
+        counts in whole days and the day of the watermark is always
+        harvested again. from_ is used when there is no watermark yet;
+        it is kept in store until the first harvest is complete, so
+        that one that is interrupted is resumed with the same from_.
+
+        The watermark is only moved once all records have been
+        processed, so records of an interrupted harvest are harvested
+        again by the next one. Records skipped by filter count as
+        processed.
+        """
+        key = self.watermarkKey(metadataPrefix, set)
+        watermark = store.get(key)
+        if watermark is not None:
+            watermark = datestamp_to_datetime(watermark)
+        args = self.incrementalArguments(metadataPrefix, store, set, from_,
+                                         overlap)
+        # the newest datestamp of the records skipped by filter
+        skipped = [None]
+        def skip(datestamp):
+            if skipped[0] is None or datestamp > skipped[0]:
+                skipped[0] = datestamp
+        first_key = self.firstFromKey(metadataPrefix, set)
+        try:
+            # streamed and pipelined lists only make their first request
+            # when they are iterated
+            for record in self.listRecords(
+                    fields=fields, filter=filter, skipped=skip, **args):
+                yield record
+                datestamp = record[0].datestamp()
+                if watermark is None or datestamp > watermark:
+                    watermark = datestamp
+        except error.NoRecordsMatchError:
+            store.delete(first_key)
+            return
+        if skipped[0] is not None and (watermark is None or
+                                       skipped[0] > watermark):
+            watermark = skipped[0]
+        if watermark is not None:
+            if self._before_checkpoint is not None:
+                self._before_checkpoint()
+            store.set(key, datetime_to_datestamp(watermark))
+        store.delete(first_key)
+
+    def watermarkKey(self, metadataPrefix, set=None):
+        args = {'metadataPrefix': metadataPrefix}
+        if set is not None:
+            args['set'] = set
+        return 'watermark:' + self.requestKey('ListRecords', args)
+
+    def firstFromKey(self, metadataPrefix, set=None):
+        return 'first' + self.watermarkKey(metadataPrefix, set)[
+            len('watermark'):]
+
+    def incrementalArguments(self, metadataPrefix, store, set=None,
+                             from_=None, overlap=WATERMARK_OVERLAP):
+        """Get the listRecords arguments of an incremental harvest.
+
+        See listRecordsIncremental, which harvests with these arguments.
+        Without a watermark, the from_ of the first call is saved in
+        store and used from then on.
+        """
+        args = {'metadataPrefix': metadataPrefix}
+        if set is not None:
+            args['set'] = set
+        watermark = store.get(self.watermarkKey(metadataPrefix, set))
+        if watermark is not None:
+            from_ = watermarkFrom(datestamp_to_datetime(watermark), overlap,
+                                  self._day_granularity)
+        else:
+            first_key = self.firstFromKey(metadataPrefix, set)
+            first_from = store.get(first_key)
+            if first_from is not None:
+                from_ = datestamp_to_datetime(first_from)
+            elif from_ is not None:
+                from_ = from_.replace(microsecond=0)
+                store.set(first_key, datetime_to_datestamp(from_))
+        args['from_'] = from_
+        return args
+
+    # parallel harvesting
+
+    def listRecordsPartitioned(self, metadataPrefix, from_=None, until=None,
+                               set=None, partitions=4, workers=4,
+                               fields=None, filter=None,
+                               queue_size=QUEUE_SIZE):
+        """Harvest ListRecords in date windows, in parallel.
+
+        The from_/until range is split into partitions consecutive
+        windows, and the resumption lists of the windows are harvested
+        concurrently by workers threads. from_ defaults to the earliest
+        datestamp of the repository and until to now. The workers stop
+        fetching while queue_size records per worker wait to be
+        processed. The lists are not checkpointed, as the workers
+        fetch ahead of the records that have been processed.
+
+        Returns an iterable of header, metadata, about tuples in no
+        particular order. A record that moves to a later window because
+        it is modified during the harvest is returned only once.
+        """
+        if from_ is None:
+            from_ = self.identify().earliestDatestamp()
+        if until is None:
+            until = datetime.datetime.utcnow()
+        worker_client = self.withoutCheckpoints()
+        def harvest(window_from, window_until):
+            kw = {'metadataPrefix': metadataPrefix,
+                  'from_': window_from,
+                  'until': window_until,
+                  'fields': fields,
+                  'filter': filter}
+            if set is not None:
+                kw['set'] = set
+            try:
+                for record in worker_client.listRecords(**kw):
+                    yield record
+            except error.NoRecordsMatchError:
+                pass
+        windows = dateWindows(from_, until, partitions,
+                              self._day_granularity)
+        return UniqueRecordGenerator(ConcurrentGenerator(
+            [harvest(window_from, window_until)
+             for window_from, window_until in windows], workers,
+            workers * queue_size))
+
+    def listRecordsBySet(self, metadataPrefix, sets=None, from_=None,
+                         until=None, workers=4, fields=None, filter=None,
+                         queue_size=QUEUE_SIZE):
+        """Harvest ListRecords set by set, in parallel.
+
+        The resumption lists of the sets are harvested concurrently by
+        workers threads. sets is a list of setSpecs, all sets from
+        listSets if not given. The workers stop fetching while
+        queue_size records per worker wait to be processed. The lists
+        are not checkpointed, as the workers fetch ahead of the records
+        that have been processed.
+
+        Returns an iterable of header, metadata, about tuples in no
+        particular order. A record in several of the sets is returned
+        once, from the first of those sets in sets.
+        """
+        if sets is None:
+            sets = [setSpec for setSpec, setName, setDescription
+                    in self.listSets()]
+        worker_client = self.withoutCheckpoints()
+        def harvest(setSpec):
+            kw = {'metadataPrefix': metadataPrefix, 'set': setSpec,
+                  'fields': fields, 'filter': filter}
+            if from_ is not None:
+                kw['from_'] = from_
+            if until is not None:
+                kw['until'] = until
+            try:
+                for record in worker_client.listRecords(**kw):
+                    owner = firstSet(record[0].setSpec(), sets)
+                    # another set's harvest returns this one
+                    if owner is not None and owner != setSpec:
+                        continue
+                    yield record
+            except error.NoRecordsMatchError:
+                pass
+        # identifiers still need checking, the headers may not list the
+        # set (for instance a parent set in a set hierarchy)
+        return UniqueRecordGenerator(ConcurrentGenerator(
+            [harvest(setSpec) for setSpec in sets], workers,
+            workers * queue_size))
 
     # various helper methods
 
     def buildRecords(self,
-                     metadata_prefix, namespaces, metadata_registry, tree):
+                     metadata_prefix, namespaces, metadata_registry, tree,
+                     fields=None, filter=None, skipped=None):
         # first find resumption token if available
-        evaluator = etree.XPathEvaluator(tree,
-                                         namespaces=namespaces)
-        token = evaluator.evaluate(
-            'string(/oai:OAI-PMH/*/oai:resumptionToken/text())')
+        token = token_xpath(tree)
         if token.strip() == '':
             token = None
-        record_nodes = evaluator.evaluate(
-            '/oai:OAI-PMH/*/oai:record')
         result = []
-        for record_node in record_nodes:
-            record_evaluator = etree.XPathEvaluator(record_node,
-                                                    namespaces=namespaces)
-            e = record_evaluator.evaluate
-            # find header node
-            header_node = e('oai:header')[0]
-            # create header
-            header = buildHeader(header_node, namespaces)
-            # find metadata node
-            metadata_list = e('oai:metadata')
-            if metadata_list:
-                metadata_node = metadata_list[0]
-                # create metadata
-                metadata = metadata_registry.readMetadata(metadata_prefix,
-                                                          metadata_node)
-            else:
-                metadata = None
-            # XXX TODO: about, should be third element of tuple
-            result.append((header, metadata, None))
+        for record_node in record_xpath(tree):
+            if filter is not None and not filter(record_node):
+                if skipped is not None:
+                    skipped(recordDatestamp(record_node))
+                continue
+            result.append(self.buildRecord(
+                metadata_prefix, namespaces, metadata_registry, record_node,
+                fields))
         return result, token
 
-    def buildIdentifiers(self, namespaces, tree):
-        evaluator = etree.XPathEvaluator(tree,
-                                         namespaces=namespaces)
+    def buildRecord(self,
+                    metadata_prefix, namespaces, metadata_registry,
+                    record_node, fields=None):
+        if self._detach and self._detach_copy:
+            record_node = copy.deepcopy(record_node)
+        # find header node
+        header_node = record_header_xpath(record_node)[0]
+        # create header
+        header = buildHeader(header_node, namespaces)
+        # find metadata node
+        metadata_list = record_metadata_xpath(record_node)
+        if metadata_list:
+            metadata_node = metadata_list[0]
+            # create metadata
+            metadata = metadata_registry.readMetadata(metadata_prefix,
+                                                      metadata_node, fields)
+        else:
+            metadata = None
+        if self._detach and not self._detach_copy:
+            header.detach()
+            if metadata is not None:
+                metadata.detach()
+        # XXX TODO: about, should be third element of tuple
+        return header, metadata, None
+
+    def buildIdentifiers(self, namespaces, tree, filter=None):
         # first find resumption token is available
-        token = evaluator.evaluate(
-            'string(/oai:OAI-PMH/*/oai:resumptionToken/text())')
-            #'string(/oai:OAI-PMH/oai:ListIdentifiers/oai:resumptionToken/text())')
+        token = token_xpath(tree)
         if token.strip() == '':
             token = None
-        header_nodes = evaluator.evaluate(
-                '/oai:OAI-PMH/oai:ListIdentifiers/oai:header')
         result = []
-        for header_node in header_nodes:
+        for header_node in identifiers_header_xpath(tree):
+            if filter is not None and not filter(header_node):
+                continue
+            if self._detach and self._detach_copy:
+                header_node = copy.deepcopy(header_node)
             header = buildHeader(header_node, namespaces)
+            if self._detach and not self._detach_copy:
+                header.detach()
             result.append(header)
         return result, token
 
     def buildSets(self, namespaces, tree):
-        evaluator = etree.XPathEvaluator(tree,
-                                         namespaces=namespaces)
         # first find resumption token if available
-        token = evaluator.evaluate(
-            'string(/oai:OAI-PMH/oai:ListSets/oai:resumptionToken/text())')
+        token = token_xpath(tree)
         if token.strip() == '':
             token = None
-        set_nodes = evaluator.evaluate(
-            '/oai:OAI-PMH/oai:ListSets/oai:set')
         sets = []
-        for set_node in set_nodes:
-            e = etree.XPathEvaluator(set_node,
-                                     namespaces=namespaces).evaluate
+        for set_node in set_xpath(tree):
             # make sure we get back unicode strings instead
             # of lxml.etree._ElementUnicodeResult objects.
-            setSpec = six.text_type(e('string(oai:setSpec/text())'))
-            setName = six.text_type(e('string(oai:setName/text())'))
+            setSpec = six.text_type(setspec_string_xpath(set_node))
+            setName = six.text_type(setname_string_xpath(set_node))
             # XXX setDescription nodes
             sets.append((setSpec, setName, None))
         return sets, token
 
     def makeRequestErrorHandling(self, **kw):
         xml = self.makeRequest(**kw)
+        return self.parseErrorHandling(xml, kw)
+
+    def parseErrorHandling(self, xml, kw):
+        """Parse the response to the request kw, raising any OAI-PMH errors.
+        """
         try:
             tree = self.parse(xml)
         except SyntaxError:
             raise error.XMLSyntaxError(kw)
         # check whether there are errors first
-        e_errors = tree.xpath('/oai:OAI-PMH/oai:error',
-                              namespaces=self.getNamespaces())
+        e_errors = error_xpath(tree)
         if e_errors:
             # XXX right now only raise first error found, does not
             # collect error info
-            for e_error in e_errors:
-                code = e_error.get('code')
-                msg = e_error.text
-                if code not in ['badArgument', 'badResumptionToken',
-                                'badVerb', 'cannotDisseminateFormat',
-                                'idDoesNotExist', 'noRecordsMatch',
-                                'noMetadataFormats', 'noSetHierarchy']:
-                    raise error.UnknownError(
-                          "Unknown error code from server: %s, message: %s" % (
-                        code, msg))
-                # find exception in error module and raise with msg
-                raise getattr(error, code[0].upper() + code[1:] + 'Error')(msg)
+            raiseError(e_errors[0])
         return tree
 
+    def streamRecords(self, args, fields=None, filter=None, skipped=None):
+        """Generate the records of ListRecords, parsing incrementally.
+        """
+        namespaces = self.getNamespaces()
+        metadata_prefix = args['metadataPrefix']
+        metadata_registry = self._metadata_registry
+        checkpoint = self.checkpointer('ListRecords', args)
+        token = self.checkpointToken('ListRecords', args)
+        resuming = token is not None
+        if resuming:
+            kw = {'resumptionToken': token}
+        else:
+            kw = args
+        while 1:
+            parser = etree.XMLPullParser(
+                events=('end',),
+                tag=(NS_OAIPMH_RECORD, NS_OAIPMH_ERROR, NS_OAIPMH_TOKEN),
+                recover=bool(self._ignore_bad_character_hack))
+            token = None
+            chunks = self.makeRequestChunks(verb='ListRecords', **kw)
+            if self._ignore_bad_character_hack:
+                chunks = cleanChunks(chunks)
+            try:
+                for chunk in chunks:
+                    parser.feed(chunk)
+                    for event, element in parser.read_events():
+                        if element.tag == NS_OAIPMH_RECORD:
+                            # drop the records we are done with
+                            while element.getprevious() is not None:
+                                del element.getparent()[0]
+                            if filter is None or filter(element):
+                                record = self.buildRecord(
+                                    metadata_prefix, namespaces,
+                                    metadata_registry, element, fields)
+                                yield record
+                                if isinstance(record[1],
+                                              common.LazyMetadata):
+                                    # read what is left before clearing
+                                    record[1].getMap()
+                            elif skipped is not None:
+                                skipped(recordDatestamp(element))
+                            element.clear()
+                        elif element.tag == NS_OAIPMH_TOKEN:
+                            token = element.text
+                        else:
+                            raiseError(element)
+                parser.close()
+            except etree.XMLSyntaxError:
+                raise error.XMLSyntaxError(kw)
+            except error.BadResumptionTokenError:
+                if not resuming:
+                    raise
+                # the checkpointed token has expired, start again
+                resuming = False
+                kw = args
+                continue
+            resuming = False
+            if token is not None and token.strip() == '':
+                token = None
+            if checkpoint is not None:
+                checkpoint(token)
+            if token is None:
+                break
+            kw = {'resumptionToken': token}
+
+    def pipelineRecords(self, args, fields=None, filter=None, skipped=None):
+        """Generate the records of ListRecords, parsed in the parse pool.
+        """
+        page_parser = PageParser(
+            self._metadata_registry, args['metadataPrefix'], fields, filter,
+            self._ignore_bad_character_hack)
+        checkpoint = self.checkpointer('ListRecords', args)
+        token = self.checkpointToken('ListRecords', args)
+        resuming = token is not None
+        if resuming:
+            kw = {'resumptionToken': token}
+        else:
+            kw = args
+        while 1:
+            pages = ConcurrentGenerator(
+                [self.submitPages(page_parser, kw)], 1, self._parse_depth)
+            try:
+                for future, token in pages:
+                    try:
+                        records, datestamps, parsed_token = future.result()
+                    except error.BadResumptionTokenError:
+                        if not resuming:
+                            raise
+                        # the checkpointed token has expired, start again
+                        resuming = False
+                        kw = args
+                        break
+                    resuming = False
+                    if skipped is not None:
+                        for datestamp in datestamps:
+                            skipped(datestamp)
+                    for record in records:
+                        yield record
+                    if checkpoint is not None:
+                        checkpoint(parsed_token)
+                    if parsed_token != token:
+                        # the token was not found by scanning the page, so
+                        # the pages fetched ahead are the wrong ones
+                        if parsed_token is None:
+                            return
+                        kw = {'resumptionToken': parsed_token}
+                        break
+                else:
+                    return
+            finally:
+                pages.close()
+
+    def submitPages(self, page_parser, kw):
+        """Fetch the pages of ListRecords and submit them to the parse pool.
+
+        Generates the future of the parsed page and the resumption
+        token of each page.
+        """
+        while 1:
+            kw = dict(kw, verb='ListRecords')
+            xml = self.makeRequest(**kw)
+            if isinstance(xml, six.text_type):
+                xml = xml.encode('utf-8')
+            token = scanToken(xml)
+            yield self._parse_pool.submit(page_parser, xml, kw), token
+            if token is None:
+                break
+            kw = {'resumptionToken': token}
+
+    def makeRequestChunks(self, **kw):
+        """Make a request, returning an iterable of chunks of the response.
+
+        By default the whole response is a single chunk.
+        """
+        xml = self.makeRequest(**kw)
+        if hasattr(xml, "encode"):
+            xml = xml.encode("utf-8")
+        return [xml]
+
     def makeRequest(self, **kw):
         raise NotImplementedError
 
 class Client(BaseClient):
     def __init__(
-            self, base_url, metadata_registry=None, credentials=None, local_file=False, force_http_get=False):
+            self, base_url, metadata_registry=None, credentials=None, local_file=False, force_http_get=False,
+            keep_alive=False, retry_policy=None):
         BaseClient.__init__(self, metadata_registry)
         self._base_url = base_url
+        self._archive = None
         self._local_file = local_file
         self._force_http_get = force_http_get
+        if keep_alive:
+            self._connection_pool = transport.ConnectionPool()
+        else:
+            self._connection_pool = None
+        self._compression = []
+        self._retry_policy = retry_policy or RetryPolicy()
         if credentials is not None:
             self._credentials = base64.encodestring('%s:%s' % credentials)
         else:
             self._credentials = None
 
+    def updateCompression(self):
+        """Update the compression setting dependent on what the server says.
+
+        Responses are requested in the compressed encodings the server
+        advertises in Identify and that we can decode.
+        """
+        self._compression = transport.acceptedEncodings(
+            self.identify().compression())
+
+    def setArchive(self, page_archive):
+        """Set an archive to add every page received from the server to.
+
+        page_archive is an archive.BlobArchive or archive.PageArchive,
+        or None to stop archiving. The raw pages are added as they are
+        received, before they are parsed, so the archive can be parsed
+        again later with a ReplayClient without downloading anything.
+        A streamed page is written to the archive while it is read, and
+        added once it has been read completely.
+        """
+        self._archive = page_archive
+
     def makeRequest(self, **kw):
         """Either load a local XML file or actually retrieve XML from a server.
         """
         if self._local_file:
-            with codecs.open(self._base_url, 'r', 'utf-8') as xmlfile:
-                text = xmlfile.read()
-            return text.encode('ascii', 'replace')
-        else:
-            # XXX include From header?
-            headers = {'User-Agent': 'pyoai'}
-            if self._credentials is not None:
-                headers['Authorization'] = 'Basic ' + self._credentials.strip()
-            if self._force_http_get:
-                request_url = '%s?%s' % (self._base_url, urlencode(kw))
-                request = urllib2.Request(request_url, headers=headers)
+            with open(self._base_url, 'rb') as xmlfile:
+                return xmlfile.read()
+        xml = retrieveFromUrlWaiting(self.buildRequest(**kw),
+                                     opener=self._opener(),
+                                     retry_policy=self._retry_policy)
+        if self._archive is not None:
+            self._archive.add(kw, xml)
+        return xml
+
+    def makeRequestChunks(self, **kw):
+        """Make a request, returning an iterable of chunks of the response.
+
+        Responses from a server are read, and decompressed, chunk by
+        chunk.
+        """
+        if self._local_file:
+            return FileChunkGenerator(self._base_url)
+        f = openUrlWaiting(self.buildRequest(**kw), opener=self._opener(),
+                           retry_policy=self._retry_policy)
+        if self._archive is not None:
+            return self._archive.tee(kw, ClosingChunkGenerator(f))
+        return ClosingChunkGenerator(f)
+
+    def requestKey(self, verb, args):
+        return state.requestKey(self._base_url, verb, args)
+
+    def buildRequest(self, **kw):
+        """Build the urllib Request for the request arguments in kw.
+        """
+        # XXX include From header?
+        headers = {'User-Agent': 'pyoai'}
+        if self._credentials is not None:
+            headers['Authorization'] = 'Basic ' + self._credentials.strip()
+        if self._compression:
+            headers['Accept-Encoding'] = ', '.join(self._compression)
+        if self._force_http_get:
+            request_url = '%s?%s' % (self._base_url, urlencode(kw))
+            return urllib2.Request(request_url, headers=headers)
+        binary_data = urlencode(kw).encode('utf-8')
+        return urllib2.Request(
+            self._base_url, data=binary_data, headers=headers)
+
+    def _opener(self):
+        if self._connection_pool is not None:
+            return self._connection_pool.urlopen
+        return urllib2.urlopen
+
+    def close(self):
+        """Close the persistent connections held by this client.
+        """
+        if self._connection_pool is not None:
+            self._connection_pool.close()
+
+def popRecordOptions(verb, kw):
+    """Remove the record options of verb from kw and return them.
+    """
+    options = {}
+    for name in RECORD_OPTIONS.get(verb, []):
+        if name in kw:
+            options[name] = kw.pop(name)
+    return options
+
+parsers = threading.local()
+
+def recoveringParser():
+    """Get the recovering XML parser of the current thread.
+
+    The parser is made once per thread and reused for every page.
+    """
+    parser = getattr(parsers, 'recovering', None)
+    if parser is None:
+        parser = parsers.recovering = etree.XMLParser(recover=True)
+    return parser
+
+def sliceChunks(data, size=transport.CHUNK_SIZE):
+    """Generate chunks of data without copying it.
+    """
+    view = memoryview(data)
+    for i in range(0, len(view), size):
+        yield view[i:i + size]
+
+def cleanChunks(chunks):
+    """Drop the bytes that are not allowed in XML from UTF-8 chunks.
+
+    The chunks stay bytes, so the parser reads them without another
+    encoding step. Only a chunk that is not valid UTF-8, or that has the
+    characters U+FFFE or U+FFFF, is fixed and encoded again. One chunk is
+    handled at a time, so a page is never copied as a whole.
+    """
+    rest = b''
+    for chunk in chunks:
+        data = bytes(chunk).translate(None, BAD_BYTES)
+        if rest:
+            data = rest + data
+        # keep a character cut in two by the chunk for the next one
+        end = completeLength(data)
+        data, rest = data[:end], data[end:]
+        # checking the text is cheap, it is not copied again unless
+        # something needs to be changed
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            text = data.decode('utf-8', 'replace')
+            data = None
+        if u'\ufffe' in text or u'\uffff' in text:
+            text = text.replace(u'\ufffe', u'').replace(u'\uffff', u'')
+            data = None
+        if data is None:
+            data = text.encode('utf-8')
+        if data:
+            yield data
+    if rest:
+        yield rest.decode('utf-8', 'replace').encode('utf-8')
+
+def completeLength(data):
+    """Get the length of data without an unfinished UTF-8 character at its end.
+    """
+    for i in range(1, min(len(data), 4) + 1):
+        byte = data[-i]
+        if byte < 0x80:
+            break
+        if byte >= 0xc0:
+            if byte >= 0xf0:
+                needed = 4
+            elif byte >= 0xe0:
+                needed = 3
             else:
-                binary_data = urlencode(kw).encode('utf-8')
-                request = urllib2.Request(
-                    self._base_url, data=binary_data, headers=headers)
-
-            return retrieveFromUrlWaiting(request)
-
-def buildHeader(header_node, namespaces):
-    e = etree.XPathEvaluator(header_node,
-                            namespaces=namespaces).evaluate
-    identifier = e('string(oai:identifier/text())')
-    datestamp = datestamp_to_datetime(
-        str(e('string(oai:datestamp/text())')))
-    setspec = [str(s) for s in e('oai:setSpec/text()')]
-    deleted = e("@status = 'deleted'")
-    return common.Header(header_node, identifier, datestamp, setspec, deleted)
+                needed = 2
+            if needed > i:
+                return len(data) - i
+            break
+    return len(data)
 
-def ResumptionListGenerator(firstBatch, nextBatch):
-    result, token = firstBatch()
+def raiseError(e_error):
+    """Raise the exception for an oai:error element.
+    """
+    code = e_error.get('code')
+    msg = e_error.text
+    if code not in ['badArgument', 'badResumptionToken',
+                    'badVerb', 'cannotDisseminateFormat',
+                    'idDoesNotExist', 'noRecordsMatch',
+                    'noMetadataFormats', 'noSetHierarchy']:
+        raise error.UnknownError(
+              "Unknown error code from server: %s, message: %s" % (
+            code, msg))
+    # find exception in error module and raise with msg
+    raise getattr(error, code[0].upper() + code[1:] + 'Error')(msg)
+
+def scanToken(xml):
+    """Find the resumption token in the raw page xml, without parsing it.
+
+    The token is the last element of a list, so the page is searched
+    from the end. Returns None if there is no token or it is empty.
+    """
+    end = len(xml)
     while 1:
+        end = xml.rfind(b'resumptionToken', 0, end)
+        if end == -1:
+            return None
+        start = xml.rfind(b'<', 0, end)
+        match = TOKEN_PATTERN.match(xml, max(start, 0))
+        if match is not None:
+            break
+        end = start
+    token = match.group(1)
+    if not token or not token.strip():
+        return None
+    if b'&' in token:
+        # leave entities and character references to the parser
+        return etree.XML(b'<t>' + token + b'</t>').text
+    return token.decode('utf-8')
+
+def recordDatestamp(record_node):
+    """Get the datestamp of the header of the oai:record record_node.
+    """
+    return datestamp_to_datetime(record_datestamp_xpath(record_node))
+
+def buildHeader(header_node, namespaces=NAMESPACES):
+    # namespaces is kept for compatibility, the compiled expressions
+    # always use the OAI-PMH namespace
+    identifier = identifier_xpath(header_node)
+    datestamp = datestamp_to_datetime(datestamp_xpath(header_node))
+    setspec = setspec_xpath(header_node)
+    deleted = deleted_xpath(header_node)
+    return common.Header(header_node, identifier, datestamp, setspec, deleted)
+
+def watermarkFrom(watermark, overlap, day_granularity=False):
+    """Get the from date of a harvest that continues at watermark.
+    """
+    if day_granularity:
+        day = datetime.datetime(watermark.year, watermark.month, watermark.day)
+        return day - datetime.timedelta(days=overlap.days)
+    return watermark.replace(microsecond=0) - overlap
+
+def dateWindows(from_, until, partitions, day_granularity=False):
+    """Split the inclusive from_/until range into consecutive windows.
+
+    Returns a list of at most partitions from_, until tuples. The windows
+    don't overlap: each ends one second, or with day granularity one day,
+    before the next one starts.
+    """
+    if day_granularity:
+        step = datetime.timedelta(days=1)
+        from_ = datetime.datetime(from_.year, from_.month, from_.day)
+        until = datetime.datetime(until.year, until.month, until.day)
+    else:
+        step = datetime.timedelta(seconds=1)
+        from_ = from_.replace(microsecond=0)
+        until = until.replace(microsecond=0)
+    # the number of distinct datestamps in the range
+    stamps = (until - from_) // step + 1
+    if stamps < 1:
+        # leave it to the server to complain
+        return [(from_, until)]
+    partitions = max(1, min(partitions, stamps))
+    windows = []
+    start = from_
+    for i in range(partitions):
+        size = stamps * (i + 1) // partitions - stamps * i // partitions
+        end = start + step * (size - 1)
+        windows.append((start, end))
+        start = end + step
+    return windows
+
+def firstSet(setSpecs, sets):
+    """Get the first set out of sets that is in setSpecs, or None.
+    """
+    for setSpec in sets:
+        if setSpec in setSpecs:
+            return setSpec
+    return None
+
+def UniqueRecordGenerator(records):
+    """Generate records, skipping identifiers that were seen before.
+    """
+    seen = set()
+    for record in records:
+        identifier = record[0].identifier()
+        if identifier in seen:
+            continue
+        seen.add(identifier)
+        yield record
+
+def ResumptionListGenerator(firstBatch, nextBatch, prefetch=0,
+                            checkpoint=None):
+    """Generate the items of a list request, batch by batch.
+
+    checkpoint is called with the token of the next batch once all items
+    of a batch have been consumed, and with None after the last batch.
+    """
+    if prefetch > 0:
+        batches = PrefetchingBatchGenerator(firstBatch, nextBatch, prefetch)
+    else:
+        batches = BatchGenerator(firstBatch, nextBatch)
+    for result, token in batches:
         for item in result:
             yield item
+        if checkpoint is not None:
+            checkpoint(token)
+
+def BatchGenerator(firstBatch, nextBatch):
+    result, token = firstBatch()
+    while 1:
+        yield result, token
         if token is None:
             break
         result, token = nextBatch(token)
 
+def PrefetchingBatchGenerator(firstBatch, nextBatch, depth):
+    """Generate batches that are fetched ahead in a background thread.
+
+    At most depth batches are kept waiting.
+    """
+    return ConcurrentGenerator(
+        [BatchGenerator(firstBatch, nextBatch)], 1, depth)
+
+def ConcurrentGenerator(iterables, workers, maxsize=0):
+    """Generate the items of iterables, consumed by worker threads.
+
+    Up to workers iterables are consumed at the same time, and their
+    items are generated in the order in which they become available.
+    At most maxsize items are kept waiting, no limit if maxsize is 0.
+    Errors raised by an iterable are raised again in the consuming
+    thread. Closing the generator stops the workers.
+    """
+    items = queue.Queue(maxsize)
+    pending = queue.Queue()
+    for iterable in iterables:
+        pending.put(iterable)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=PREFETCH_POLL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work():
+        while not stopped.is_set():
+            try:
+                iterable = pending.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                for item in iterable:
+                    if not put((item, None)):
+                        return
+            except Exception:
+                put((None, sys.exc_info()))
+                return
+        put((done, None))
+
+    threads = [threading.Thread(target=work)
+               for i in range(min(workers, pending.qsize()))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            item, exc_info = items.get()
+            if exc_info is not None:
+                six.reraise(*exc_info)
+            if item is done:
+                running -= 1
+                continue
+            yield item
+    finally:
+        # also stops the workers when the consumer stops early
+        stopped.set()
+
 def retrieveFromUrlWaiting(request,
-                           wait_max=WAIT_MAX, wait_default=WAIT_DEFAULT):
-    """Get text from URL, handling 503 Retry-After.
+                           wait_max=WAIT_MAX, wait_default=WAIT_DEFAULT,
+                           opener=urllib2.urlopen, retry_policy=None):
+    """Get text from URL, retrying on 503 Retry-After and other failures.
+
+    opener - callable that opens the request, urllib's urlopen by default
+             or the urlopen method of a transport.ConnectionPool
+    retry_policy - RetryPolicy to use, if not given one that tries
+                   wait_max times, waiting at most wait_default seconds
+                   between tries
     """
-    for i in list(range(wait_max)):
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_tries=wait_max, backoff_max=wait_default)
+    def retrieve():
+        f = retry_policy.open(opener, request)
         try:
-            f = urllib2.urlopen(request)
-            text = f.read()
+            return b''.join(transport.decodedChunks(f))
+        finally:
             f.close()
-            # we successfully opened without having to wait
-            break
-        except urllib2.HTTPError:
-            e = sys.exc_info()[1]
-            if e.code == 503:
-                try:
-                    retryAfter = int(e.hdrs.get('Retry-After'))
-                except TypeError:
-                    retryAfter = None
-                if retryAfter is None:
-                    time.sleep(wait_default)
-                else:
-                    time.sleep(retryAfter)
-            else:
-                # reraise any other HTTP error
-                raise
-    else:
-        raise Error("Waited too often (more than %s times)" % wait_max)
-    return text
+    return retry_policy.call(retrieve)
+
+def openUrlWaiting(request,
+                   wait_max=WAIT_MAX, wait_default=WAIT_DEFAULT,
+                   opener=urllib2.urlopen, retry_policy=None):
+    """Open URL, retrying on 503 Retry-After and other failures.
+    """
+    if retry_policy is None:
+        retry_policy = RetryPolicy(max_tries=wait_max, backoff_max=wait_default)
+    return retry_policy.call(retry_policy.open, opener, request)
+
+class RetryPolicy(object):
+    """Decides whether and how long to wait before a request is retried.
+
+    Requests are retried after the HTTP status codes in retry_codes and
+    after network errors such as connection resets and timeouts. The
+    wait is taken from a Retry-After header if the server sends one,
+    otherwise it grows exponentially from backoff_base seconds up to
+    backoff_max seconds, with random jitter.
+
+    max_tries - number of times a request is tried
+    max_wait - cap on the seconds spent waiting for one request
+    timeout - socket timeout in seconds for each try, None for the default
+
+    The retries and waited attributes count the retries and the seconds
+    spent waiting over all requests made with the policy.
+    """
+    def __init__(self, max_tries=WAIT_MAX, backoff_base=BACKOFF_BASE,
+                 backoff_max=WAIT_DEFAULT, max_wait=WAIT_MAX * WAIT_DEFAULT,
+                 jitter=True, timeout=None, retry_codes=RETRY_CODES):
+        self.max_tries = max_tries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_wait = max_wait
+        self.jitter = jitter
+        self.timeout = timeout
+        self.retry_codes = retry_codes
+        self.retries = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def open(self, opener, request):
+        """Open request with opener, passing on the timeout.
+        """
+        if self.timeout is None:
+            return opener(request)
+        return opener(request, timeout=self.timeout)
+
+    def call(self, func, *args):
+        """Call func, retrying it as long as the policy allows.
+        """
+        tries = 0
+        waited = 0.0
+        while 1:
+            tries += 1
+            try:
+                return func(*args)
+            except RETRY_ERRORS:
+                delay = self.nextDelay(sys.exc_info()[1], tries, waited)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                waited += delay
+
+    def nextDelay(self, e, tries, waited):
+        """Get the seconds to wait before retrying after exception e.
+
+        tries is the number of tries made so far and waited the seconds
+        already spent waiting for this request. Returns None if the
+        request should not be retried and raises Error when the policy
+        gives up; otherwise the retry is counted.
+        """
+        delay = self.retryDelay(e, tries)
+        if delay is None:
+            return None
+        if tries >= self.max_tries:
+            raise Error(
+                "Waited too often (more than %s times)" % self.max_tries)
+        if self.max_wait is not None and waited + delay > self.max_wait:
+            raise Error(
+                "Waited too long (more than %s seconds)" % self.max_wait)
+        self.countRetry(delay)
+        return delay
+
+    def retryDelay(self, e, tries):
+        """Get the seconds to wait after exception e on try number tries.
+
+        Returns None if the request should not be retried.
+        """
+        if isinstance(e, urllib2.HTTPError):
+            if e.code not in self.retry_codes:
+                return None
+            retry_after = parseRetryAfter(e.hdrs.get('Retry-After'))
+            if retry_after is not None:
+                return retry_after
+        return self.backoff(tries)
+
+    def backoff(self, tries):
+        """Get the seconds to wait after try number tries without Retry-After.
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (tries - 1))
+        if self.jitter:
+            delay = random.uniform(delay / 2.0, delay)
+        return delay
+
+    def countRetry(self, delay):
+        with self._lock:
+            self.retries += 1
+            self.waited += delay
+
+def parseRetryAfter(value):
+    """Get the seconds to wait from a Retry-After header value, or None.
+
+    The value can be a number of seconds or an HTTP date.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, email.utils.mktime_tz(parsed) - time.time())
+
+def FileChunkGenerator(path):
+    """Generate the chunks of the file at path.
+    """
+    with open(path, 'rb') as f:
+        while 1:
+            chunk = f.read(transport.CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def ClosingChunkGenerator(f):
+    """Generate the decompressed chunks of response f, closing it after.
+    """
+    try:
+        for chunk in transport.decodedChunks(f):
+            yield chunk
+    finally:
+        f.close()
+
+class PageParser(object):
+    """Read the records of a ListRecords page, in a parse pool process.
+
+    The parser is pickled to the pool with each page. Calling it with
+    the raw page and the request arguments returns the detached records
+    the filter kept, the datestamps of the records it skipped and the
+    resumption token of the page.
+    """
+    def __init__(self, metadata_registry, metadata_prefix, fields=None,
+                 filter=None, ignore_bad_characters=False):
+        self._metadata_registry = metadata_registry
+        self._metadata_prefix = metadata_prefix
+        self._fields = fields
+        self._filter = filter
+        self._ignore_bad_characters = ignore_bad_characters
+
+    def __call__(self, xml, kw):
+        myclient = BaseClient(self._metadata_registry)
+        myclient.ignoreBadCharacters(self._ignore_bad_characters)
+        myclient.setDetach(True)
+        tree = myclient.parseErrorHandling(xml, kw)
+        datestamps = []
+        records, token = myclient.buildRecords(
+            self._metadata_prefix, myclient.getNamespaces(),
+            self._metadata_registry, tree, self._fields, self._filter,
+            datestamps.append)
+        return records, datestamps, token
 
 class ServerClient(BaseClient):
     def __init__(self, server, metadata_registry=None):
@@ -400,3 +1477,38 @@ class ServerClient(BaseClient):
 
     def makeRequest(self, **kw):
         return self._server.handleRequest(kw)
+
+class ReplayClient(BaseClient):
+    """Client that serves requests from an archive of captured pages.
+
+    Nothing goes over the network, so a historic harvest can be parsed
+    and exported again at disk speed. page_archive is an
+    archive.PageArchive or archive.BlobArchive, or the path of one.
+    """
+    def __init__(self, page_archive, metadata_registry=None):
+        BaseClient.__init__(self, metadata_registry)
+        if isinstance(page_archive, six.string_types):
+            page_archive = archive.openArchive(page_archive)
+        self._archive = page_archive
+
+    def listArchivedRecords(self, fields=None, filter=None, skipped=None):
+        """Generate the records of every ListRecords list in the archive.
+
+        The lists are parsed again in the order they were harvested in,
+        with the readers now in the metadata registry, and with the
+        parse pool or streaming when they are set. Lists that had no
+        records are passed over.
+        """
+        options = {'fields': fields, 'filter': filter, 'skipped': skipped}
+        for kw in self._archive.requests('ListRecords'):
+            try:
+                for record in self.dispatchVerb('ListRecords', kw, options):
+                    yield record
+            except error.NoRecordsMatchError:
+                pass
+
+    def makeRequest(self, **kw):
+        return self._archive.read(kw)
+
+    def makeRequestChunks(self, **kw):
+        return self._archive.chunks(kw)
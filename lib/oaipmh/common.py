@@ -3,6 +3,9 @@ import pkg_resources
 from oaipmh import error
 
 class Header(object):
+    __slots__ = ('_element', '_identifier', '_datestamp', '_setspec',
+                 '_deleted')
+
     def __init__(self, element, identifier, datestamp, setspec, deleted):
         self._element = element
         # force identifier to be a string, it might be 
@@ -18,6 +21,11 @@ class Header(object):
     def element(self):
         return self._element
 
+    def detach(self):
+        """Drop the reference to the element, so it can be freed.
+        """
+        self._element = None
+
     def identifier(self):
         return self._identifier
 
@@ -31,6 +39,8 @@ class Header(object):
         return self._deleted
 
 class Metadata(object):
+    __slots__ = ('_element', '_map')
+
     def __init__(self, element, map):
         self._element = element
         self._map = map
@@ -38,6 +48,11 @@ class Metadata(object):
     def element(self):
         return self._element
 
+    def detach(self):
+        """Drop the reference to the element, so it can be freed.
+        """
+        self._element = None
+
     def getMap(self):
         return self._map
 
@@ -46,6 +61,44 @@ class Metadata(object):
 
     __getitem__ = getField
 
+class LazyMetadata(Metadata):
+    """Metadata that reads a field from the element when it is first asked for.
+
+    reader is the metadata.MetadataReader that reads the fields. Fields
+    that have been read are kept, getMap reads all remaining fields.
+    """
+    __slots__ = ('_reader', )
+
+    def __init__(self, element, reader):
+        Metadata.__init__(self, element, {})
+        self._reader = reader
+
+    def getMap(self):
+        missing = [name for name in self._reader.fieldNames()
+                   if name not in self._map]
+        if missing:
+            self._map.update(self._reader.readMap(self._element, missing))
+        return self._map
+
+    def getField(self, name):
+        try:
+            return self._map[name]
+        except KeyError:
+            pass
+        if name not in self._reader.fieldNames():
+            raise KeyError(name)
+        value = self._reader.readMap(self._element, [name])[name]
+        self._map[name] = value
+        return value
+
+    def detach(self):
+        """Read the remaining fields and drop the element.
+        """
+        self.getMap()
+        self._element = None
+
+    __getitem__ = getField
+
 class Identify(object):
     def __init__(self, repositoryName, baseURL, protocolVersion, adminEmails,
                  earliestDatestamp, deletedRecord, granularity, compression,
@@ -1,14 +1,23 @@
 import datetime
+from functools import lru_cache
 from oaipmh.error import DatestampError
 
+# how many distinct datestamps are remembered in each direction; records
+# imported in a batch often share the same second, so a page mostly
+# repeats a handful of values
+CACHE_SIZE = 1024
+
 def datetime_to_datestamp(dt, day_granularity=False):
     assert dt.tzinfo is None # only accept timezone naive datetimes
+    return _datetime_to_datestamp(dt, day_granularity)
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _datetime_to_datestamp(dt, day_granularity):
     # ignore microseconds
-    dt = dt.replace(microsecond=0)
-    result = dt.isoformat() + 'Z'
     if day_granularity:
-        result = result[:-10]
-    return result
+        return '%04d-%02d-%02d' % (dt.year, dt.month, dt.day)
+    return '%04d-%02d-%02dT%02d:%02d:%02dZ' % (
+        dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
 
 # handy utility function not used by pyoai itself yet
 def date_to_datestamp(d, day_granularity=False): 	 
@@ -17,10 +26,32 @@ def date_to_datestamp(d, day_granularity=False):
 
 def datestamp_to_datetime(datestamp, inclusive=False):
     try:
-        return _datestamp_to_datetime(datestamp, inclusive)
+        return _cached_datestamp_to_datetime(datestamp, inclusive)
     except ValueError:
         raise DatestampError(datestamp)
-    
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _cached_datestamp_to_datetime(datestamp, inclusive):
+    # fast path for the two forms OAI-PMH allows; fromisoformat accepts
+    # more than that, so the separators are checked first, and anything
+    # it refuses goes through the general parser
+    try:
+        if len(datestamp) == 20:
+            if (datestamp[4] == '-' and datestamp[7] == '-' and
+                datestamp[10] == 'T' and datestamp[13] == ':' and
+                datestamp[16] == ':' and datestamp[19] == 'Z'):
+                return datetime.datetime.fromisoformat(datestamp[:19])
+        elif len(datestamp) == 10:
+            if datestamp[4] == '-' and datestamp[7] == '-':
+                result = datetime.datetime.fromisoformat(datestamp)
+                if inclusive:
+                    # used when a date was specified as ?until parameter
+                    result = result.replace(hour=23, minute=59, second=59)
+                return result
+    except ValueError:
+        pass
+    return _datestamp_to_datetime(datestamp, inclusive)
+
 def _datestamp_to_datetime(datestamp, inclusive=False):
     splitted = datestamp.split('T')
     if len(splitted) == 2:
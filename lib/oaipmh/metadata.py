@@ -1,3 +1,4 @@
+import re
 import sys
 
 from lxml import etree
@@ -34,14 +35,18 @@ class MetadataRegistry(object):
     def hasWriter(self, metadata_prefix):
         return metadata_prefix in self._writers
     
-    def readMetadata(self, metadata_prefix, element):
+    def readMetadata(self, metadata_prefix, element, fields=None):
         """Turn XML into metadata object.
 
         element - element to read in
+        fields - names of the fields to read, all fields if None;
+                 the reader must support this, as MetadataReader does
 
         returns - metadata object
         """
-        return self._readers[metadata_prefix](element)
+        if fields is None:
+            return self._readers[metadata_prefix](element)
+        return self._readers[metadata_prefix](element, fields)
 
     def writeMetadata(self, metadata_prefix, element, metadata):
         """Write metadata as XML.
@@ -56,38 +61,170 @@ global_metadata_registry = MetadataRegistry()
 class Error(Exception):
     pass
 
+FIELD_TYPES = ['bytes', 'bytesList', 'text', 'textList']
+
+# expressions of the form [prefix:]container/[prefix:]name/text(), or
+# string() of it, select the text of child elements and can be read in
+# a single walk over the children of the container
+name_expr = r'(?:[A-Za-z_][\w.-]*:)?[A-Za-z_][\w.-]*'
+walk_expr = re.compile(
+    r'^(?:(%s)/)?(%s)/text\(\)$' % (name_expr, name_expr))
+string_expr = re.compile(r'^string\((.*)\)$')
+
 class MetadataReader(object):
     """A default implementation of a reader based on fields.
+
+    fields maps field names to a field type and an XPath expression.
+    Unless compiled is false, fields that select the text of child
+    elements (such as 'oai_dc:dc/dc:title/text()') are all read in a
+    single walk over the element, other fields are read with XPath.
+
+    Calling the reader with a list of field names reads only those
+    fields. A lazy reader returns common.LazyMetadata, which reads each
+    field when it is first asked for.
     """
-    def __init__(self, fields, namespaces=None):
+    def __init__(self, fields, namespaces=None, compiled=True, lazy=False):
         self._fields = fields
         self._namespaces = namespaces or {}
+        self._compiled = compiled
+        self._lazy = lazy
+        # readers for subsets of the fields
+        self._projections = {}
+        # (field name, field type, compiled expression) of XPath fields
+        self._xpath_fields = []
+        # container tag, or None for the element itself, to child tag
+        # to names of the fields read from it
+        self._walk = {}
+        # fields read in the walk that have a single value
+        self._walk_single = []
+        for field_name, (field_type, expr) in fields.items():
+            if field_type not in FIELD_TYPES:
+                raise Error("Unknown field type: %s" % field_type)
+            if compiled and self._addWalkField(field_name, field_type, expr):
+                continue
+            self._xpath_fields.append(
+                (field_name, field_type,
+                 etree.XPath(expr, namespaces=self._namespaces,
+                             smart_strings=False)))
+
+    def __reduce__(self):
+        # compiled expressions can't be pickled, so the reader is made
+        # again from its fields, for instance in a parse pool process
+        return (self.__class__, (self._fields, self._namespaces,
+                                 self._compiled, self._lazy))
+
+    def _addWalkField(self, field_name, field_type, expr):
+        single = not field_type.endswith('List')
+        if single:
+            match = string_expr.match(expr)
+            if match is None:
+                return False
+            expr = match.group(1)
+        match = walk_expr.match(expr)
+        if match is None:
+            return False
+        container, name = match.groups()
+        try:
+            if container is not None:
+                container = self._tag(container)
+            name = self._tag(name)
+        except KeyError:
+            # leave it to XPath to complain
+            return False
+        names = self._walk.setdefault(container, {}).setdefault(name, [])
+        names.append(field_name)
+        if single:
+            self._walk_single.append(field_name)
+        return True
+
+    def _tag(self, name):
+        if ':' not in name:
+            return name
+        prefix, local = name.split(':')
+        return '{%s}%s' % (self._namespaces[prefix], local)
+
+    def project(self, fields):
+        """Get a reader that reads only the named fields.
+        """
+        key = frozenset(fields)
+        reader = self._projections.get(key)
+        if reader is None:
+            unknown = key.difference(self._fields)
+            if unknown:
+                raise Error("Unknown fields: %s" % ', '.join(sorted(unknown)))
+            reader = MetadataReader(
+                dict([(field_name, self._fields[field_name])
+                      for field_name in key]),
+                self._namespaces, self._compiled, self._lazy)
+            self._projections[key] = reader
+        return reader
+
+    def lazyReader(self):
+        """Get a lazy reader for the same fields.
+        """
+        return MetadataReader(self._fields, self._namespaces,
+                              self._compiled, lazy=True)
 
-    def __call__(self, element):
+    def fieldNames(self):
+        return list(self._fields.keys())
+
+    def __call__(self, element, fields=None):
+        if fields is not None:
+            return self.project(fields)(element)
+        if self._lazy:
+            return common.LazyMetadata(element, self)
+        return common.Metadata(element, self.readMap(element))
+
+    def readMap(self, element, fields=None):
+        """Read the fields, all if fields is None, into a dictionary.
+        """
+        if fields is not None:
+            return self.project(fields).readMap(element)
         map = {}
-        # create XPathEvaluator for this element
-        xpath_evaluator = etree.XPathEvaluator(element, 
-                                               namespaces=self._namespaces)
-        
-        e = xpath_evaluator.evaluate
-        # now extra field info according to xpath expr
-        for field_name, (field_type, expr) in list(self._fields.items()):
+        if self._walk:
+            self._readWalk(element, map)
+        for field_name, field_type, xpath in self._xpath_fields:
+            value = xpath(element)
             if field_type == 'bytes':
-                value = str(e(expr))
+                value = str(value)
             elif field_type == 'bytesList':
-                value = [str(item) for item in e(expr)]
+                value = [str(item) for item in value]
             elif field_type == 'text':
-                # make sure we get back unicode strings instead
-                # of lxml.etree._ElementUnicodeResult objects.
-                value = text_type(e(expr))
-            elif field_type == 'textList':
-                # make sure we get back unicode strings instead
-                # of lxml.etree._ElementUnicodeResult objects.
-                value = [text_type(v) for v in e(expr)]
+                value = text_type(value)
             else:
-                raise Error("Unknown field type: %s" % field_type)
+                value = [text_type(v) for v in value]
             map[field_name] = value
-        return common.Metadata(element, map)
+        return map
+
+    def _readWalk(self, element, map):
+        walk = self._walk
+        for tags in walk.values():
+            for names in tags.values():
+                for field_name in names:
+                    map[field_name] = []
+        for container_tag, tags in walk.items():
+            if container_tag is None:
+                containers = [element]
+            else:
+                containers = element.iterchildren(container_tag)
+            for container in containers:
+                for child in container:
+                    names = tags.get(child.tag)
+                    if names is None:
+                        continue
+                    # the text nodes of the child, as text() gives them
+                    texts = []
+                    if child.text is not None:
+                        texts.append(child.text)
+                    if len(child):
+                        for node in child:
+                            if node.tail is not None:
+                                texts.append(node.tail)
+                    for field_name in names:
+                        map[field_name].extend(texts)
+        for field_name in self._walk_single:
+            values = map[field_name]
+            map[field_name] = values and values[0] or ''
 
 oai_dc_reader = MetadataReader(
     fields={
@@ -0,0 +1,699 @@
+# Released under the BSD license (see LICENSE.txt)
+"""Sinks that write harvested records to files.
+
+A sink is given the records that listRecords generates, (header,
+metadata, about) tuples, one at a time with write. It collects them and
+writes them out in batches through a large file buffer; close writes
+what is left. sync writes them out and makes sure they are on disk,
+a client calls it before it checkpoints when it is given to
+setBeforeCheckpoint. Sinks can be used as context managers.
+
+The row of a record starts with the columns of its header, followed by
+one column for each of the metadata fields the sink was made with.
+"""
+from __future__ import absolute_import
+
+import csv
+import gzip
+import io
+import json
+import os
+import sqlite3
+import sys
+import time
+import zlib
+
+from oaipmh.datestamp import datetime_to_datestamp
+from oaipmh.state import replace, writeAtomically
+
+# pyarrow is only needed for the columnar sinks
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+# and zstandard for zstd compression
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BUFFER_SIZE = 1024 * 1024 # bytes
+BATCH_SIZE = 1000 # records
+ROW_GROUP_SIZE = 100000 # records
+SHARD_RECORDS = 1000000 # records
+SHARD_BYTES = 256 * 1024 * 1024 # compressed bytes
+PROGRESS_INTERVAL = 10 # seconds
+HEADER_COLUMNS = ['oai_identifier', 'datestamp', 'setSpec', 'deleted']
+# separates the values of a multi-valued field in a single cell
+SEPARATOR = u'|'
+
+class Error(Exception):
+    pass
+
+def joinValues(values):
+    """Join the values of a multi-valued field into one cell.
+
+    The values are separated by SEPARATOR; a separator or a backslash
+    in a value is escaped with a backslash.
+    """
+    escaped = []
+    for value in values:
+        if u'\\' in value or SEPARATOR in value:
+            value = value.replace(u'\\', u'\\\\').replace(
+                SEPARATOR, u'\\' + SEPARATOR)
+        escaped.append(value)
+    return SEPARATOR.join(escaped)
+
+def splitValues(cell):
+    """Split a cell made by joinValues into its values.
+    """
+    if not cell:
+        return []
+    values = []
+    value = []
+    chars = iter(cell)
+    for char in chars:
+        if char == u'\\':
+            value.append(next(chars, u''))
+        elif char == SEPARATOR:
+            values.append(u''.join(value))
+            value = []
+        else:
+            value.append(char)
+    values.append(u''.join(value))
+    return values
+
+def recordRow(record, fields):
+    """Get the header values and the values of fields of record.
+
+    Multi-valued fields and setSpec are lists; fields the metadata
+    doesn't have, and all fields of deleted records, are None.
+    """
+    header, metadata, about = record
+    row = [header.identifier(), datetime_to_datestamp(header.datestamp()),
+           header.setSpec(), header.isDeleted()]
+    if metadata is None:
+        row.extend([None] * len(fields))
+    else:
+        map = metadata.getMap()
+        row.extend([map.get(field) for field in fields])
+    return row
+
+def recordDict(record, fields=None):
+    """Get record as a dictionary that can be written as JSON.
+
+    Only the metadata fields in fields are included, all if it is None.
+    metadata is None for deleted records.
+    """
+    header, metadata, about = record
+    if metadata is not None:
+        map = metadata.getMap()
+        if fields is not None:
+            map = dict([(field, map.get(field)) for field in fields])
+    else:
+        map = None
+    return {'identifier': header.identifier(),
+            'datestamp': datetime_to_datestamp(header.datestamp()),
+            'setSpec': header.setSpec(),
+            'deleted': header.isDeleted(),
+            'metadata': map}
+
+def jsonLines(records, fields=None):
+    """Get the JSON Lines of records, each line ends in a newline.
+    """
+    lines = [json.dumps(recordDict(record, fields), ensure_ascii=False)
+             for record in records]
+    lines.append(u'')
+    return u'\n'.join(lines)
+
+def formatCell(value):
+    if value is None:
+        return u''
+    if isinstance(value, bool):
+        return value and u'true' or u'false'
+    if isinstance(value, list):
+        return joinValues(value)
+    return value
+
+class Sink(object):
+    """Base class of the sinks.
+
+    Records are kept until there are batch_size of them, and then
+    handed to writeBatch together. count is the number of records
+    written. appendable tells whether the sink can be opened with
+    append, to go on with a harvest that was interrupted.
+    """
+    appendable = True
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self._batch = []
+        self._batch_size = batch_size
+        self.count = 0
+
+    def write(self, record):
+        self._batch.append(record)
+        self.count += 1
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self.writeBatch(self._batch)
+            self._batch = []
+
+    def writeBatch(self, records):
+        raise NotImplementedError
+
+    def sync(self):
+        """Write out the records collected so far, durably.
+        """
+        self.flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class FileSink(Sink):
+    """Sink that writes text to the file at path.
+
+    The file is overwritten, unless append is true; then the records
+    are added to the end of it. new tells whether the file was empty.
+    """
+    def __init__(self, path, batch_size=BATCH_SIZE, buffer_size=BUFFER_SIZE,
+                 append=False):
+        Sink.__init__(self, batch_size)
+        self.new = not (append and os.path.exists(path) and
+                        os.path.getsize(path))
+        self._file = io.open(path, append and 'a' or 'w', encoding='utf-8',
+                             newline='', buffering=buffer_size)
+
+    def sync(self):
+        Sink.sync(self)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        try:
+            Sink.close(self)
+        finally:
+            self._file.close()
+
+class CSVSink(FileSink):
+    """Write records as CSV, with a header line.
+
+    fields are the metadata fields to write; columns, if given, are the
+    names of their columns. The values of multi-valued fields are
+    joined with joinValues. When appending to a file that isn't empty
+    the header line is left out.
+    """
+    def __init__(self, path, fields, columns=None, delimiter=',',
+                 batch_size=BATCH_SIZE, buffer_size=BUFFER_SIZE,
+                 append=False):
+        FileSink.__init__(self, path, batch_size, buffer_size, append)
+        self._fields = fields
+        self._writer = csv.writer(self._file, delimiter=delimiter)
+        if self.new:
+            self._writer.writerow(HEADER_COLUMNS + list(columns or fields))
+
+    def writeBatch(self, records):
+        fields = self._fields
+        self._writer.writerows(
+            [[formatCell(value) for value in recordRow(record, fields)]
+             for record in records])
+
+# backslash escapes of the characters that can't be in a TSV cell
+TSV_ESCAPES = [(u'\\', u'\\\\'), (u'\t', u'\\t'), (u'\n', u'\\n'),
+               (u'\r', u'\\r')]
+
+def escapeTSV(cell):
+    for char, escape in TSV_ESCAPES:
+        if char in cell:
+            cell = cell.replace(char, escape)
+    return cell
+
+class TSVSink(FileSink):
+    """Write records as tab separated values, with a header line.
+
+    Tabs, newlines and backslashes in cells are escaped with a
+    backslash, so every record is on a single line. Multi-valued
+    fields are joined with joinValues before they are escaped.
+    """
+    def __init__(self, path, fields, columns=None,
+                 batch_size=BATCH_SIZE, buffer_size=BUFFER_SIZE,
+                 append=False):
+        FileSink.__init__(self, path, batch_size, buffer_size, append)
+        self._fields = fields
+        if self.new:
+            self._file.write(
+                u'\t'.join(HEADER_COLUMNS + list(columns or fields)))
+            self._file.write(u'\n')
+
+    def writeBatch(self, records):
+        fields = self._fields
+        lines = [u'\t'.join([escapeTSV(formatCell(value))
+                             for value in recordRow(record, fields)])
+                 for record in records]
+        lines.append(u'')
+        self._file.write(u'\n'.join(lines))
+
+class JSONLinesSink(FileSink):
+    """Write records as JSON Lines, one recordDict on every line.
+
+    Only the metadata fields in fields are written, all if it is None.
+    columns is accepted for the other sinks' sake and ignored.
+    """
+    def __init__(self, path, fields=None, columns=None,
+                 batch_size=BATCH_SIZE, buffer_size=BUFFER_SIZE,
+                 append=False):
+        FileSink.__init__(self, path, batch_size, buffer_size, append)
+        self._fields = fields
+
+    def writeBatch(self, records):
+        self._file.write(jsonLines(records, self._fields))
+
+class ProgressSink(Sink):
+    """Pass records on to sink, reporting progress every interval seconds.
+
+    Instead of a line per record a line with the number of records, how
+    many of them are deleted and the rate is written to stream, stderr
+    by default, and a last one when the sink is closed.
+    """
+    def __init__(self, sink, interval=PROGRESS_INTERVAL, stream=None,
+                 clock=time.time):
+        Sink.__init__(self)
+        self._sink = sink
+        self._interval = interval
+        self._stream = stream or sys.stderr
+        self._clock = clock
+        self._start = self._last = clock()
+        self.deleted = 0
+
+    def write(self, record):
+        self._sink.write(record)
+        self.count += 1
+        if record[0].isDeleted():
+            self.deleted += 1
+        now = self._clock()
+        if now - self._last >= self._interval:
+            self._last = now
+            self.report(now)
+
+    def report(self, now):
+        elapsed = now - self._start
+        self._stream.write('%d records, %d deleted, %.0f records/sec\n' % (
+            self.count, self.deleted, elapsed and self.count / elapsed or 0))
+        self._stream.flush()
+
+    def flush(self):
+        self._sink.flush()
+
+    def sync(self):
+        self._sink.sync()
+
+    def close(self):
+        self._sink.close()
+        self.report(self._clock())
+
+class ColumnSink(Sink):
+    """Base class of the sinks that write columns with pyarrow.
+
+    The values of each column are collected in a list, and every
+    row_group_size records the lists are turned into a table that is
+    handed to writeTable. datestamp is a timestamp column and setSpec
+    and the fields with a list type are list columns.
+
+    field_types maps the names of fields to their field type in
+    metadata.FIELD_TYPES; fields that aren't in it are 'textList', as
+    the fields of oai_dc are.
+
+    A column file can't be added to, so append raises Error. It can
+    only be read once it is closed, so sync does nothing.
+    """
+    appendable = False
+
+    def __init__(self, fields, columns=None, field_types=None,
+                 row_group_size=ROW_GROUP_SIZE):
+        if pyarrow is None:
+            raise Error("pyarrow is needed to write columns")
+        Sink.__init__(self, row_group_size)
+        self._fields = fields
+        field_types = field_types or {}
+        string_list = pyarrow.list_(pyarrow.string())
+        types = [pyarrow.string(), pyarrow.timestamp('s'), string_list,
+                 pyarrow.bool_()]
+        for field in fields:
+            if field_types.get(field, 'textList').endswith('List'):
+                types.append(string_list)
+            else:
+                types.append(pyarrow.string())
+        self.schema = pyarrow.schema(
+            list(zip(HEADER_COLUMNS + list(columns or fields), types)))
+        self._columns = [[] for name in self.schema.names]
+
+    def write(self, record):
+        header, metadata, about = record
+        columns = self._columns
+        columns[0].append(header.identifier())
+        columns[1].append(header.datestamp())
+        columns[2].append(header.setSpec())
+        columns[3].append(header.isDeleted())
+        if metadata is None:
+            for column in columns[4:]:
+                column.append(None)
+        else:
+            map = metadata.getMap()
+            for field, column in zip(self._fields, columns[4:]):
+                column.append(map.get(field))
+        self.count += 1
+        if len(columns[0]) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._columns[0]:
+            return
+        self.writeTable(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type)
+             for column, field in zip(self._columns, self.schema)],
+            schema=self.schema))
+        self._columns = [[] for name in self.schema.names]
+
+    def writeTable(self, table):
+        raise NotImplementedError
+
+    def sync(self):
+        pass
+
+class ParquetSink(ColumnSink):
+    """Write records to a Parquet file, a row group per row_group_size.
+    """
+    def __init__(self, path, fields, columns=None, field_types=None,
+                 row_group_size=ROW_GROUP_SIZE, compression='snappy',
+                 append=False):
+        if append:
+            raise Error("Can't append to: %s" % path)
+        ColumnSink.__init__(self, fields, columns, field_types,
+                            row_group_size)
+        self._writer = pyarrow.parquet.ParquetWriter(
+            path, self.schema, compression=compression)
+
+    def writeTable(self, table):
+        self._writer.write_table(table, row_group_size=len(table))
+
+    def close(self):
+        try:
+            ColumnSink.close(self)
+        finally:
+            self._writer.close()
+
+class ArrowSink(ColumnSink):
+    """Write records to an Arrow IPC file, a record batch per row_group_size.
+    """
+    def __init__(self, path, fields, columns=None, field_types=None,
+                 row_group_size=ROW_GROUP_SIZE, append=False):
+        if append:
+            raise Error("Can't append to: %s" % path)
+        ColumnSink.__init__(self, fields, columns, field_types,
+                            row_group_size)
+        self._file = pyarrow.OSFile(path, 'wb')
+        self._writer = pyarrow.ipc.new_file(self._file, self.schema)
+
+    def writeTable(self, table):
+        self._writer.write_table(table, max_chunksize=len(table))
+
+    def close(self):
+        try:
+            ColumnSink.close(self)
+        finally:
+            self._writer.close()
+            self._file.close()
+
+def compressedExtension():
+    """Get the extension of the best compression there is, zstd or gzip.
+    """
+    if zstandard is not None:
+        return '.zst'
+    return '.gz'
+
+class ShardedJSONLinesSink(Sink):
+    """Write records as compressed JSON Lines, in shards.
+
+    path names the shards, with an extension of .gz for gzip or .zst
+    for zstd: harvest.jsonl.gz is written as harvest.00000.jsonl.gz,
+    harvest.00001.jsonl.gz and so on, numbered on from the shards that
+    are there already. A new shard is started once one has max_records
+    records or max_bytes compressed bytes. A shard is written under a
+    .part name and renamed when it is complete, so only complete shards
+    have their final name; shards lists them.
+
+    Every line is a recordDict, with only the metadata fields in
+    fields, all if it is None. compressedExtension gives the extension
+    of the best compression that is installed. Shards that are there
+    are never overwritten, so append makes no difference.
+
+    sync flushes the compressor and syncs the .part file. The records
+    synced to a .part shard that was left behind by a crash are written
+    to a shard of its own when the sink is made again.
+    """
+    def __init__(self, path, fields=None, columns=None,
+                 max_records=SHARD_RECORDS, max_bytes=SHARD_BYTES,
+                 batch_size=BATCH_SIZE, buffer_size=BUFFER_SIZE,
+                 append=False):
+        Sink.__init__(self, batch_size)
+        base, self._compression = os.path.splitext(path)
+        if self._compression not in ('.gz', '.zst'):
+            raise Error("Unknown compression: %s" % path)
+        if self._compression == '.zst' and zstandard is None:
+            raise Error("zstandard is needed to write %s" % path)
+        self._base, self._extension = os.path.splitext(base)
+        self._fields = fields
+        self._max_records = max_records
+        self._max_bytes = max_bytes
+        self._buffer_size = buffer_size
+        self._number = 0
+        self._raw = None
+        self.shards = []
+        self.recoverShards()
+
+    def recoverShards(self):
+        """Finish the shards a crash left behind with the synced records.
+        """
+        directory = os.path.dirname(self._base) or os.curdir
+        prefix = os.path.basename(self._base) + '.'
+        suffix = self._extension + self._compression + '.part'
+        for name in sorted(os.listdir(directory)):
+            if not (name.startswith(prefix) and name.endswith(suffix) and
+                    name[len(prefix):-len(suffix)].isdigit()):
+                continue
+            part_path = os.path.join(directory, name)
+            with open(part_path, 'rb') as f:
+                data = f.read()
+            # what can be decompressed, up to the last complete line
+            if self._compression == '.zst':
+                data = zstandard.ZstdDecompressor().decompressobj(
+                    ).decompress(data)
+            else:
+                data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(
+                    data)
+            data = data[:data.rfind(b'\n') + 1]
+            if data:
+                if self._compression == '.zst':
+                    data = zstandard.ZstdCompressor().compress(data)
+                else:
+                    data = gzip.compress(data)
+                writeAtomically(part_path[:-len('.part')], data)
+            os.remove(part_path)
+
+    def shardPath(self, number):
+        return '%s.%05d%s%s' % (self._base, number, self._extension,
+                                self._compression)
+
+    def openShard(self):
+        while os.path.exists(self.shardPath(self._number)):
+            self._number += 1
+        self._path = self.shardPath(self._number)
+        self._raw = open(self._path + '.part', 'wb',
+                         buffering=self._buffer_size)
+        if self._compression == '.zst':
+            self._file = zstandard.ZstdCompressor().stream_writer(
+                self._raw, closefd=False)
+        else:
+            # leave the .part name out of the gzip header
+            self._file = gzip.GzipFile(filename='', fileobj=self._raw,
+                                       mode='wb')
+        self._shard_count = 0
+
+    def closeShard(self):
+        self._file.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        self._raw = None
+        replace(self._path + '.part', self._path)
+        self.shards.append(self._path)
+
+    def writeBatch(self, records):
+        while records:
+            if self._raw is None:
+                self.openShard()
+            room = self._max_records - self._shard_count
+            self._file.write(
+                jsonLines(records[:room], self._fields).encode('utf-8'))
+            self._shard_count += len(records[:room])
+            records = records[room:]
+            if self._compression == '.zst':
+                # the compressor keeps everything until it is flushed,
+                # and the size of the shard is needed
+                self._file.flush(zstandard.FLUSH_BLOCK)
+            if (self._shard_count >= self._max_records or
+                self._raw.tell() >= self._max_bytes):
+                self.closeShard()
+
+    def sync(self):
+        Sink.sync(self)
+        if self._raw is None:
+            return
+        if self._compression == '.zst':
+            self._file.flush(zstandard.FLUSH_BLOCK)
+        else:
+            self._file.flush(zlib.Z_SYNC_FLUSH)
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+
+    def close(self):
+        try:
+            Sink.close(self)
+        finally:
+            if self._raw is not None:
+                self.closeShard()
+
+SQLITE_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS records ('
+    'identifier TEXT PRIMARY KEY, datestamp TEXT NOT NULL, '
+    'deleted INTEGER NOT NULL, metadata TEXT)',
+    'CREATE TABLE IF NOT EXISTS record_sets ('
+    'setSpec TEXT NOT NULL, identifier TEXT NOT NULL, '
+    'PRIMARY KEY (setSpec, identifier))',
+    'CREATE INDEX IF NOT EXISTS records_datestamp ON records (datestamp)',
+    'CREATE INDEX IF NOT EXISTS record_sets_identifier '
+    'ON record_sets (identifier)',
+    ]
+# true unless a newer version of the record is stored already
+NOT_NEWER = ('NOT EXISTS (SELECT 1 FROM records WHERE '
+             'identifier = :identifier AND datestamp > :datestamp)')
+SQLITE_DELETE_SETS = ('DELETE FROM record_sets '
+                      'WHERE identifier = :identifier AND ' + NOT_NEWER)
+SQLITE_INSERT_SET = ('INSERT OR IGNORE INTO record_sets (setSpec, identifier) '
+                     'SELECT :setSpec, :identifier WHERE ' + NOT_NEWER)
+SQLITE_UPSERT = (
+    'INSERT INTO records (identifier, datestamp, deleted, metadata) '
+    'VALUES (:identifier, :datestamp, :deleted, :metadata) '
+    'ON CONFLICT (identifier) DO UPDATE SET '
+    'datestamp = excluded.datestamp, deleted = excluded.deleted, '
+    'metadata = excluded.metadata '
+    'WHERE excluded.datestamp >= records.datestamp')
+
+class SQLiteSink(Sink):
+    """Keep a mirror of the repository in an SQLite database.
+
+    The records table has a row per identifier with its datestamp, the
+    deleted flag and the metadata map as JSON. A record that is
+    harvested again replaces its row, unless the stored version is
+    newer. A deleted record leaves a tombstone: its row stays, deleted
+    is 1 and metadata is NULL. The setSpecs of the records are in
+    record_sets. datestamp and setSpec are indexed.
+
+    Each batch is written in a single transaction that is on disk once
+    it is committed, sync commits the records collected so far. The
+    database is in WAL mode, so it can be
+    queried while a harvest writes to it.
+    Only the metadata fields in fields are kept, all if it is None.
+    The database is always added to, so append makes no difference.
+    """
+    def __init__(self, path, fields=None, columns=None,
+                 batch_size=BATCH_SIZE, append=False):
+        Sink.__init__(self, batch_size)
+        self._fields = fields
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        # NORMAL would only survive a crash of the process, a commit has
+        # to be on disk before the harvest is checkpointed past it
+        self._connection.execute('PRAGMA synchronous = FULL')
+        with self._connection:
+            for statement in SQLITE_SCHEMA:
+                self._connection.execute(statement)
+
+    def writeBatch(self, records):
+        # keep the newest version of every record, so that the
+        # statements can run over the whole batch at once
+        rows = {}
+        for record in records:
+            row = recordDict(record, self._fields)
+            previous = rows.get(row['identifier'])
+            if previous is None or row['datestamp'] >= previous['datestamp']:
+                rows[row['identifier']] = row
+        rows = list(rows.values())
+        sets = []
+        for row in rows:
+            row['deleted'] = int(row['deleted'])
+            if row['deleted']:
+                row['metadata'] = None
+            elif row['metadata'] is not None:
+                row['metadata'] = json.dumps(row['metadata'],
+                                             ensure_ascii=False)
+            for setSpec in row['setSpec']:
+                sets.append({'identifier': row['identifier'],
+                             'datestamp': row['datestamp'],
+                             'setSpec': setSpec})
+        with self._connection:
+            self._connection.executemany(SQLITE_DELETE_SETS, rows)
+            self._connection.executemany(SQLITE_INSERT_SET, sets)
+            self._connection.executemany(SQLITE_UPSERT, rows)
+
+    def close(self):
+        try:
+            Sink.close(self)
+        finally:
+            self._connection.close()
+
+# sinks by file name extension
+SINKS = {
+    '.csv': CSVSink,
+    '.tsv': TSVSink,
+    '.jsonl': JSONLinesSink,
+    '.jsonl.gz': ShardedJSONLinesSink,
+    '.jsonl.zst': ShardedJSONLinesSink,
+    '.parquet': ParquetSink,
+    '.arrow': ArrowSink,
+    '.sqlite': SQLiteSink,
+    '.db': SQLiteSink,
+    }
+
+def sinkClass(path):
+    """Get the sink class for path, chosen by its extension.
+
+    The extension of a compressed file includes the one before it, so
+    only JSON Lines are compressed.
+    """
+    base, extension = os.path.splitext(path.lower())
+    if extension in ('.gz', '.zst'):
+        extension = os.path.splitext(base)[1] + extension
+    if extension not in SINKS:
+        raise Error("No sink for files like: %s" % path)
+    return SINKS[extension]
+
+def canAppend(path):
+    """Tell whether the sink for path can be appended to.
+    """
+    return sinkClass(path).appendable
+
+def openSink(path, fields, columns=None, **kw):
+    """Open the sink for path, chosen by its extension.
+    """
+    return sinkClass(path)(path, fields, columns, **kw)
@@ -0,0 +1,137 @@
+# Released under the BSD license (see LICENSE.txt)
+"""Durable harvest state.
+
+A store maps string keys to JSON values. Clients use a store to
+checkpoint the resumption token of a list request after each page, so
+that a harvest that was interrupted can be resumed where it stopped.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+# atomic on POSIX, and on Windows where available
+replace = getattr(os, 'replace', os.rename)
+
+class Error(Exception):
+    pass
+
+def writeAtomically(path, data, prefix='.tmp-'):
+    """Replace the file at path with the bytes in data.
+
+    data is written to a temporary file next to it, synced to disk and
+    renamed to path, so that after a crash the file at path is either
+    the old or the new version.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=prefix)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+def requestKey(base_url, verb, args):
+    """Get the key of the request with verb and args to base_url.
+
+    until and resumptionToken are left out, so that a harvest that is
+    restarted with a later until still finds the state of the one that
+    was interrupted.
+    """
+    items = sorted([(name, value) for name, value in args.items()
+                    if name not in ('until', 'resumptionToken')])
+    return '%s?%s' % (base_url, urlencode([('verb', verb)] + items))
+
+class FileStore(object):
+    """Store kept in a JSON file.
+
+    The whole file is written again on every change. The new version is
+    written to a temporary file next to it, synced to disk and renamed
+    over the old version, so that after a crash the file holds either
+    the old or the new state.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._data = self._read()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._write()
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+                self._write()
+
+    def close(self):
+        pass
+
+    def _read(self):
+        if not os.path.exists(self._path):
+            return {}
+        with open(self._path) as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                raise Error("Not a state file: %s" % self._path)
+
+    def _write(self):
+        writeAtomically(self._path, json.dumps(
+            self._data, sort_keys=True).encode('utf-8'), '.state-')
+
+class SQLiteStore(object):
+    """Store kept in an SQLite database.
+
+    Every change is committed in its own transaction.
+    """
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS state '
+                    '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                    (key, json.dumps(value, sort_keys=True)))
+
+    def delete(self, key):
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    'DELETE FROM state WHERE key = ?', (key,))
+
+    def close(self):
+        self._connection.close()
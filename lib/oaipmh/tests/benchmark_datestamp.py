@@ -0,0 +1,55 @@
+"""Measure converting datestamps in both directions.
+
+The old conversions are kept here for comparison. A harvest mostly sees
+repeated datestamps, a batch import stamps many records with the same
+second, so both a page of distinct values and a page of repeated values
+are measured. Run it from this directory:
+
+  PYTHONPATH=../.. python benchmark_datestamp.py [values per page]
+"""
+import datetime
+import sys
+from oaipmh import datestamp
+from benchmark_records import measure
+
+def oldDatestampToDatetime(value):
+    d, t = value.split('T')
+    t = t[:-1]
+    YYYY, MM, DD = d.split('-')
+    hh, mm, ss = t.split(':')
+    return datetime.datetime(
+        int(YYYY), int(MM), int(DD), int(hh), int(mm), int(ss))
+
+def oldDatetimeToDatestamp(dt):
+    dt = dt.replace(microsecond=0)
+    return dt.isoformat() + 'Z'
+
+def createDatetimes(count, distinct):
+    start = datetime.datetime(2004, 1, 1)
+    return [start + datetime.timedelta(seconds=i % distinct)
+            for i in range(count)]
+
+def main(count=10000):
+    for name, distinct in [('distinct', count), ('repeated', 10)]:
+        datetimes = createDatetimes(count, distinct)
+        values = [oldDatetimeToDatestamp(dt) for dt in datetimes]
+        def oldParse():
+            for value in values:
+                oldDatestampToDatetime(value)
+        def newParse():
+            for value in values:
+                datestamp.datestamp_to_datetime(value)
+        def oldFormat():
+            for dt in datetimes:
+                oldDatetimeToDatestamp(dt)
+        def newFormat():
+            for dt in datetimes:
+                datestamp.datetime_to_datestamp(dt)
+        print('%s datestamps:' % name)
+        print('  parse, split:     %10.0f values/sec' % measure(oldParse, count))
+        print('  parse, cached:    %10.0f values/sec' % measure(newParse, count))
+        print('  format, isoformat:%10.0f values/sec' % measure(oldFormat, count))
+        print('  format, cached:   %10.0f values/sec' % measure(newFormat, count))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
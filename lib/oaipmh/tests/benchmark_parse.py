@@ -0,0 +1,45 @@
+"""Measure parsing of dirty pages with ignoreBadCharacters.
+
+The pages have the kind of damage seen in the wild (see
+createbrokendata.py): form feeds and other control characters, and
+bytes that are not UTF-8. Run it from this directory:
+
+  PYTHONPATH=../.. python benchmark_parse.py [records per page]
+"""
+import sys
+from lxml import etree
+from oaipmh import client
+from benchmark_records import createPage, measure
+
+def createDirtyPage(count):
+    page = createPage('ListRecords', count)
+    page = page.replace(b'Title', b'T\x0citle')
+    page = page.replace(b'A description', b'A d\xe9scription\x01')
+    return page
+
+def hackParse(xml):
+    """Parse like BaseClient.parse used to, for comparison.
+    """
+    xml = xml.decode('UTF-8', 'replace')
+    # also get rid of character code 12
+    xml = xml.replace(chr(12), '?')
+    xml = xml.encode('UTF-8')
+    return etree.XML(xml)
+
+def main(count=500):
+    myclient = client.ServerClient(None)
+    myclient.ignoreBadCharacters(True)
+    dirty = createDirtyPage(count)
+    # the old hack only dealt with form feeds
+    hack_dirty = dirty.replace(b'\x01', b'')
+    print('page size:              %8d bytes' % len(dirty))
+    print('decode/replace/encode:  %8.1f pages/sec' % measure(
+        lambda: hackParse(hack_dirty), 1))
+    print('recovering parser:      %8.1f pages/sec' % measure(
+        lambda: myclient.parse(dirty), 1))
+    clean = createPage('ListRecords', count)
+    print('clean page, strict:     %8.1f pages/sec' % measure(
+        lambda: etree.XML(clean), 1))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
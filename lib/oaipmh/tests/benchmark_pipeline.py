@@ -0,0 +1,59 @@
+"""Measure listRecords with and without a parse pool.
+
+A chain of pages is captured in a page archive and replayed, so only
+reading the pages from disk is left on the fetch side. Run it from this
+directory:
+
+  PYTHONPATH=../.. python benchmark_pipeline.py [pages] [processes]
+"""
+from concurrent.futures import ProcessPoolExecutor
+import shutil
+import sys
+import tempfile
+import time
+from oaipmh import archive, client, metadata
+from benchmark_records import createPage
+
+def createArchive(path, pages, count=500):
+    page_archive = archive.PageArchive(path, create=True)
+    page = createPage('ListRecords', count)
+    for i in range(pages):
+        kw = {'verb': 'ListRecords'}
+        if i == 0:
+            kw['metadataPrefix'] = 'oai_dc'
+        else:
+            kw['resumptionToken'] = 'token%s' % i
+        if i == pages - 1:
+            data = page.replace(b'>token<', b'><')
+        else:
+            data = page.replace(b'>token<', b'>token%d<' % (i + 1))
+        page_archive.add(kw, data)
+    return page_archive, pages * count
+
+def main(pages=40, processes=4):
+    registry = metadata.MetadataRegistry()
+    registry.registerReader('oai_dc', metadata.oai_dc_reader)
+    path = tempfile.mkdtemp()
+    try:
+        page_archive, count = createArchive(path, pages)
+        myclient = client.ReplayClient(page_archive, registry)
+        def harvest():
+            start = time.time()
+            records = list(myclient.listRecords(metadataPrefix='oai_dc'))
+            assert len(records) == count
+            return count / (time.time() - start)
+        print('in process:         %8.0f records/sec' % harvest())
+        pool = ProcessPoolExecutor(processes)
+        try:
+            myclient.setParsePool(pool)
+            # start the processes
+            harvest()
+            print('%-19s %8.0f records/sec' % ('%d processes:' % processes,
+                                            harvest()))
+        finally:
+            pool.shutdown()
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,119 @@
+"""Measure how fast pages of records and headers are built.
+
+Pages are parsed once up front, so only the work done on the parsed
+tree is measured. Run it from this directory:
+
+  PYTHONPATH=../.. python benchmark_records.py [records per page]
+"""
+import sys
+import time
+from oaipmh import client, metadata
+
+RECORD = '''<record>
+<header%(status)s>
+<identifier>oai:example.org:%(i)s</identifier>
+<datestamp>2004-%(month)02d-%(day)02dT12:%(minute)02d:00Z</datestamp>
+<setSpec>publication</setSpec>
+<setSpec>set%(set)s</setSpec>
+</header>
+<metadata>
+<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+           xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:title>Title %(i)s</dc:title>
+<dc:creator>Creator, A.</dc:creator>
+<dc:creator>Creator, B.</dc:creator>
+<dc:subject>Subject</dc:subject>
+<dc:description>A description of record %(i)s.</dc:description>
+<dc:publisher>Publisher</dc:publisher>
+<dc:date>2004-%(month)02d-%(day)02d</dc:date>
+<dc:type>info:eu-repo/semantics/article</dc:type>
+<dc:format>application/pdf</dc:format>
+<dc:identifier>http://example.org/%(i)s</dc:identifier>
+<dc:source>Journal %(set)s</dc:source>
+<dc:language>en</dc:language>
+<dc:rights>info:eu-repo/semantics/openAccess</dc:rights>
+<dc:isPartOf>Series</dc:isPartOf>
+</oai_dc:dc>
+</metadata>
+</record>'''
+
+PAGE = '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<responseDate>2004-12-31T12:00:00Z</responseDate>
+<request verb="%(verb)s">http://example.org/oai</request>
+<%(verb)s>
+%(items)s
+<resumptionToken>token</resumptionToken>
+</%(verb)s>
+</OAI-PMH>'''
+
+def createPage(verb, count):
+    items = []
+    for i in range(count):
+        values = {'i': i, 'month': i % 12 + 1, 'day': i % 28 + 1,
+                  'minute': i % 60, 'set': i % 5,
+                  'status': i % 10 == 0 and ' status="deleted"' or ''}
+        record = RECORD % values
+        if verb == 'ListIdentifiers':
+            record = record[record.index('<header'):
+                            record.index('</header>') + len('</header>')]
+        items.append(record)
+    return (PAGE % {'verb': verb, 'items': '\n'.join(items)}).encode('utf-8')
+
+def measure(build, count, seconds=2.0):
+    """Return the number of items built per second.
+    """
+    rounds = 0
+    start = time.time()
+    while 1:
+        build()
+        rounds += 1
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            return rounds * count / elapsed
+
+def main(count=500):
+    registry = metadata.MetadataRegistry()
+    registry.registerReader('oai_dc', metadata.oai_dc_reader)
+    myclient = client.ServerClient(None, registry)
+    namespaces = myclient.getNamespaces()
+
+    tree = myclient.parse(createPage('ListRecords', count))
+    def buildRecords():
+        records, token = myclient.buildRecords(
+            'oai_dc', namespaces, registry, tree)
+        assert len(records) == count and token == 'token'
+    print('buildRecords:     %8.0f records/sec' % measure(buildRecords, count))
+
+    reader = metadata.oai_dc_reader
+    xpath_reader = metadata.MetadataReader(
+        reader._fields, reader._namespaces, compiled=False)
+    metadata_nodes = tree.xpath('//oai:metadata', namespaces=namespaces)
+    for name, a_reader in [('compiled', reader), ('xpath', xpath_reader)]:
+        def readMetadata():
+            for node in metadata_nodes:
+                a_reader(node)
+        print('%-8s reader:  %8.0f records/sec' % (
+            name, measure(readMetadata, len(metadata_nodes))))
+    lazy_reader = reader.lazyReader()
+    def readType():
+        for node in metadata_nodes:
+            lazy_reader(node).getField('type')
+    print('lazy, one field: %8.0f records/sec' % (
+        measure(readType, len(metadata_nodes))))
+
+    tree = myclient.parse(createPage('ListIdentifiers', count))
+    def buildIdentifiers():
+        headers, token = myclient.buildIdentifiers(namespaces, tree)
+        assert len(headers) == count and token == 'token'
+    print('buildIdentifiers: %8.0f headers/sec' %
+          measure(buildIdentifiers, count))
+
+    page = createPage('ListIdentifiers', count)
+    def parseErrorHandling():
+        myclient.parseErrorHandling(page, {})
+    print('parse and check:  %8.0f pages/sec' % (
+        measure(parseErrorHandling, 1)))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,109 @@
+"""Measure writing records with the sinks, and loading what they wrote.
+
+For comparison the records are also written the way harvest.py used to:
+a csv.DictWriter row with list reprs and a few prints per record, with
+stdout sent to /dev/null. Loading a CSV file includes splitting the
+multi-valued cells. Run it from this directory:
+
+  PYTHONPATH=../.. python benchmark_sinks.py [records]
+"""
+import csv
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+from oaipmh import common, sinks
+from benchmark_records import measure
+
+FIELDS = ['identifier', 'date', 'source', 'rights', 'ispartof', 'creator',
+          'title']
+
+def createRecords(count):
+    records = []
+    for i in range(count):
+        map = {'identifier': [u'http://example.org/%s' % i,
+                              u'urn:nbn:nl:%s' % i],
+               'date': [u'2004-01-01'], 'source': [u'Journal %s' % (i % 5)],
+               'rights': [u'info:eu-repo/semantics/openAccess'],
+               'ispartof': [u'Series'],
+               'creator': [u'Creator, A.', u'Cr\xe9ator, B.'],
+               'title': [u'Title %s' % i]}
+        records.append((common.Header(None, 'oai:example.org:%s' % i,
+                                      datetime(2004, 1, 1, 12), ['a'], False),
+                        common.Metadata(None, map), None))
+    return records
+
+def writeDictWriter(path, records):
+    out = open(os.devnull, 'w')
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS, delimiter=' ',
+                                    quotechar='"')
+            writer.writeheader()
+            for num, record in enumerate(records):
+                print('%0.6d %s' % (num, record[0].identifier()))
+                fields = record[1].getMap()
+                print(fields['identifier'])
+                print(" by ")
+                print(fields['creator'])
+                print(" is part of")
+                print(fields['ispartof'])
+                writer.writerow(dict([(name, fields[name])
+                                      for name in FIELDS]))
+    finally:
+        sys.stdout = stdout
+        out.close()
+
+def writeSink(path, records):
+    with sinks.openSink(path, FIELDS) as sink:
+        for record in records:
+            sink.write(record)
+    return sink
+
+def loadCSV(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        rows = csv.reader(f)
+        next(rows)
+        return [row[:2] + [sinks.splitValues(cell) for cell in row[4:]]
+                for row in rows]
+
+def loadParquet(path):
+    import pyarrow.parquet
+    return pyarrow.parquet.read_table(path)
+
+def main(count=20000):
+    records = createRecords(count)
+    tmpdir = tempfile.mkdtemp()
+    extensions = ['.csv', '.tsv', '.jsonl', '.jsonl.gz', '.sqlite']
+    if sinks.zstandard is not None:
+        extensions.append('.jsonl.zst')
+    if sinks.pyarrow is not None:
+        extensions.extend(['.parquet', '.arrow'])
+    try:
+        path = os.path.join(tmpdir, 'records.csv')
+        print('DictWriter and print: %8.0f records/sec' % measure(
+            lambda: writeDictWriter(path, records), count))
+        for extension in extensions:
+            path = os.path.join(tmpdir, 'records' + extension)
+            def write():
+                sink = writeSink(path, records)
+                # only keep the shards of the last run
+                for shard in getattr(sink, 'shards', []):
+                    os.rename(shard, path)
+            print('%-20s %8.0f records/sec, %8d bytes' % (
+                extension[1:] + ' sink:', measure(write, count),
+                os.path.getsize(path)))
+        print('load csv:            %8.0f records/sec' % measure(
+            lambda: loadCSV(os.path.join(tmpdir, 'records.csv')), count))
+        if sinks.pyarrow is not None:
+            print('load parquet:        %8.0f records/sec' % measure(
+                lambda: loadParquet(os.path.join(tmpdir, 'records.parquet')),
+                count))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
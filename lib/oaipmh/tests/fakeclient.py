@@ -1,22 +1,12 @@
-from oaipmh import client, common
+from oaipmh import archive, client, common
 import os.path
 from datetime import datetime
-try:
-    from urllib.parse import urlencode
-except ImportError:
-    from urllib import urlencode
 
 
-class FakeClient(client.BaseClient):
-    def __init__(self, mapping_path):
-        client.BaseClient.__init__(self)
-        self._mapping = createMapping(mapping_path)
-        
-    def makeRequest(self, **kw):
-        # this is a complete fake, and can only deal with a number of
-        # fixed requests that are mapped to files
-        # sort it to get stable behavior
-        return self._mapping[getRequestKey(kw)]
+class FakeClient(client.ReplayClient):
+    # this is a complete fake, and can only deal with a number of
+    # fixed requests that are mapped to files
+    pass
 
 class TestError(Exception):
     def __init__(self, kw):
@@ -42,25 +32,7 @@ class GranularityFakeClient(client.BaseClient):
 def getRequestKey(kw):
     """Create stable key for request dictionary to use in file.
     """
-    items = list(kw.items())
-    items.sort()
-    return urlencode(items)
-
-def createMapping(mapping_path):
-    f = open(os.path.join(mapping_path, 'mapping.txt'), 'r')
-    result = {}
-    while 1:
-        request = f.readline()
-        response = f.readline()
-        request = request.strip()
-        response = response.strip()
-        if not request or not response:
-            break
-        xml_f = open(os.path.join(mapping_path, response), 'r')
-        text = xml_f.read()
-        xml_f.close()
-        result[request] = text
-    return result
+    return archive.pageKey(kw)
 
 class FakeCreaterClient(client.Client):
     def __init__(self, base_url, mapping_path, metadata_registry):
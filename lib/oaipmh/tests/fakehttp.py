@@ -0,0 +1,175 @@
+import asyncio
+import gzip
+import threading
+import zlib
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+from oaipmh import server, metadata
+import fakeserver
+
+class FakeHTTPServer(ThreadingMixIn, HTTPServer):
+    """Serve an in-process OAI-PMH server over HTTP/1.1 on localhost.
+    """
+    daemon_threads = True
+
+    def __init__(self, oai_server):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeRequestHandler)
+        self.oai_server = oai_server
+        self.connections = 0
+        self.requests = []
+        # list of (status, headers) to answer the next requests with
+        # instead of the OAI-PMH response
+        self.failures = []
+        # content codings the server is willing to apply
+        self.compression = []
+        self.encodings = []
+        self._thread = None
+
+    def url(self):
+        return 'http://127.0.0.1:%s/oai' % self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_oai(urlsplit(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.handle_oai(self.rfile.read(length).decode('utf-8'))
+
+    def handle_oai(self, query):
+        kw = dict([(key, value[0]) for key, value in
+                   parse_qs(query, True).items()])
+        self.server.requests.append((kw, self.headers))
+        if self.server.failures:
+            status, headers = self.server.failures.pop(0)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.oai_server.handleRequest(kw)
+        accepted = [value.strip() for value in
+                    self.headers.get('Accept-Encoding', '').split(',')]
+        encoding = 'identity'
+        for candidate in self.server.compression:
+            if candidate in accepted:
+                encoding = candidate
+                break
+        if encoding == 'gzip':
+            body = gzip.compress(body)
+        elif encoding == 'deflate':
+            body = zlib.compress(body)
+        self.server.encodings.append(encoding)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeAsyncHTTPServer(object):
+    """Serve an in-process OAI-PMH server over HTTP/1.1 using asyncio.
+
+    Responses are sent with chunked transfer encoding.
+    """
+    def __init__(self, oai_server):
+        self.oai_server = oai_server
+        self.connections = 0
+        self.requests = []
+        self.failures = []
+        # seconds to wait before answering the next requests
+        self.delays = []
+        self._server = None
+
+    def url(self):
+        return 'http://127.0.0.1:%s/oai' % (
+            self._server.sockets[0].getsockname()[1])
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self.handle, '127.0.0.1', 0)
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while 1:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode(
+                    'latin-1').split()
+                headers = {}
+                while 1:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if method == 'POST':
+                    query = (await reader.readexactly(length)).decode('utf-8')
+                else:
+                    query = urlsplit(path).query
+                kw = dict([(key, value[0]) for key, value in
+                           parse_qs(query, True).items()])
+                self.requests.append(kw)
+                if self.delays:
+                    await asyncio.sleep(self.delays.pop(0))
+                if self.failures:
+                    status, extra_headers = self.failures.pop(0)
+                    body = b''
+                else:
+                    status, extra_headers = 200, {}
+                    body = self.oai_server.handleRequest(kw)
+                lines = ['HTTP/1.1 %s Whatever' % status,
+                         'Content-Type: text/xml; charset=utf-8',
+                         'Transfer-Encoding: chunked']
+                for name, value in extra_headers.items():
+                    lines.append('%s: %s' % (name, value))
+                writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+                for i in range(0, len(body), 4096):
+                    chunk = body[i:i + 4096]
+                    writer.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+                writer.write(b'0\r\n\r\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+def createOAIServer(fake_server=None, batch_size=7):
+    metadata_registry = metadata.MetadataRegistry()
+    metadata_registry.registerWriter('oai_dc', server.oai_dc_writer)
+    metadata_registry.registerReader('oai_dc', metadata.oai_dc_reader)
+    return server.Server(fake_server or fakeserver.FakeServer(),
+                         metadata_registry,
+                         resumption_batch_size=batch_size)
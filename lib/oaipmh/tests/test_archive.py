@@ -0,0 +1,298 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase, TestSuite, main, makeSuite
+from oaipmh import archive, client, metadata, server
+from fakehttp import FakeHTTPServer, createOAIServer
+import fakeserver
+
+class CapturingClient(client.ServerClient):
+    """Add every page that is served to a page archive.
+    """
+    def __init__(self, server, page_archive, metadata_registry=None):
+        client.ServerClient.__init__(self, server, metadata_registry)
+        self._archive = page_archive
+
+    def makeRequest(self, **kw):
+        xml = client.ServerClient.makeRequest(self, **kw)
+        self._archive.add(kw, xml)
+        return xml
+
+class PageArchiveTestCase(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'pages')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_add(self):
+        pages = archive.PageArchive(self._path, create=True)
+        pages.add({'verb': 'Identify'}, b'<a/>')
+        pages.add({'verb': 'ListSets', 'resumptionToken': 'x'}, u'<b>\xe4</b>')
+        pages.add({'verb': 'Identify'}, b'<c/>')
+        pages.add({'verb': 'ListSets'}, b'')
+        pages = archive.PageArchive(self._path)
+        self.assertEquals(3, len(pages))
+        self.assertEquals(['resumptionToken=x&verb=ListSets',
+                           'verb=Identify', 'verb=ListSets'], pages.keys())
+        self.assertEquals(b'<c/>', pages.read({'verb': 'Identify'}))
+        self.assertEquals(u'<b>\xe4</b>'.encode('utf-8'), pages.read(
+            {'resumptionToken': 'x', 'verb': 'ListSets'}))
+        self.assertEquals(b'', pages.read({'verb': 'ListSets'}))
+        self.assert_({'verb': 'Identify'} in pages)
+        self.assertRaises(archive.Error, pages.read, {'verb': 'ListRecords'})
+        self.assertEquals(['00000.xml', '00001.xml', '00002.xml',
+                           'mapping.txt'], sorted(os.listdir(self._path)))
+
+    def test_chunks(self):
+        pages = archive.PageArchive(self._path, create=True)
+        data = b''.join([b'%d' % i for i in range(1000)])
+        pages.add({'verb': 'Identify'}, data)
+        chunks = list(pages.chunks({'verb': 'Identify'}, size=100))
+        self.assertEquals(29, len(chunks))
+        self.assertEquals(data, b''.join(chunks))
+
+    def test_cut_off_index(self):
+        pages = archive.PageArchive(self._path, create=True)
+        pages.add({'verb': 'Identify'}, b'<a/>')
+        f = open(os.path.join(self._path, 'mapping.txt'), 'a')
+        f.write('verb=ListSets\n0000')
+        f.close()
+        pages = archive.PageArchive(self._path)
+        self.assertEquals(['verb=Identify'], pages.keys())
+
+    def test_no_archive(self):
+        self.assertRaises(archive.Error, archive.PageArchive, self._path)
+
+class LaterDatetime(datetime):
+    @classmethod
+    def utcnow(cls):
+        return datetime(2030, 1, 1)
+
+class BlobArchiveTestCase(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'blobs')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def blobs(self):
+        return sorted([name for dirpath, dirnames, names
+                       in os.walk(os.path.join(self._path, 'blobs'))
+                       for name in names])
+
+    def test_add(self):
+        pages = archive.BlobArchive(self._path, create=True)
+        pages.add({'verb': 'Identify'}, b'<a/>')
+        pages.add({'verb': 'ListSets', 'resumptionToken': 'x'}, u'<b>\xe4</b>')
+        pages.add({'verb': 'Identify'}, b'<c/>')
+        pages.add({'verb': 'ListSets'}, b'')
+        pages = archive.openArchive(self._path)
+        self.assert_(isinstance(pages, archive.BlobArchive))
+        self.assertEquals(3, len(pages))
+        self.assertEquals(['resumptionToken=x&verb=ListSets',
+                           'verb=Identify', 'verb=ListSets'], pages.keys())
+        self.assertEquals(b'<c/>', pages.read({'verb': 'Identify'}))
+        self.assertEquals(u'<b>\xe4</b>'.encode('utf-8'), pages.read(
+            {'resumptionToken': 'x', 'verb': 'ListSets'}))
+        self.assertEquals(b'', pages.read({'verb': 'ListSets'}))
+        self.assertRaises(archive.Error, pages.read, {'verb': 'ListRecords'})
+        # the blob of the first capture of Identify is kept
+        self.assertEquals(4, len(self.blobs()))
+
+    def test_duplicates(self):
+        pages = archive.BlobArchive(self._path, create=True)
+        data = b'<page>%s</page>' % (b'x' * 10000)
+        pages.add({'verb': 'ListSets'}, data)
+        pages.add({'verb': 'ListSets'}, data)
+        pages.add({'verb': 'ListSets', 'resumptionToken': 'x'}, data)
+        self.assertEquals(2, pages.duplicates)
+        self.assertEquals(1, len(self.blobs()))
+        # the same page is indexed once for a request
+        f = open(os.path.join(self._path, 'index.txt'))
+        self.assertEquals(2, len(f.readlines()))
+        f.close()
+        # and compressed
+        blob = pages.path({'verb': 'ListSets'})
+        self.assert_(os.path.getsize(blob) < 200)
+        self.assertEquals(data, b''.join(
+            pages.chunks({'verb': 'ListSets'}, size=1000)))
+
+    def test_response_date(self):
+        oai_server = server.Server(fakeserver.FakeServer(),
+                                   metadata.MetadataRegistry())
+        kw = {'verb': 'Identify'}
+        first = oai_server.handleRequest(kw)
+        server.datetime = LaterDatetime
+        try:
+            second = oai_server.handleRequest(kw)
+        finally:
+            server.datetime = datetime
+        self.assertNotEquals(first, second)
+        pages = archive.BlobArchive(self._path, create=True)
+        pages.add(kw, first)
+        pages.add(kw, second)
+        self.assertEquals(1, pages.duplicates)
+        self.assertEquals(1, len(self.blobs()))
+        self.assertEquals(first, pages.read(kw))
+        # the same digest when the page comes in chunks
+        digest = archive.PageDigest()
+        for i in range(0, len(second), 10):
+            digest.update(second[i:i + 10])
+        self.assertEquals(os.path.basename(pages.path(kw)),
+                          digest.hexdigest() + '.gz')
+
+    def test_requests(self):
+        pages = archive.BlobArchive(self._path, create=True)
+        for kw in [{'verb': 'ListRecords', 'metadataPrefix': 'oai_dc',
+                    'set': 'b'},
+                   {'verb': 'ListRecords', 'resumptionToken': 'b1'},
+                   {'verb': 'Identify'},
+                   {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc',
+                    'from': '2020-01-01T00:00:00Z'}]:
+            pages.add(kw, b'<a/>')
+        expected = [{'metadataPrefix': 'oai_dc', 'set': 'b'},
+                    {'metadataPrefix': 'oai_dc',
+                     'from': '2020-01-01T00:00:00Z'}]
+        self.assertEquals(expected, pages.requests())
+        self.assertEquals(expected, archive.BlobArchive(
+            self._path).requests())
+
+    def test_no_archive(self):
+        self.assertRaises(archive.Error, archive.BlobArchive, self._path)
+
+class ReplayTestCase(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._registry = metadata.MetadataRegistry()
+        self._registry.registerWriter('oai_dc', server.oai_dc_writer)
+        self._registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._server = server.Server(fakeserver.FakeServer(), self._registry,
+                                     resumption_batch_size=7)
+        self._archive = archive.PageArchive(self._dir)
+        capturing = CapturingClient(self._server, self._archive,
+                                    self._registry)
+        self._records = list(capturing.listRecords(metadataPrefix='oai_dc'))
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def assertReplayed(self, records):
+        self.assertEquals(
+            [(header.identifier(), metadata.getMap())
+             for header, metadata, about in self._records],
+            [(header.identifier(), metadata.getMap())
+             for header, metadata, about in records])
+
+    def test_replay(self):
+        # every page of the resumption chain was captured
+        self.assertEquals(15, len(self._archive))
+        replay = client.ReplayClient(self._dir, self._registry)
+        self.assertReplayed(replay.listRecords(metadataPrefix='oai_dc'))
+
+    def test_streaming(self):
+        replay = client.ReplayClient(self._archive, self._registry)
+        replay.setStreaming(True)
+        self.assertReplayed(replay.listRecords(metadataPrefix='oai_dc'))
+
+    def test_not_captured(self):
+        replay = client.ReplayClient(self._archive, self._registry)
+        self.assertRaises(archive.Error, replay.listRecords,
+                          metadataPrefix='oai_dc', set='hello')
+
+    def test_archived_records(self):
+        # the lists are replayed in the order they were captured in
+        self._records.extend(
+            CapturingClient(self._server, self._archive, self._registry
+                            ).listRecords(metadataPrefix='oai_dc',
+                                          set='hello'))
+        replay = client.ReplayClient(self._archive, self._registry)
+        self.assertReplayed(replay.listArchivedRecords())
+        replay.setStreaming(True)
+        self.assertReplayed(replay.listArchivedRecords())
+
+class TeeTests(object):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._archive = self.createArchive()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_complete(self):
+        chunks = self._archive.tee({'verb': 'Identify'},
+                                   iter([b'<a>', b'</a>']))
+        self.assertEquals(b'<a>', next(chunks))
+        # the page goes to a file as it is generated
+        self.assertEquals(1, len([name for name in os.listdir(self._dir)
+                                  if name.startswith('.tmp-')]))
+        self.assertEquals([b'</a>'], list(chunks))
+        self.assertEquals(b'<a></a>', self._archive.read({'verb': 'Identify'}))
+        self.assertEquals(1, len(self._archive))
+
+    def test_incomplete(self):
+        chunks = self._archive.tee({'verb': 'Identify'},
+                                   iter([b'<a>', b'</a>']))
+        next(chunks)
+        chunks.close()
+        self.assertEquals(0, len(self._archive))
+        self.assertEquals([], [name for name in os.listdir(self._dir)
+                               if name.startswith('.tmp-')])
+
+class PageArchiveTeeTestCase(TeeTests, TestCase):
+    def createArchive(self):
+        return archive.PageArchive(self._dir)
+
+class BlobArchiveTeeTestCase(TeeTests, TestCase):
+    def createArchive(self):
+        return archive.BlobArchive(self._dir)
+
+    def test_duplicate(self):
+        self._archive.add({'verb': 'Identify'}, b'<a></a>')
+        list(self._archive.tee({'verb': 'Identify', 'x': 'y'},
+                               iter([b'<a>', b'</a>'])))
+        self.assertEquals(1, self._archive.duplicates)
+        self.assertEquals(b'<a></a>', self._archive.read(
+            {'verb': 'Identify', 'x': 'y'}))
+        self.assertEquals(['blobs', 'index.txt'], sorted(os.listdir(self._dir)))
+
+class CaptureTestCase(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._httpserver = FakeHTTPServer(createOAIServer())
+        self._httpserver.start()
+        self._registry = metadata.MetadataRegistry()
+        self._registry.registerReader('oai_dc', metadata.oai_dc_reader)
+
+    def tearDown(self):
+        self._httpserver.stop()
+        shutil.rmtree(self._dir)
+
+    def harvest(self, myclient):
+        return [(header.identifier(), metadata.getMap())
+                for header, metadata, about
+                in myclient.listRecords(metadataPrefix='oai_dc')]
+
+    def test_streaming(self):
+        myclient = client.Client(self._httpserver.url(), self._registry)
+        myclient.setArchive(archive.BlobArchive(self._dir))
+        myclient.setStreaming(True)
+        records = self.harvest(myclient)
+        self.assertEquals(100, len(records))
+        replay = client.ReplayClient(self._dir, self._registry)
+        self.assertEquals(15, len(archive.BlobArchive(self._dir)))
+        self.assertEquals(records, self.harvest(replay))
+
+def test_suite():
+    return TestSuite((makeSuite(PageArchiveTestCase),
+                      makeSuite(BlobArchiveTestCase),
+                      makeSuite(ReplayTestCase),
+                      makeSuite(PageArchiveTeeTestCase),
+                      makeSuite(BlobArchiveTeeTestCase),
+                      makeSuite(CaptureTestCase)))
+
+if __name__=='__main__':
+    main(defaultTest='test_suite')
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from datetime import datetime
+from unittest import TestCase, TestSuite, main, makeSuite
+from fakehttp import FakeAsyncHTTPServer, createOAIServer
+from oaipmh import client, error, metadata
+from oaipmh.asyncclient import AsyncClient
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+def createRegistry():
+    registry = metadata.MetadataRegistry()
+    registry.registerReader('oai_dc', metadata.oai_dc_reader)
+    return registry
+
+class AsyncClientTestCase(TestCase):
+
+    def harvest(self, test, *servers):
+        async def wrapper():
+            fakeservers = []
+            for oai_server in servers:
+                fakeserver = FakeAsyncHTTPServer(oai_server)
+                await fakeserver.start()
+                fakeservers.append(fakeserver)
+            try:
+                return await test(*fakeservers)
+            finally:
+                for fakeserver in fakeservers:
+                    await fakeserver.stop()
+        return run(wrapper())
+
+    def test_identify(self):
+        async def test(fakeserver):
+            async with AsyncClient(fakeserver.url()) as client:
+                identify = await client.identify()
+                await client.updateGranularity()
+            return identify
+        identify = self.harvest(test, createOAIServer())
+        self.assertEquals('Fake', identify.repositoryName())
+        self.assertEquals('YYYY-MM-DDThh:mm:ssZ', identify.granularity())
+
+    def test_listRecords(self):
+        async def test(fakeserver):
+            async with AsyncClient(fakeserver.url(),
+                                   createRegistry()) as client:
+                records = []
+                async for record in client.listRecords(
+                        metadataPrefix='oai_dc'):
+                    records.append(record)
+            return records, fakeserver
+        records, fakeserver = self.harvest(test, createOAIServer())
+        self.assertEquals(['Title %s' % i for i in range(100)],
+                          [metadata.getField('title')[0]
+                           for header, metadata, about in records])
+        self.assertEquals(15, len(fakeserver.requests))
+        self.assertEquals(1, fakeserver.connections)
+
+    def test_listIdentifiers_get(self):
+        async def test(fakeserver):
+            async with AsyncClient(fakeserver.url(),
+                                   force_http_get=True) as client:
+                return [header.identifier() async for header in
+                        client.listIdentifiers(metadataPrefix='oai_dc',
+                                               from_=datetime(2004, 1, 1),
+                                               until=datetime(2004, 7, 1))]
+        identifiers = self.harvest(test, createOAIServer())
+        self.assertEquals(52, len(identifiers))
+
+    def test_error(self):
+        async def test(fakeserver):
+            async with AsyncClient(fakeserver.url()) as client:
+                async for header in client.listIdentifiers(
+                        metadataPrefix='oai_dc', from_=datetime(2003, 1, 1),
+                        until=datetime(2003, 7, 1)):
+                    pass
+        self.assertRaises(error.NoRecordsMatchError,
+                          self.harvest, test, createOAIServer())
+
+    def test_concurrent_retry_after(self):
+        finished = []
+        async def harvest(fakeserver, name):
+            async with AsyncClient(fakeserver.url()) as client:
+                headers = [header async for header in
+                           client.listIdentifiers(metadataPrefix='oai_dc')]
+            finished.append((name, time.time()))
+            return headers
+        async def test(slow, fast):
+            slow.failures.append((503, {'Retry-After': '1'}))
+            return await asyncio.gather(harvest(slow, 'slow'),
+                                        harvest(fast, 'fast'))
+        start = time.time()
+        slow_headers, fast_headers = self.harvest(
+            test, createOAIServer(), createOAIServer())
+        self.assertEquals(100, len(slow_headers))
+        self.assertEquals(100, len(fast_headers))
+        # the fast harvest is not held up by the slow one waiting
+        self.assertEquals(['fast', 'slow'], [name for name, t in finished])
+        self.assert_(finished[0][1] - start < 1)
+        self.assert_(finished[1][1] - start >= 1)
+
+    def test_timeout(self):
+        async def test(fakeserver):
+            # the answer to the first request arrives after it timed out
+            fakeserver.delays.append(0.5)
+            policy = client.RetryPolicy(timeout=0.2, backoff_base=0,
+                                        jitter=False)
+            async with AsyncClient(fakeserver.url(),
+                                   retry_policy=policy) as myclient:
+                identifiers = [header.identifier() async for header in
+                               myclient.listIdentifiers(
+                                   metadataPrefix='oai_dc')]
+            await asyncio.sleep(0.5)
+            return identifiers, fakeserver, policy
+        identifiers, fakeserver, policy = self.harvest(
+            test, createOAIServer())
+        # the late answer is not taken for the answer to the retry
+        self.assertEquals([str(i) for i in range(100)], identifiers)
+        self.assertEquals(1, policy.retries)
+        self.assertEquals(16, len(fakeserver.requests))
+        self.assertEquals(2, fakeserver.connections)
+
+def test_suite():
+    return TestSuite((makeSuite(AsyncClientTestCase), ))
+
+if __name__=='__main__':
+    main(defaultTest='test_suite')
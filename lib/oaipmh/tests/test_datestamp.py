@@ -1,7 +1,8 @@
 from datetime import datetime
 from unittest import TestCase, TestSuite, makeSuite
+from oaipmh import datestamp
 from oaipmh.datestamp import datestamp_to_datetime,\
-     tolerant_datestamp_to_datetime
+     tolerant_datestamp_to_datetime, datetime_to_datestamp
 from oaipmh.error import DatestampError
 
 class DatestampTestCase(TestCase):
@@ -45,6 +46,43 @@ class DatestampTestCase(TestCase):
                           datestamp_to_datetime('2009-11-16',
                                                 inclusive=True))
         
+    def test_fast_path(self):
+        # the fast path and the general parser agree
+        for value in ['2005-07-04T14:35:10Z', '0999-01-02T00:00:00Z',
+                      '2005-07-04', '2005-07-04T14:35: 1Z']:
+            for inclusive in [False, True]:
+                self.assertEquals(
+                    datestamp._datestamp_to_datetime(value, inclusive),
+                    datestamp_to_datetime(value, inclusive))
+        for value in ['2005-07-04T14:35:1xZ', '2005-13-04T14:35:10Z',
+                      '2005-07-04X14:35:10Z', 'aaaa-bb-cc', '2005-02-30']:
+            self.assertRaises(DatestampError, datestamp_to_datetime, value)
+
+    def test_cache(self):
+        self.assert_(datestamp_to_datetime('2005-07-04T14:35:10Z') is
+                     datestamp_to_datetime('2005-07-04T14:35:10Z'))
+        self.assertEquals(datetime(2005, 7, 4),
+                          datestamp_to_datetime('2005-07-04'))
+        self.assertEquals(datetime(2005, 7, 4, 23, 59, 59),
+                          datestamp_to_datetime('2005-07-04', True))
+        info = datestamp._cached_datestamp_to_datetime.cache_info()
+        self.assertEquals(datestamp.CACHE_SIZE, info.maxsize)
+
+    def test_datetime_to_datestamp(self):
+        self.assertEquals('2005-07-04T14:35:10Z', datetime_to_datestamp(
+            datetime(2005, 7, 4, 14, 35, 10, 123)))
+        self.assertEquals('2005-07-04', datetime_to_datestamp(
+            datetime(2005, 7, 4, 14, 35, 10), day_granularity=True))
+        self.assertEquals('0999-01-02T00:00:00Z', datetime_to_datestamp(
+            datetime(999, 1, 2)))
+        for dt in [datetime(2005, 7, 4, 14, 35, 10, 123), datetime(999, 1, 2)]:
+            for day_granularity in [False, True]:
+                result = dt.replace(microsecond=0).isoformat() + 'Z'
+                if day_granularity:
+                    result = result[:-10]
+                self.assertEquals(result,
+                                  datetime_to_datestamp(dt, day_granularity))
+
     def test_tolerant_datestamp_to_datetime(self):
         f = tolerant_datestamp_to_datetime
         self.assertEquals(
@@ -0,0 +1,290 @@
+from unittest import TestCase, TestSuite, main, makeSuite
+from lxml import etree
+from oaipmh import client, common, metadata, server, validation
+import os
+import pickle
+import shutil
+import tempfile
+from oaipmh import state
+import fakeserver
+
+XML = b'''<metadata xmlns="http://www.openarchives.org/OAI/2.0/">
+<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+           xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:title>A <i>mixed</i> title<!-- comment -->end</dc:title>
+<dc:creator>Creator, A.</dc:creator>
+<dc:creator/>
+<dc:creator xml:lang="nl">Creator, B.</dc:creator>
+<dc:identifier type="doi">10.1000/1</dc:identifier>
+<dc:date>2004-01-01</dc:date>
+<!-- comment -->
+<dc:subject>One</dc:subject>
+</oai_dc:dc>
+<oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+           xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:subject>Two</dc:subject>
+</oai_dc:dc>
+<extra>Extra</extra>
+</metadata>'''
+
+NAMESPACES = {
+    'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'oai': 'http://www.openarchives.org/OAI/2.0/'}
+
+FIELDS = {
+    'title': ('textList', 'oai_dc:dc/dc:title/text()'),
+    'creator': ('textList', 'oai_dc:dc/dc:creator/text()'),
+    'subject': ('textList', 'oai_dc:dc/dc:subject/text()'),
+    'rights': ('textList', 'oai_dc:dc/dc:rights/text()'),
+    'date': ('bytesList', 'oai_dc:dc/dc:date/text()'),
+    'first_creator': ('text', 'string(oai_dc:dc/dc:creator/text())'),
+    'first_subject': ('bytes', 'string(oai_dc:dc/dc:subject/text())'),
+    'no_rights': ('text', 'string(oai_dc:dc/dc:rights/text())'),
+    'extra': ('textList', 'oai:extra/text()'),
+    # these don't fit the walk
+    'doi': ('textList', "oai_dc:dc/dc:identifier[@type='doi']/text()"),
+    'lang': ('text', 'string(oai_dc:dc/dc:creator/@xml:lang)'),
+    'count': ('text', 'count(oai_dc:dc/dc:creator)'),
+    }
+
+class MetadataReaderTestCase(TestCase):
+    def setUp(self):
+        self._element = etree.XML(XML)
+
+    def test_compiled(self):
+        compiled = metadata.MetadataReader(FIELDS, NAMESPACES)
+        xpath = metadata.MetadataReader(FIELDS, NAMESPACES, compiled=False)
+        self.assertEquals(xpath(self._element).getMap(),
+                          compiled(self._element).getMap())
+        self.assertEquals(
+            ['count', 'doi', 'lang'],
+            sorted([field_name for field_name, field_type, expr
+                    in compiled._xpath_fields]))
+
+    def test_values(self):
+        map = metadata.MetadataReader(FIELDS, NAMESPACES)(
+            self._element).getMap()
+        self.assertEquals(['A ', ' title', 'end'], map['title'])
+        self.assertEquals(['Creator, A.', 'Creator, B.'], map['creator'])
+        self.assertEquals(['One', 'Two'], map['subject'])
+        self.assertEquals([], map['rights'])
+        self.assertEquals('Creator, A.', map['first_creator'])
+        self.assertEquals('One', map['first_subject'])
+        self.assertEquals('', map['no_rights'])
+        self.assertEquals(['Extra'], map['extra'])
+        self.assertEquals(['10.1000/1'], map['doi'])
+        self.assertEquals('nl', map['lang'])
+
+    def test_oai_dc(self):
+        compiled = metadata.oai_dc_reader
+        self.assertEquals([], compiled._xpath_fields)
+        xpath = metadata.MetadataReader(compiled._fields,
+                                        compiled._namespaces, compiled=False)
+        self.assertEquals(xpath(self._element).getMap(),
+                          compiled(self._element).getMap())
+
+    def test_lazy(self):
+        eager = metadata.MetadataReader(FIELDS, NAMESPACES)
+        reader = eager.lazyReader()
+        result = reader(self._element)
+        self.assert_(isinstance(result, common.LazyMetadata))
+        self.assertEquals('nl', result.getField('lang'))
+        self.assertEquals(['One', 'Two'], result['subject'])
+        self.assertEquals(['lang', 'subject'], sorted(result._map.keys()))
+        self.assertRaises(KeyError, result.getField, 'isbn')
+        self.assertEquals(eager(self._element).getMap(), result.getMap())
+        # projected lazy readers stay lazy
+        result = reader(self._element, ['title', 'doi'])
+        self.assert_(isinstance(result, common.LazyMetadata))
+        self.assertEquals(['doi', 'title'], sorted(result.getMap().keys()))
+
+    def test_pickle(self):
+        reader = metadata.MetadataReader(FIELDS, NAMESPACES).lazyReader()
+        copied = pickle.loads(pickle.dumps(reader))
+        self.assert_(isinstance(copied(self._element), common.LazyMetadata))
+        self.assertEquals(reader(self._element).getMap(),
+                          copied(self._element).getMap())
+
+    def test_unknown_field_type(self):
+        self.assertRaises(metadata.Error, metadata.MetadataReader,
+                          {'title': ('number', 'dc:title/text()')})
+
+    def test_project(self):
+        reader = metadata.MetadataReader(FIELDS, NAMESPACES)
+        result = reader(self._element, ['title', 'doi', 'no_rights'])
+        self.assertEquals({'title': ['A ', ' title', 'end'],
+                           'doi': ['10.1000/1'], 'no_rights': ''},
+                          result.getMap())
+        self.assert_(reader.project(['doi', 'title', 'no_rights']) is
+                     reader.project(['title', 'doi', 'no_rights']))
+        self.assertRaises(metadata.Error, reader, self._element,
+                          ['title', 'isbn'])
+
+class ProjectionTestCase(TestCase):
+    def setUp(self):
+        self._registry = metadata.MetadataRegistry()
+        self._registry.registerWriter('oai_dc', server.oai_dc_writer)
+        self._registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._client = client.ServerClient(
+            server.Server(fakeserver.FakeServer(), self._registry,
+                          resumption_batch_size=7),
+            self._registry)
+
+    def test_listRecords(self):
+        records = list(self._client.listRecords(metadataPrefix='oai_dc',
+                                                fields=['title', 'date']))
+        self.assertEquals(100, len(records))
+        for header, metadata, about in records:
+            self.assertEquals(['date', 'title'],
+                              sorted(metadata.getMap().keys()))
+        self.assertEquals(['Title 0'], records[0][1].getField('title'))
+
+    def test_streaming(self):
+        self._client.setStreaming(True)
+        records = list(self._client.listRecords(metadataPrefix='oai_dc',
+                                                fields=['title']))
+        self.assertEquals({'title': ['Title 99']}, records[-1][1].getMap())
+
+    def test_streaming_lazy(self):
+        self._registry.registerReader('oai_dc',
+                                      metadata.oai_dc_reader.lazyReader())
+        self._client.setStreaming(True)
+        records = list(self._client.listRecords(metadataPrefix='oai_dc'))
+        # the fields were read before the records were cleared
+        self.assertEquals(['Title %s' % i for i in range(100)],
+                          [metadata.getField('title')[0]
+                           for header, metadata, about in records])
+
+    def test_getRecord(self):
+        header, metadata, about = self._client.getRecord(
+            metadataPrefix='oai_dc', identifier='1', fields=['title'])
+        self.assertEquals({'title': ['Title 1']}, metadata.getMap())
+
+    def test_other_verbs(self):
+        self.assertRaises(validation.BadArgumentError,
+                          self._client.listIdentifiers,
+                          metadataPrefix='oai_dc', fields=['title'])
+
+class FilterTestCase(TestCase):
+    def setUp(self):
+        self._read = []
+        def reader(element):
+            self._read.append(element)
+            return metadata.oai_dc_reader(element)
+        self._registry = metadata.MetadataRegistry()
+        self._registry.registerWriter('oai_dc', server.oai_dc_writer)
+        self._registry.registerReader('oai_dc', reader)
+        self._client = client.ServerClient(
+            server.Server(fakeserver.FakeServer(), self._registry,
+                          resumption_batch_size=7),
+            self._registry)
+        # titles ending with a 7
+        self._filter = etree.XPath(
+            "substring(oai:metadata/oai_dc:dc/dc:title, "
+            "string-length(oai:metadata/oai_dc:dc/dc:title)) = '7'",
+            namespaces=NAMESPACES)
+
+    def test_listRecords(self):
+        records = self._client.listRecords(metadataPrefix='oai_dc',
+                                           filter=self._filter)
+        self.assertEquals(['7', '17', '27', '37', '47', '57', '67', '77',
+                           '87', '97'],
+                          [header.identifier()
+                           for header, metadata, about in records])
+        # the reader only ran for the records that were kept
+        self.assertEquals(10, len(self._read))
+
+    def test_streaming(self):
+        self._client.setStreaming(True)
+        records = self._client.listRecords(metadataPrefix='oai_dc',
+                                           filter=self._filter)
+        self.assertEquals(10, len(list(records)))
+        self.assertEquals(10, len(self._read))
+
+    def test_listIdentifiers(self):
+        def even(header_node):
+            return int(header_node[0].text) % 2 == 0
+        headers = self._client.listIdentifiers(metadataPrefix='oai_dc',
+                                               filter=even)
+        self.assertEquals([str(i) for i in range(0, 100, 2)],
+                          [header.identifier() for header in headers])
+
+    def test_incremental(self):
+        # records skipped by the filter still move the watermark
+        tmpdir = tempfile.mkdtemp()
+        try:
+            store = state.FileStore(os.path.join(tmpdir, 'state.json'))
+            records = self._client.listRecordsIncremental(
+                'oai_dc', store, filter=lambda record_node: False)
+            self.assertEquals([], list(records))
+            self.assertEquals(['2004-12-28T11:23:23Z'],
+                              list(store._data.values()))
+        finally:
+            shutil.rmtree(tmpdir)
+
+class DetachTestCase(TestCase):
+    def setUp(self):
+        self._registry = metadata.MetadataRegistry()
+        self._registry.registerWriter('oai_dc', server.oai_dc_writer)
+        self._registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._client = client.ServerClient(
+            server.Server(fakeserver.FakeServer(), self._registry,
+                          resumption_batch_size=7),
+            self._registry)
+
+    def test_attached(self):
+        header, metadata, about = next(
+            self._client.listRecords(metadataPrefix='oai_dc'))
+        self.assertEquals('OAI-PMH', etree.QName(
+            header.element().getroottree().getroot()).localname)
+
+    def test_drop(self):
+        self._client.setDetach(True)
+        records = list(self._client.listRecords(metadataPrefix='oai_dc'))
+        for header, metadata, about in records:
+            self.assertEquals(None, header.element())
+            self.assertEquals(None, metadata.element())
+        self.assertEquals(['Title 5'], records[5][1].getField('title'))
+        # detached records can be pickled
+        header, metadata, about = pickle.loads(pickle.dumps(records[5]))
+        self.assertEquals('5', header.identifier())
+        self.assertEquals(['Title 5'], metadata.getField('title'))
+        headers = self._client.listIdentifiers(metadataPrefix='oai_dc')
+        self.assertEquals([None] * 100,
+                          [header.element() for header in headers])
+
+    def test_drop_lazy(self):
+        self._registry.registerReader('oai_dc',
+                                      metadata.oai_dc_reader.lazyReader())
+        self._client.setDetach(True)
+        header, result, about = next(
+            self._client.listRecords(metadataPrefix='oai_dc'))
+        self.assertEquals(None, result.element())
+        self.assertEquals(['Title 0'], result.getField('title'))
+
+    def test_copy(self):
+        self._client.setDetach(True, copy=True)
+        header, metadata, about = next(
+            self._client.listRecords(metadataPrefix='oai_dc'))
+        root = header.element().getroottree().getroot()
+        self.assertEquals('record', etree.QName(root).localname)
+        self.assert_(metadata.element().getroottree().getroot() is root)
+        header = next(self._client.listIdentifiers(metadataPrefix='oai_dc'))
+        self.assertEquals('header', etree.QName(
+            header.element().getroottree().getroot()).localname)
+
+    def test_slots(self):
+        header = common.Header(None, '1', None, [], False)
+        self.assertRaises(AttributeError, setattr, header, 'extra', 1)
+        metadata = common.Metadata(None, {})
+        self.assertRaises(AttributeError, setattr, metadata, 'extra', 1)
+
+def test_suite():
+    return TestSuite((makeSuite(MetadataReaderTestCase),
+                      makeSuite(ProjectionTestCase),
+                      makeSuite(FilterTestCase),
+                      makeSuite(DetachTestCase)))
+
+if __name__=='__main__':
+    main(defaultTest='test_suite')
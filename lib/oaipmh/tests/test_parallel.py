@@ -0,0 +1,321 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import os
+import re
+import shutil
+import tempfile
+import time
+from unittest import TestCase, TestSuite, main, makeSuite
+from oaipmh import client, common, error, metadata, server, state
+import fakeserver
+
+class SetFakeServer(fakeserver.FakeServer):
+    def __init__(self):
+        self._data = []
+        for header, metadata, about in fakeserver.createFakeData():
+            i = int(header.identifier())
+            sets = [i % 2 and 'odd' or 'even']
+            if i % 3 == 0:
+                sets.append('three')
+            self._data.append(
+                (common.Header(None, header.identifier(),
+                               header.datestamp(), sets, False),
+                 metadata, about))
+
+    def listSets(self):
+        return [('even', 'Even', None), ('odd', 'Odd', None),
+                ('three', 'Three', None)]
+
+    def listRecords(self, metadataPrefix=None, from_=None, until=None,
+                    set=None):
+        result = fakeserver.FakeServer.listRecords(
+            self, metadataPrefix, from_, until)
+        if set is not None:
+            result = [record for record in result
+                      if set in record[0].setSpec()]
+        return result
+
+def evenFilter(record_node):
+    # a module level function can be sent to the parse pool
+    return int(record_node[0][0].text) % 2 == 0
+
+class BrokenServerClient(client.ServerClient):
+    def makeRequest(self, **kw):
+        xml = client.ServerClient.makeRequest(self, **kw)
+        if 'resumptionToken' in kw:
+            xml = xml.replace(b'</OAI-PMH>', b'')
+        return xml
+
+class CDATAServerClient(client.ServerClient):
+    def makeRequest(self, **kw):
+        xml = client.ServerClient.makeRequest(self, **kw)
+        # the token of the page can only be found by parsing it
+        return re.sub(br'(<resumptionToken[^>]*>)([^<]+)<',
+                      br'\1<![CDATA[\2]]><', xml)
+
+class DateWindowsTestCase(TestCase):
+
+    def test_seconds(self):
+        windows = client.dateWindows(datetime(2004, 1, 1),
+                                     datetime(2004, 1, 1, 0, 0, 9), 3)
+        self.assertEquals(
+            [(datetime(2004, 1, 1, 0, 0, 0), datetime(2004, 1, 1, 0, 0, 2)),
+             (datetime(2004, 1, 1, 0, 0, 3), datetime(2004, 1, 1, 0, 0, 5)),
+             (datetime(2004, 1, 1, 0, 0, 6), datetime(2004, 1, 1, 0, 0, 9))],
+            windows)
+
+    def test_days(self):
+        windows = client.dateWindows(datetime(2004, 1, 1, 12),
+                                     datetime(2004, 1, 4, 8), 2,
+                                     day_granularity=True)
+        self.assertEquals(
+            [(datetime(2004, 1, 1), datetime(2004, 1, 2)),
+             (datetime(2004, 1, 3), datetime(2004, 1, 4))],
+            windows)
+
+    def test_more_partitions_than_stamps(self):
+        windows = client.dateWindows(datetime(2004, 1, 1),
+                                     datetime(2004, 1, 2), 10,
+                                     day_granularity=True)
+        self.assertEquals(
+            [(datetime(2004, 1, 1), datetime(2004, 1, 1)),
+             (datetime(2004, 1, 2), datetime(2004, 1, 2))],
+            windows)
+
+class ConcurrentGeneratorTestCase(TestCase):
+
+    def test_all_items(self):
+        iterables = [range(i * 100, i * 100 + 100) for i in range(10)]
+        items = list(client.ConcurrentGenerator(iterables, 3, 5))
+        self.assertEquals(list(range(1000)), sorted(items))
+
+    def test_error(self):
+        def failing():
+            yield 1
+            raise ValueError("broken")
+        items = client.ConcurrentGenerator([range(10), failing()], 2)
+        self.assertRaises(ValueError, list, items)
+
+class CountingServerClient(client.ServerClient):
+    def __init__(self, server, metadata_registry=None):
+        client.ServerClient.__init__(self, server, metadata_registry)
+        self.requests = 0
+
+    def makeRequest(self, **kw):
+        self.requests += 1
+        return client.ServerClient.makeRequest(self, **kw)
+
+class PartitionedTestCase(TestCase):
+    def setUp(self):
+        metadata_registry = metadata.MetadataRegistry()
+        metadata_registry.registerWriter('oai_dc', server.oai_dc_writer)
+        metadata_registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._server = server.Server(fakeserver.FakeServer(),
+                                     metadata_registry,
+                                     resumption_batch_size=7)
+        self._registry = metadata_registry
+        self._client = client.ServerClient(self._server, metadata_registry)
+
+    def test_listRecordsPartitioned(self):
+        records = self._client.listRecordsPartitioned(
+            metadataPrefix='oai_dc', from_=datetime(2004, 1, 1),
+            until=datetime(2004, 12, 31), partitions=12, workers=3)
+        self.assertEquals(
+            sorted(['Title %s' % i for i in range(100)]),
+            sorted([metadata.getField('title')[0]
+                    for header, metadata, about in records]))
+
+    def test_default_range(self):
+        # empty windows don't stop the harvest
+        records = self._client.listRecordsPartitioned(
+            metadataPrefix='oai_dc', partitions=40)
+        self.assertEquals(
+            sorted([str(i) for i in range(100)]),
+            sorted([header.identifier()
+                    for header, metadata, about in records]))
+
+    def test_queue_size(self):
+        myclient = CountingServerClient(self._server, self._registry)
+        records = myclient.listRecordsPartitioned(
+            metadataPrefix='oai_dc', from_=datetime(2004, 1, 1),
+            until=datetime(2004, 12, 31), partitions=2, workers=2,
+            queue_size=7)
+        next(records)
+        time.sleep(0.5)
+        # the workers wait for the records to be processed
+        self.assert_(myclient.requests <= 6)
+        self.assertEquals(99, len(list(records)))
+
+    def test_no_checkpoints(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            store = state.FileStore(os.path.join(tmpdir, 'state.json'))
+            self._client.setCheckpointStore(store)
+            hooks = []
+            self._client.setBeforeCheckpoint(lambda: hooks.append(1))
+            records = self._client.listRecordsPartitioned(
+                metadataPrefix='oai_dc', from_=datetime(2004, 1, 1),
+                until=datetime(2004, 12, 31), partitions=2, workers=2)
+            next(records)
+            time.sleep(0.2)
+            self.assertEquals({}, store._data)
+            self.assertEquals(99, len(list(records)))
+            self.assertEquals([], hooks)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_unique(self):
+        records = list(self._client.listRecords(metadataPrefix='oai_dc'))
+        # every window returns the same records
+        self._client.listRecords = lambda **kw: iter(records)
+        result = list(self._client.listRecordsPartitioned(
+            metadataPrefix='oai_dc', from_=datetime(2004, 1, 1),
+            until=datetime(2004, 12, 31), partitions=4))
+        self.assertEquals(100, len(result))
+
+class SetPartitionedTestCase(TestCase):
+    def setUp(self):
+        metadata_registry = metadata.MetadataRegistry()
+        metadata_registry.registerWriter('oai_dc', server.oai_dc_writer)
+        metadata_registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._server = server.Server(SetFakeServer(), metadata_registry,
+                                     resumption_batch_size=7)
+        self._registry = metadata_registry
+        self._client = client.ServerClient(self._server, metadata_registry)
+
+    def test_all_sets(self):
+        records = list(self._client.listRecordsBySet(
+            metadataPrefix='oai_dc', workers=2))
+        self.assertEquals(
+            sorted([str(i) for i in range(100)]),
+            sorted([header.identifier()
+                    for header, metadata, about in records]))
+
+    def test_chosen_sets(self):
+        records = list(self._client.listRecordsBySet(
+            metadataPrefix='oai_dc', sets=['three', 'odd']))
+        self.assertEquals(
+            sorted([str(i) for i in range(100) if i % 3 == 0 or i % 2]),
+            sorted([header.identifier()
+                    for header, metadata, about in records]))
+
+    def test_from_until(self):
+        records = list(self._client.listRecordsBySet(
+            metadataPrefix='oai_dc', sets=['even', 'three'],
+            from_=datetime(2004, 1, 1), until=datetime(2004, 7, 1)))
+        self.assertEquals(
+            sorted([str(i) for i in range(100)
+                    if (i % 2 == 0 or i % 3 == 0) and i % 12 < 6]),
+            sorted([header.identifier()
+                    for header, metadata, about in records]))
+
+    def test_queue_size(self):
+        myclient = CountingServerClient(self._server, self._registry)
+        records = myclient.listRecordsBySet(
+            metadataPrefix='oai_dc', sets=['even', 'odd'], workers=2,
+            queue_size=7)
+        next(records)
+        time.sleep(0.5)
+        self.assert_(myclient.requests <= 6)
+        self.assertEquals(99, len(list(records)))
+
+    def test_firstSet(self):
+        self.assertEquals('b', client.firstSet(['c', 'b'], ['a', 'b', 'c']))
+        self.assertEquals(None, client.firstSet(['d'], ['a', 'b', 'c']))
+
+class PipelineTestCase(TestCase):
+    def setUp(self):
+        self._registry = metadata.MetadataRegistry()
+        self._registry.registerWriter('oai_dc', server.oai_dc_writer)
+        self._registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._server = server.Server(fakeserver.FakeServer(), self._registry,
+                                     resumption_batch_size=7)
+        self._client = client.ServerClient(self._server, self._registry)
+        self._pool = ProcessPoolExecutor(2)
+
+    def tearDown(self):
+        self._pool.shutdown()
+
+    def records(self, records):
+        return [(header.identifier(), header.datestamp(), metadata.getMap())
+                for header, metadata, about in records]
+
+    def test_listRecords(self):
+        expected = self.records(
+            self._client.listRecords(metadataPrefix='oai_dc'))
+        self._client.setParsePool(self._pool, depth=2)
+        records = list(self._client.listRecords(metadataPrefix='oai_dc'))
+        # in page order
+        self.assertEquals(expected, self.records(records))
+        self.assertEquals([None] * 100,
+                          [header.element() for header, metadata, about
+                           in records])
+
+    def test_filter(self):
+        self._client.setParsePool(self._pool)
+        skipped = []
+        records = self._client.listRecords(
+            metadataPrefix='oai_dc', fields=['title'], filter=evenFilter,
+            skipped=skipped.append)
+        self.assertEquals(
+            [(str(i), {'title': ['Title %s' % i]}) for i in range(0, 100, 2)],
+            [(header.identifier(), metadata.getMap())
+             for header, metadata, about in records])
+        self.assertEquals(50, len(skipped))
+        self.assert_(isinstance(skipped[0], datetime))
+
+    def test_incremental(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            store = state.FileStore(os.path.join(tmpdir, 'state.json'))
+            self._client.setParsePool(self._pool)
+            records = self._client.listRecordsIncremental(
+                'oai_dc', store, filter=evenFilter)
+            self.assertEquals(50, len(list(records)))
+            # the newest record is odd, and was skipped
+            self.assertEquals(['2004-12-28T11:23:23Z'],
+                              list(store._data.values()))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_broken_page(self):
+        myclient = BrokenServerClient(self._server, self._registry)
+        myclient.setParsePool(self._pool)
+        records = myclient.listRecords(metadataPrefix='oai_dc')
+        # the first page is fine
+        self.assertEquals(['0', '1', '2', '3', '4', '5', '6'],
+                          [next(records)[0].identifier() for i in range(7)])
+        self.assertRaises(error.XMLSyntaxError, next, records)
+
+    def test_token_mismatch(self):
+        myclient = CDATAServerClient(self._server, self._registry)
+        myclient.setParsePool(self._pool)
+        records = myclient.listRecords(metadataPrefix='oai_dc')
+        self.assertEquals([str(i) for i in range(100)],
+                          [header.identifier() for header, metadata, about
+                           in records])
+
+    def test_scanToken(self):
+        scan = client.scanToken
+        self.assertEquals('a b', scan(
+            b'<ListRecords><record>resumptionToken</record>'
+            b'<resumptionToken cursor="0">a b</resumptionToken>'
+            b'</ListRecords>'))
+        self.assertEquals('a&b', scan(
+            b'<oai:resumptionToken>a&amp;b</oai:resumptionToken>'))
+        self.assertEquals(None, scan(
+            b'<ListRecords><resumptionToken completeListSize="1"/>'))
+        self.assertEquals(None, scan(
+            b'<resumptionToken> </resumptionToken>'))
+        self.assertEquals(None, scan(b'<record>resumptionToken</record>'))
+        self.assertEquals(None, scan(b''))
+
+def test_suite():
+    return TestSuite((makeSuite(DateWindowsTestCase),
+                      makeSuite(ConcurrentGeneratorTestCase),
+                      makeSuite(PartitionedTestCase),
+                      makeSuite(SetPartitionedTestCase),
+                      makeSuite(PipelineTestCase)))
+
+if __name__=='__main__':
+    main(defaultTest='test_suite')
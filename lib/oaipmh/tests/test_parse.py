@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, TestSuite, main, makeSuite
+from fakehttp import createOAIServer
+from oaipmh import client, error, metadata
+
+class DirtyServerClient(client.ServerClient):
+    """Add a form feed and a byte that is not UTF-8 to every title.
+    """
+    def makeRequest(self, **kw):
+        xml = client.ServerClient.makeRequest(self, **kw)
+        return xml.replace(b'Title', b'T\x0citle\xff')
+
+class BadCharactersTestCase(TestCase):
+    def setUp(self):
+        self._registry = metadata.MetadataRegistry()
+        self._registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._client = DirtyServerClient(createOAIServer(), self._registry)
+
+    def titles(self, records):
+        return [metadata.getField('title')[0]
+                for header, metadata, about in records]
+
+    def test_strict(self):
+        self.assertRaises(error.XMLSyntaxError, self._client.listRecords,
+                          metadataPrefix='oai_dc')
+
+    def test_ignore(self):
+        self._client.ignoreBadCharacters(True)
+        records = self._client.listRecords(metadataPrefix='oai_dc')
+        self.assertEquals([u'Title� %s' % i for i in range(100)],
+                          self.titles(records))
+
+    def test_streaming(self):
+        self._client.ignoreBadCharacters(True)
+        self._client.setStreaming(True)
+        records = self._client.listRecords(metadataPrefix='oai_dc')
+        self.assertEquals([u'Title� %s' % i for i in range(100)],
+                          self.titles(records))
+
+    def test_parser_reused(self):
+        self._client.ignoreBadCharacters(True)
+        parser = client.recoveringParser()
+        self.assertRaises(error.XMLSyntaxError,
+                          self._client.parseErrorHandling, b'', {})
+        tree = self._client.parse(b'<a>\x01b</a>')
+        self.assertEquals('b', tree.text)
+        self.assert_(client.recoveringParser() is parser)
+
+    def test_cleanChunks(self):
+        data = u'caf\xe9 \x0c€\uffff'.encode('utf-8') + b'\xff'
+        # split inside the multibyte characters
+        chunks = [data[i:i + 1] for i in range(len(data))]
+        self.assertEquals(u'caf\xe9 €�'.encode('utf-8'),
+                          b''.join(client.cleanChunks(chunks)))
+        self.assertEquals(
+            u'caf\xe9 €�'.encode('utf-8'),
+            b''.join(client.cleanChunks(client.sliceChunks(data, 3))))
+
+    def test_cleanChunks_valid(self):
+        data = u'<a>caf\xe9 €</a>'.encode('utf-8')
+        chunks = list(client.cleanChunks(client.sliceChunks(data, 5)))
+        self.assertEquals(data, b''.join(chunks))
+        for chunk in chunks:
+            self.assert_(isinstance(chunk, bytes))
+            chunk.decode('utf-8')
+
+class LocalFileTestCase(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'identify.xml')
+        xml = createOAIServer().handleRequest({'verb': 'Identify'})
+        f = open(self._path, 'wb')
+        f.write(xml.replace(b'>Fake<', u'>F\xe4ke<'.encode('utf-8')))
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_identify(self):
+        myclient = client.Client(self._path, local_file=True)
+        self.assertEquals(u'F\xe4ke', myclient.identify().repositoryName())
+
+    def test_chunks(self):
+        myclient = client.Client(self._path, local_file=True)
+        f = open(self._path, 'rb')
+        self.assertEquals(f.read(),
+                          b''.join(myclient.makeRequestChunks(verb='Identify')))
+        f.close()
+
+def test_suite():
+    return TestSuite((makeSuite(BadCharactersTestCase),
+                      makeSuite(LocalFileTestCase)))
+
+if __name__=='__main__':
+    main(defaultTest='test_suite')
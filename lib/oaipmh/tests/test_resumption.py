@@ -0,0 +1,101 @@
+import threading
+import time
+from unittest import TestCase, TestSuite, main, makeSuite
+from oaipmh import client, metadata, server
+import fakeserver
+
+class TestError(Exception):
+    pass
+
+def createBatches(pages, fail_on=None):
+    """Create firstBatch and nextBatch functions for pages of items.
+    """
+    requested = []
+    def batch(index):
+        requested.append(index)
+        if index == fail_on:
+            raise TestError(index)
+        if index + 1 < pages:
+            token = str(index + 1)
+        else:
+            token = None
+        return list(range(index * 10, index * 10 + 10)), token
+    def firstBatch():
+        return batch(0)
+    def nextBatch(token):
+        return batch(int(token))
+    return firstBatch, nextBatch, requested
+
+class ResumptionListGeneratorTestCase(TestCase):
+
+    def test_sequential(self):
+        firstBatch, nextBatch, requested = createBatches(5)
+        items = client.ResumptionListGenerator(firstBatch, nextBatch)
+        self.assertEquals(list(range(50)), list(items))
+        self.assertEquals([0, 1, 2, 3, 4], requested)
+
+    def test_prefetch(self):
+        firstBatch, nextBatch, requested = createBatches(5)
+        items = client.ResumptionListGenerator(firstBatch, nextBatch,
+                                               prefetch=2)
+        self.assertEquals(0, next(items))
+        # give the fetching thread time to read ahead
+        time.sleep(0.2)
+        # the batch being consumed, two waiting and one being handed over
+        self.assert_(3 <= len(requested) <= 4)
+        self.assertEquals(list(range(1, 50)), list(items))
+        self.assertEquals([0, 1, 2, 3, 4], requested)
+
+    def test_prefetch_error(self):
+        firstBatch, nextBatch, requested = createBatches(5, fail_on=3)
+        items = client.ResumptionListGenerator(firstBatch, nextBatch,
+                                               prefetch=1)
+        result = []
+        try:
+            for item in items:
+                result.append(item)
+        except TestError as e:
+            self.assertEquals(3, e.args[0])
+        else:
+            self.fail("TestError not raised")
+        self.assertEquals(list(range(30)), result)
+
+    def test_prefetch_close(self):
+        firstBatch, nextBatch, requested = createBatches(1000)
+        before = threading.active_count()
+        items = client.ResumptionListGenerator(firstBatch, nextBatch,
+                                               prefetch=1)
+        self.assertEquals(0, next(items))
+        items.close()
+        time.sleep(client.PREFETCH_POLL * 3)
+        self.assertEquals(before, threading.active_count())
+        self.assert_(len(requested) < 5)
+
+class PrefetchClientTestCase(TestCase):
+    def setUp(self):
+        metadata_registry = metadata.MetadataRegistry()
+        metadata_registry.registerWriter('oai_dc', server.oai_dc_writer)
+        metadata_registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._server = server.Server(fakeserver.FakeServer(),
+                                     metadata_registry,
+                                     resumption_batch_size=7)
+        self._client = client.ServerClient(self._server, metadata_registry)
+        self._client.setPrefetch(3)
+
+    def test_listIdentifiers(self):
+        headers = self._client.listIdentifiers(metadataPrefix='oai_dc')
+        self.assertEquals([str(i) for i in range(100)],
+                          [header.identifier() for header in headers])
+
+    def test_listRecords(self):
+        records = list(self._client.listRecords(metadataPrefix='oai_dc'))
+        self.assertEquals(['Title %s' % i for i in range(100)],
+                          [metadata.getField('title')[0]
+                           for header, metadata, about in records])
+
+def test_suite():
+    return TestSuite((makeSuite(ResumptionListGeneratorTestCase),
+                      makeSuite(PrefetchClientTestCase)))
+
+if __name__=='__main__':
+    main(defaultTest='test_suite')
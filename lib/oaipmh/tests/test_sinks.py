@@ -0,0 +1,417 @@
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime
+from unittest import TestCase, TestSuite, main, makeSuite, skipIf
+from oaipmh import common, sinks
+
+def createRecords():
+    return [
+        (common.Header(None, 'oai:x:1', datetime(2004, 1, 2, 3, 4, 5),
+                       ['a', 'b'], False),
+         common.Metadata(None, {'title': [u'T\xeftle | one', u'Tab\there'],
+                                'date': [u'2004'],
+                                'rights': [],
+                                'creator': [u'Back\\slash\nline']}),
+         None),
+        (common.Header(None, 'oai:x:2', datetime(2004, 1, 3), [], True),
+         None, None),
+        ]
+
+class SinkTests(object):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'records' + self.extension)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def writeRecords(self, columns=None, append=False):
+        sink = sinks.openSink(self._path, ['title', 'date', 'rights',
+                                           'creator'], columns, batch_size=1,
+                              append=append)
+        with sink:
+            for record in createRecords():
+                sink.write(record)
+        self.assertEquals(2, sink.count)
+
+    def read(self):
+        f = io.open(self._path, encoding='utf-8', newline='')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+class CSVSinkTestCase(SinkTests, TestCase):
+    extension = '.csv'
+
+    def test_write(self):
+        self.writeRecords(['title', 'date', 'rights', 'creators'])
+        rows = list(csv.reader(io.StringIO(self.read())))
+        self.assertEquals(sinks.HEADER_COLUMNS +
+                          ['title', 'date', 'rights', 'creators'], rows[0])
+        self.assertEquals(
+            ['oai:x:1', '2004-01-02T03:04:05Z', 'a|b', 'false',
+             u'T\xeftle \\| one|Tab\there', '2004', '', u'Back\\\\slash\nline'],
+            rows[1])
+        self.assertEquals([u'T\xeftle | one', u'Tab\there'],
+                          sinks.splitValues(rows[1][4]))
+        self.assertEquals(['oai:x:2', '2004-01-03T00:00:00Z', '', 'true',
+                           '', '', '', ''], rows[2])
+
+    def test_sync(self):
+        sink = sinks.openSink(self._path, ['title'])
+        for record in createRecords():
+            sink.write(record)
+        self.assertEquals(u'', self.read())
+        sink.sync()
+        self.assertEquals(3, len(list(csv.reader(io.StringIO(self.read())))))
+        sink.close()
+
+    def test_append(self):
+        self.writeRecords(append=True)
+        self.writeRecords(append=True)
+        rows = list(csv.reader(io.StringIO(self.read())))
+        self.assertEquals(5, len(rows))
+        self.assertEquals(rows[1:3], rows[3:])
+        # without append the file is overwritten
+        self.writeRecords()
+        self.assertEquals(3, len(list(csv.reader(io.StringIO(self.read())))))
+
+class TSVSinkTestCase(SinkTests, TestCase):
+    extension = '.tsv'
+
+    def test_write(self):
+        self.writeRecords()
+        lines = self.read().split('\n')
+        self.assertEquals(4, len(lines))
+        self.assertEquals('', lines[-1])
+        self.assertEquals(sinks.HEADER_COLUMNS +
+                          ['title', 'date', 'rights', 'creator'],
+                          lines[0].split('\t'))
+        self.assertEquals(
+            ['oai:x:1', '2004-01-02T03:04:05Z', 'a|b', 'false',
+             u'T\xeftle \\\\| one|Tab\\there', '2004', '',
+             u'Back\\\\\\\\slash\\nline'],
+            lines[1].split('\t'))
+
+    def test_append(self):
+        self.writeRecords()
+        self.writeRecords(append=True)
+        lines = self.read().split('\n')
+        self.assertEquals(6, len(lines))
+        self.assertEquals(lines[1:3], lines[3:5])
+
+class JSONLinesSinkTestCase(SinkTests, TestCase):
+    extension = '.jsonl'
+
+    def test_write(self):
+        self.writeRecords()
+        lines = self.read().split('\n')
+        self.assertEquals(3, len(lines))
+        self.assertEquals(
+            {'identifier': 'oai:x:1', 'datestamp': '2004-01-02T03:04:05Z',
+             'setSpec': ['a', 'b'], 'deleted': False,
+             'metadata': {'title': [u'T\xeftle | one', u'Tab\there'],
+                          'date': [u'2004'], 'rights': [],
+                          'creator': [u'Back\\slash\nline']}},
+            json.loads(lines[0]))
+        self.assertEquals(
+            {'identifier': 'oai:x:2', 'datestamp': '2004-01-03T00:00:00Z',
+             'setSpec': [], 'deleted': True, 'metadata': None},
+            json.loads(lines[1]))
+
+class ColumnSinkTests(SinkTests):
+    def writeRecords(self):
+        sink = sinks.openSink(
+            self._path, ['title', 'date', 'creator', 'rights'],
+            ['title', 'date', 'creators', 'rights'],
+            field_types={'date': 'text'}, row_group_size=2)
+        records = createRecords()
+        for i in range(3):
+            records[0][1]._map['date'] = u'200%s' % i
+            for record in records:
+                sink.write(record)
+        sink.close()
+        self.assertEquals(6, sink.count)
+
+    def test_sync(self):
+        sink = sinks.openSink(self._path, ['title'], row_group_size=2)
+        sink.write(createRecords()[0])
+        sink.sync()
+        # the row is only written with a full row group or on close
+        self.assertEquals(1, len(sink._columns[0]))
+        sink.close()
+
+    def assertTable(self, table):
+        self.assertEquals(sinks.HEADER_COLUMNS +
+                          ['title', 'date', 'creators', 'rights'],
+                          table.schema.names)
+        # Parquet keeps milliseconds at least
+        self.assert_(str(table.schema.field(1).type).startswith('timestamp'))
+        import pyarrow
+        self.assert_(pyarrow.types.is_list(table.schema.field(4).type))
+        self.assertEquals(pyarrow.string(), table.schema.field(5).type)
+        rows = table.to_pylist()
+        self.assertEquals(6, len(rows))
+        self.assertEquals(
+            {'oai_identifier': 'oai:x:1',
+             'datestamp': datetime(2004, 1, 2, 3, 4, 5),
+             'setSpec': ['a', 'b'], 'deleted': False,
+             'title': [u'T\xeftle | one', u'Tab\there'], 'date': u'2000',
+             'creators': [u'Back\\slash\nline'], 'rights': []},
+            rows[0])
+        self.assertEquals(
+            {'oai_identifier': 'oai:x:2', 'datestamp': datetime(2004, 1, 3),
+             'setSpec': [], 'deleted': True, 'title': None, 'date': None,
+             'creators': None, 'rights': None},
+            rows[1])
+        self.assertEquals([u'2000', None, u'2001', None, u'2002', None],
+                          [row['date'] for row in rows])
+
+@skipIf(sinks.pyarrow is None, "pyarrow is not installed")
+class ParquetSinkTestCase(ColumnSinkTests, TestCase):
+    extension = '.parquet'
+
+    def test_write(self):
+        import pyarrow.parquet
+        self.writeRecords()
+        parquet_file = pyarrow.parquet.ParquetFile(self._path)
+        # a row group per two records
+        self.assertEquals(3, parquet_file.num_row_groups)
+        self.assertTable(parquet_file.read())
+
+    def test_append(self):
+        self.assertRaises(sinks.Error, sinks.openSink, self._path, ['title'],
+                          append=True)
+
+@skipIf(sinks.pyarrow is None, "pyarrow is not installed")
+class ArrowSinkTestCase(ColumnSinkTests, TestCase):
+    extension = '.arrow'
+
+    def test_write(self):
+        import pyarrow.ipc
+        self.writeRecords()
+        with pyarrow.memory_map(self._path) as source:
+            reader = pyarrow.ipc.open_file(source)
+            self.assertEquals(3, reader.num_record_batches)
+            self.assertTable(reader.read_all())
+
+class SQLiteSinkTestCase(SinkTests, TestCase):
+    extension = '.sqlite'
+
+    def select(self, sql):
+        connection = sqlite3.connect(self._path)
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def test_durable(self):
+        sink = sinks.openSink(self._path, ['title'])
+        try:
+            # FULL, commits are synced to disk
+            self.assertEquals([(2,)], sink._connection.execute(
+                'PRAGMA synchronous').fetchall())
+        finally:
+            sink.close()
+
+    def test_write(self):
+        self.writeRecords()
+        self.assertEquals(
+            [('oai:x:1', '2004-01-02T03:04:05Z', 0,
+              {'title': [u'T\xeftle | one', u'Tab\there'],
+               'date': [u'2004'], 'rights': [],
+               'creator': [u'Back\\slash\nline']}),
+             ('oai:x:2', '2004-01-03T00:00:00Z', 1, None)],
+            [(identifier, datestamp, deleted,
+              metadata and json.loads(metadata))
+             for identifier, datestamp, deleted, metadata in self.select(
+                 'SELECT * FROM records ORDER BY identifier')])
+        self.assertEquals([('a', 'oai:x:1'), ('b', 'oai:x:1')], self.select(
+            'SELECT * FROM record_sets ORDER BY setSpec'))
+        self.assertEquals([('wal',)], self.select('PRAGMA journal_mode'))
+        self.assertEquals(
+            ['record_sets_identifier', 'records_datestamp'],
+            [name for name, in self.select(
+                "SELECT name FROM sqlite_master WHERE type = 'index' "
+                "AND sql IS NOT NULL ORDER BY name")])
+
+    def test_update(self):
+        self.writeRecords()
+        sink = sinks.SQLiteSink(self._path, ['title'])
+        # deleted, then harvested again with an older version
+        sink.write((common.Header(None, 'oai:x:1', datetime(2005, 1, 1),
+                                  ['c'], True), None, None))
+        sink.flush()
+        sink.write((common.Header(None, 'oai:x:1', datetime(2004, 1, 1),
+                                  ['d'], False),
+                    common.Metadata(None, {'title': [u'Old']}), None))
+        # two versions in one batch
+        for day in [5, 4]:
+            sink.write((common.Header(None, 'oai:x:3',
+                                      datetime(2004, 1, day), [str(day)],
+                                      False),
+                        common.Metadata(None, {'title': [u'D%s' % day]}),
+                        None))
+        sink.close()
+        self.assertEquals(
+            [('oai:x:1', '2005-01-01T00:00:00Z', 1, None),
+             ('oai:x:2', '2004-01-03T00:00:00Z', 1, None),
+             ('oai:x:3', '2004-01-05T00:00:00Z', 0, '{"title": ["D5"]}')],
+            self.select('SELECT * FROM records ORDER BY identifier'))
+        self.assertEquals([('5', 'oai:x:3'), ('c', 'oai:x:1')], self.select(
+            'SELECT * FROM record_sets ORDER BY setSpec'))
+
+class ShardedSinkTests(SinkTests):
+    def writeShards(self, **kw):
+        sink = sinks.openSink(self._path, ['title'], batch_size=3, **kw)
+        records = createRecords() * 5
+        for record in records:
+            sink.write(record)
+        # a finished shard has its name, the current one doesn't yet
+        names = sorted(os.listdir(self._dir))
+        sink.close()
+        lines = []
+        for path in sink.shards:
+            lines.append([json.loads(line) for line in
+                          self.decompress(path).decode('utf-8').splitlines()])
+        return names, sink.shards, lines
+
+    def test_records(self):
+        names, shards, lines = self.writeShards(max_records=4)
+        self.assertEquals(['records.00000' + self.extension,
+                           'records.00001' + self.extension,
+                           'records.00002.jsonl%s.part' % self.compression],
+                          names)
+        self.assertEquals([os.path.join(self._dir, 'records.0000%s.jsonl%s'
+                                        % (i, self.compression))
+                           for i in range(3)], shards)
+        self.assertEquals([4, 4, 2], [len(shard) for shard in lines])
+        self.assertEquals({'title': [u'T\xeftle | one', u'Tab\there']},
+                          lines[0][0]['metadata'])
+        self.assertEquals(
+            {'identifier': 'oai:x:2', 'datestamp': '2004-01-03T00:00:00Z',
+             'setSpec': [], 'deleted': True, 'metadata': None},
+            lines[2][1])
+        # the shards of the next run are numbered on
+        names, shards, lines = self.writeShards()
+        self.assertEquals([os.path.join(self._dir, 'records.00003.jsonl%s'
+                                        % self.compression)], shards)
+        self.assertEquals([10], [len(shard) for shard in lines])
+
+    def test_recover(self):
+        sink = sinks.openSink(self._path, ['title'], max_records=4)
+        records = createRecords() * 3
+        for record in records:
+            sink.write(record)
+        sink.sync()
+        # crashed after writing more, without syncing
+        sink.write(records[0])
+        self.assertEquals(1, len(sink.shards))
+        sink = sinks.openSink(self._path, ['title'])
+        self.assertEquals(['records.00000' + self.extension,
+                           'records.00001' + self.extension],
+                          sorted(os.listdir(self._dir)))
+        lines = self.decompress(
+            os.path.join(self._dir, 'records.00001' + self.extension))
+        self.assertEquals(['oai:x:1', 'oai:x:2'],
+                          [json.loads(line)['identifier']
+                           for line in lines.decode('utf-8').splitlines()])
+        sink.write(records[0])
+        sink.close()
+        self.assertEquals([os.path.join(self._dir, 'records.00002' +
+                                        self.extension)], sink.shards)
+
+    def test_bytes(self):
+        names, shards, lines = self.writeShards(max_bytes=1)
+        # a shard per batch
+        self.assertEquals([3, 3, 3, 1], [len(shard) for shard in lines])
+
+class GzipSinkTestCase(ShardedSinkTests, TestCase):
+    extension = '.jsonl.gz'
+    compression = '.gz'
+
+    def decompress(self, path):
+        f = gzip.open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+@skipIf(sinks.zstandard is None, "zstandard is not installed")
+class ZstdSinkTestCase(ShardedSinkTests, TestCase):
+    extension = '.jsonl.zst'
+    compression = '.zst'
+
+    def decompress(self, path):
+        import zstandard
+        f = open(path, 'rb')
+        try:
+            return zstandard.ZstdDecompressor().stream_reader(f).read()
+        finally:
+            f.close()
+
+class SinksTestCase(TestCase):
+    def test_values(self):
+        for values in [[], [u'a'], [u'a|b', u'c\\', u'\\|'], [u'', u'x']]:
+            self.assertEquals(values,
+                              sinks.splitValues(sinks.joinValues(values)))
+
+    def test_unknown(self):
+        self.assertRaises(sinks.Error, sinks.openSink, 'records.xls', [])
+        self.assertRaises(sinks.Error, sinks.openSink, 'records.csv.gz', [])
+        self.assertRaises(sinks.Error, sinks.openSink, 'records.zst', [])
+        self.assertRaises(sinks.Error, sinks.ShardedJSONLinesSink,
+                          'records.jsonl')
+
+    def test_canAppend(self):
+        self.assert_(sinks.canAppend('records.csv'))
+        self.assert_(sinks.canAppend('records.sqlite'))
+        self.assert_(not sinks.canAppend('records.parquet'))
+        self.assert_(not sinks.canAppend('records.arrow'))
+        self.assertRaises(sinks.Error, sinks.canAppend, 'records.xls')
+
+    def test_compressedExtension(self):
+        self.assertEquals(sinks.zstandard is None and '.gz' or '.zst',
+                          sinks.compressedExtension())
+
+    def test_progress(self):
+        written = []
+        class ListSink(sinks.Sink):
+            def writeBatch(self, records):
+                written.extend(records)
+        times = iter([i / 10.0 for i in range(10)])
+        stream = io.StringIO()
+        sink = sinks.ProgressSink(ListSink(batch_size=2), interval=0.25,
+                                  stream=stream, clock=lambda: next(times))
+        records = createRecords() * 3
+        for record in records:
+            sink.write(record)
+        sink.close()
+        self.assertEquals(records, written)
+        # a line every three records, and one when closing
+        self.assertEquals([u'3 records, 1 deleted, 10 records/sec',
+                           u'6 records, 3 deleted, 10 records/sec',
+                           u'6 records, 3 deleted, 9 records/sec',
+                           u''],
+                          stream.getvalue().split(u'\n'))
+
+def test_suite():
+    return TestSuite((makeSuite(CSVSinkTestCase),
+                      makeSuite(TSVSinkTestCase),
+                      makeSuite(JSONLinesSinkTestCase),
+                      makeSuite(ParquetSinkTestCase),
+                      makeSuite(ArrowSinkTestCase),
+                      makeSuite(SQLiteSinkTestCase),
+                      makeSuite(GzipSinkTestCase),
+                      makeSuite(ZstdSinkTestCase),
+                      makeSuite(SinksTestCase)))
+
+if __name__=='__main__':
+    main(defaultTest='test_suite')
@@ -0,0 +1,267 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+from datetime import datetime, timedelta
+import shutil
+import tempfile
+from unittest import TestCase, TestSuite, main, makeSuite
+from oaipmh import client, common, metadata, server, sinks, state
+import fakeserver
+
+class StoreTests(object):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_get_set(self):
+        store = self.createStore()
+        self.assertEquals(None, store.get('a'))
+        self.assertEquals(1, store.get('a', 1))
+        store.set('a', {'token': 'x', 'args': {'set': 'b'}})
+        store.set('b', 2)
+        store.set('b', 3)
+        store.delete('c')
+        store.close()
+        store = self.createStore()
+        self.assertEquals({'token': 'x', 'args': {'set': 'b'}},
+                          store.get('a'))
+        self.assertEquals(3, store.get('b'))
+        store.delete('a')
+        store.close()
+        store = self.createStore()
+        self.assertEquals(None, store.get('a'))
+        store.close()
+
+class FileStoreTestCase(StoreTests, TestCase):
+    def createStore(self):
+        return state.FileStore(self._path)
+
+    def test_no_temporary_files(self):
+        store = self.createStore()
+        store.set('a', 1)
+        self.assertEquals(['state'], os.listdir(self._dir))
+
+    def test_not_a_state_file(self):
+        f = open(self._path, 'w')
+        f.write('garbage')
+        f.close()
+        self.assertRaises(state.Error, self.createStore)
+
+class SQLiteStoreTestCase(StoreTests, TestCase):
+    def createStore(self):
+        return state.SQLiteStore(self._path)
+
+class CheckpointTestCase(TestCase):
+    def setUp(self):
+        self._registry = metadata.MetadataRegistry()
+        self._registry.registerWriter('oai_dc', server.oai_dc_writer)
+        self._registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._server = server.Server(fakeserver.FakeServer(), self._registry,
+                                     resumption_batch_size=7)
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'checkpoints.json')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def createClient(self):
+        myclient = client.ServerClient(self._server, self._registry)
+        myclient.setCheckpointStore(state.FileStore(self._path))
+        return myclient
+
+    def interrupt(self, myclient, count):
+        records = myclient.listRecords(metadataPrefix='oai_dc')
+        for i in range(count):
+            next(records)
+
+    def identifiers(self, records):
+        return [header.identifier() for header, metadata, about in records]
+
+    def test_resume(self):
+        # interrupted while processing the third page
+        self.interrupt(self.createClient(), 20)
+        myclient = self.createClient()
+        records = myclient.listRecords(metadataPrefix='oai_dc')
+        self.assertEquals([str(i) for i in range(14, 100)],
+                          self.identifiers(records))
+        # the checkpoint is gone once the list is complete
+        self.assertEquals({}, state.FileStore(self._path)._data)
+        records = myclient.listRecords(metadataPrefix='oai_dc')
+        self.assertEquals(100, len(self.identifiers(records)))
+
+    def test_page_boundary(self):
+        # the last record of a page is only done once the next is asked for
+        self.interrupt(self.createClient(), 7)
+        records = self.createClient().listRecords(metadataPrefix='oai_dc')
+        self.assertEquals('0', next(records)[0].identifier())
+
+    def test_other_arguments(self):
+        self.interrupt(self.createClient(), 20)
+        records = self.createClient().listIdentifiers(
+            metadataPrefix='oai_dc')
+        self.assertEquals(100, len(list(records)))
+
+    def test_expired_token(self):
+        myclient = self.createClient()
+        store = state.FileStore(self._path)
+        store.set(myclient.checkpointKey('ListRecords',
+                                         {'metadataPrefix': 'oai_dc'}),
+                  {'args': {'metadataPrefix': 'oai_dc'}, 'token': 'bogus'})
+        records = self.createClient().listRecords(metadataPrefix='oai_dc')
+        self.assertEquals([str(i) for i in range(100)],
+                          self.identifiers(records))
+
+    def test_streaming(self):
+        self.interrupt(self.createClient(), 20)
+        myclient = self.createClient()
+        myclient.setStreaming(True)
+        records = myclient.listRecords(metadataPrefix='oai_dc')
+        self.assertEquals([str(i) for i in range(14, 100)],
+                          self.identifiers(records))
+        self.assertEquals({}, state.FileStore(self._path)._data)
+
+    def test_before_checkpoint(self):
+        path = os.path.join(self._dir, 'records.csv')
+        myclient = self.createClient()
+        with sinks.openSink(path, ['title']) as sink:
+            myclient.setBeforeCheckpoint(sink.sync)
+            records = myclient.listRecords(metadataPrefix='oai_dc')
+            for i in range(31):
+                sink.write(next(records))
+            # the records before the checkpoint are on disk
+            token = state.FileStore(self._path).get(myclient.checkpointKey(
+                'ListRecords', {'metadataPrefix': 'oai_dc'}))['token']
+            self.assert_('cursor%3D28' in token)
+            f = open(path)
+            self.assertEquals(29, len(f.readlines()))
+            f.close()
+
+    def test_requestKey(self):
+        self.assertEquals(
+            state.requestKey('http://x/oai', 'ListRecords',
+                             {'metadataPrefix': 'oai_dc', 'set': 's',
+                              'from': '2004-01-01'}),
+            state.requestKey('http://x/oai', 'ListRecords',
+                             {'set': 's', 'from': '2004-01-01',
+                              'metadataPrefix': 'oai_dc',
+                              'until': '2005-01-01'}))
+
+class WatermarkTestCase(TestCase):
+    def setUp(self):
+        self._registry = metadata.MetadataRegistry()
+        self._registry.registerWriter('oai_dc', server.oai_dc_writer)
+        self._registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._fakeserver = fakeserver.FakeServer()
+        self._client = client.ServerClient(
+            server.Server(self._fakeserver, self._registry,
+                          resumption_batch_size=7),
+            self._registry)
+        self._dir = tempfile.mkdtemp()
+        self._store = state.SQLiteStore(os.path.join(self._dir, 'state.db'))
+
+    def tearDown(self):
+        self._store.close()
+        shutil.rmtree(self._dir)
+
+    def harvest(self, **kw):
+        return [header.identifier() for header, metadata, about in
+                self._client.listRecordsIncremental('oai_dc', self._store,
+                                                    **kw)]
+
+    def addRecord(self, identifier, datestamp):
+        self._fakeserver._data.append(
+            (common.Header(None, identifier, datestamp, [], False),
+             common.Metadata(None, {'title': ['New']}), None))
+
+    def test_incremental(self):
+        self.assertEquals(100, len(self.harvest()))
+        # the newest record, 2004-12-28T11:23:23Z, is in the overlap
+        self.assertEquals(['83'], self.harvest())
+        self.addRecord('100', datetime(2005, 1, 1))
+        self.addRecord('101', datetime(2004, 12, 28, 11, 20))
+        self.assertEquals(['83', '100', '101'], self.harvest())
+        self.assertEquals(['100'], self.harvest(overlap=timedelta(0)))
+
+    def test_first_from(self):
+        self.assertEquals(['23', '83'],
+                          self.harvest(from_=datetime(2004, 12, 21)))
+        self.assertEquals(['83'], self.harvest(from_=datetime(2004, 12, 21)))
+
+    def test_first_interrupted(self):
+        self._client.setCheckpointStore(self._store)
+        records = self._client.listRecordsIncremental(
+            'oai_dc', self._store, from_=datetime(2004, 1, 1, 0, 0, 0, 5))
+        for i in range(20):
+            next(records)
+        records.close()
+        # the restart, with a from_ computed again, resumes
+        self.assertEquals([str(i) for i in range(14, 100)],
+                          self.harvest(from_=datetime(2004, 12, 21)))
+        self.assertEquals(['83'], self.harvest(from_=datetime(2004, 12, 21)))
+        self.assertEquals(None, self._store.get(
+            self._client.firstFromKey('oai_dc')))
+
+    def test_no_records(self):
+        self.assertEquals([], self.harvest(from_=datetime(2005, 1, 1)))
+        self.assertEquals([], self.harvest(from_=datetime(2005, 1, 1)))
+        self.assertEquals(100, len(self.harvest()))
+
+    def test_no_records_streaming(self):
+        self._client.setStreaming(True)
+        self.test_no_records()
+
+    def test_no_records_pool(self):
+        pool = ProcessPoolExecutor(1)
+        try:
+            self._client.setParsePool(pool)
+            self.test_no_records()
+        finally:
+            pool.shutdown()
+
+    def test_interrupted(self):
+        records = self._client.listRecordsIncremental('oai_dc', self._store)
+        next(records)
+        records.close()
+        self.assertEquals(100, len(self.harvest()))
+
+    def test_resumesList(self):
+        self._client.setCheckpointStore(self._store)
+        def resumes():
+            args = self._client.incrementalArguments('oai_dc', self._store)
+            return self._client.resumesList('ListRecords', **args)
+        self.assertEquals(False, resumes())
+        records = self._client.listRecordsIncremental('oai_dc', self._store)
+        for i in range(20):
+            next(records)
+        records.close()
+        self.assertEquals(True, resumes())
+        self.assertEquals([str(i) for i in range(14, 100)], self.harvest())
+        self.assertEquals(False, resumes())
+
+    def test_per_set(self):
+        self.harvest()
+        self.assertEquals(100, len(self.harvest(set='a')))
+
+    def test_watermarkFrom(self):
+        watermark = datetime(2004, 3, 5, 12, 30, 10, 5)
+        self.assertEquals(datetime(2004, 3, 5, 12, 20, 10),
+                          client.watermarkFrom(watermark,
+                                               timedelta(minutes=10)))
+        self.assertEquals(datetime(2004, 3, 5),
+                          client.watermarkFrom(watermark,
+                                               timedelta(minutes=10), True))
+        self.assertEquals(datetime(2004, 3, 3),
+                          client.watermarkFrom(watermark,
+                                               timedelta(days=2, hours=3),
+                                               True))
+
+def test_suite():
+    return TestSuite((makeSuite(FileStoreTestCase),
+                      makeSuite(SQLiteStoreTestCase),
+                      makeSuite(CheckpointTestCase),
+                      makeSuite(WatermarkTestCase)))
+
+if __name__=='__main__':
+    main(defaultTest='test_suite')
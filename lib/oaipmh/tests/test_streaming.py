@@ -0,0 +1,71 @@
+from datetime import datetime
+from unittest import TestCase, TestSuite, main, makeSuite
+from fakehttp import FakeHTTPServer, createOAIServer
+from oaipmh import client, error, metadata
+
+class ChunkingServerClient(client.ServerClient):
+    """Feed the responses to the parser in small chunks.
+    """
+    def makeRequestChunks(self, **kw):
+        xml = self.makeRequest(**kw)
+        return [xml[i:i + 100] for i in range(0, len(xml), 100)]
+
+class StreamingTestCase(TestCase):
+    def setUp(self):
+        self._registry = metadata.MetadataRegistry()
+        self._registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._client = ChunkingServerClient(createOAIServer(batch_size=30),
+                                            self._registry)
+        self._client.setStreaming(True)
+
+    def test_listRecords(self):
+        records = self._client.listRecords(metadataPrefix='oai_dc')
+        titles = []
+        for header, metadata, about in records:
+            record_node = header.element().getparent()
+            # only the current record, and possibly the start of the
+            # next one in the same chunk, is left on the page
+            self.assert_(len(record_node.getparent()) <= 2)
+            titles.append(metadata.getField('title')[0])
+        self.assertEquals(['Title %s' % i for i in range(100)], titles)
+
+    def test_from_until(self):
+        records = self._client.listRecords(metadataPrefix='oai_dc',
+                                           from_=datetime(2004, 1, 1),
+                                           until=datetime(2004, 7, 1))
+        self.assertEquals(52, len(list(records)))
+
+    def test_error(self):
+        records = self._client.listRecords(metadataPrefix='oai_dc',
+                                           from_=datetime(2003, 1, 1),
+                                           until=datetime(2003, 7, 1))
+        self.assertRaises(error.NoRecordsMatchError, list, records)
+
+    def test_not_wellformed(self):
+        myclient = client.ServerClient(None, self._registry)
+        myclient.setStreaming(True)
+        myclient.makeRequest = lambda **kw: b'<OAI-PMH><ListRecords>'
+        self.assertRaises(error.XMLSyntaxError, list,
+                          myclient.listRecords(metadataPrefix='oai_dc'))
+
+    def test_http(self):
+        httpserver = FakeHTTPServer(createOAIServer())
+        httpserver.start()
+        try:
+            myclient = client.Client(httpserver.url(), self._registry,
+                                     keep_alive=True)
+            myclient.setStreaming(True)
+            records = list(myclient.listRecords(metadataPrefix='oai_dc'))
+            myclient.close()
+        finally:
+            httpserver.stop()
+        self.assertEquals(['Title %s' % i for i in range(100)],
+                          [metadata.getField('title')[0]
+                           for header, metadata, about in records])
+        self.assertEquals(1, httpserver.connections)
+
+def test_suite():
+    return TestSuite((makeSuite(StreamingTestCase), ))
+
+if __name__=='__main__':
+    main(defaultTest='test_suite')
@@ -0,0 +1,255 @@
+import socket
+import time
+import zlib
+from io import BytesIO
+from unittest import TestCase, TestSuite, main, makeSuite
+from fakehttp import FakeHTTPServer, createOAIServer
+from oaipmh import client, common, metadata, transport
+import fakeserver
+
+class CompressingFakeServer(fakeserver.FakeServer):
+    def identify(self):
+        return common.Identify(
+            repositoryName='Fake',
+            baseURL='http://www.infrae.com/oai/',
+            protocolVersion="2.0",
+            adminEmails=['faassen@infrae.com'],
+            earliestDatestamp=fakeserver.datetime(2004, 1, 1),
+            deletedRecord='transient',
+            granularity='YYYY-MM-DDThh:mm:ssZ',
+            compression=['gzip', 'compress', 'deflate'])
+
+class FakeResponse(object):
+    def __init__(self, body, encoding):
+        self._f = BytesIO(body)
+        self._headers = {'Content-Encoding': encoding}
+
+    def info(self):
+        return self._headers
+
+    def read(self, amt=None):
+        return self._f.read(amt)
+
+    def close(self):
+        pass
+
+class FailingConnection(object):
+    """Idle connection whose next request fails with error.
+    """
+    sock = None
+
+    def __init__(self, error):
+        self._error = error
+        self.closed = False
+
+    def request(self, method, selector, data, headers):
+        raise self._error
+
+    def close(self):
+        self.closed = True
+
+class ConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        self._httpserver = FakeHTTPServer(createOAIServer())
+        self._httpserver.start()
+        registry = metadata.MetadataRegistry()
+        registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._client = client.Client(self._httpserver.url(), registry,
+                                     keep_alive=True)
+
+    def tearDown(self):
+        self._client.close()
+        self._httpserver.stop()
+
+    def test_listIdentifiers_one_connection(self):
+        headers = list(self._client.listIdentifiers(metadataPrefix='oai_dc'))
+        self.assertEquals([str(i) for i in range(100)],
+                          [header.identifier() for header in headers])
+        # 15 pages, but a single connection
+        self.assertEquals(15, len(self._httpserver.requests))
+        self.assertEquals(1, self._httpserver.connections)
+
+    def test_across_verbs(self):
+        self._client.identify()
+        records = list(self._client.listRecords(metadataPrefix='oai_dc'))
+        self.assertEquals(100, len(records))
+        self.assertEquals(1, self._httpserver.connections)
+
+    def test_http_get(self):
+        myclient = client.Client(self._httpserver.url(), keep_alive=True,
+                                 force_http_get=True)
+        self.assertEquals('Fake', myclient.identify().repositoryName())
+        self.assertEquals('Fake', myclient.identify().repositoryName())
+        myclient.close()
+        self.assertEquals(1, self._httpserver.connections)
+
+    def test_error_status(self):
+        self._httpserver.failures.append((404, {}))
+        pool = transport.ConnectionPool()
+        request = client.urllib2.Request(self._httpserver.url() +
+                                         '?verb=Identify')
+        self.assertRaises(client.urllib2.HTTPError, pool.urlopen, request)
+        # the connection survives the error response
+        response = pool.urlopen(request)
+        self.assert_(response.read())
+        pool.close()
+        self.assertEquals(1, self._httpserver.connections)
+
+    def openOnIdle(self, error):
+        pool = transport.ConnectionPool()
+        url = self._httpserver.url()
+        connection = FailingConnection(error)
+        pool._idle[('http', url.split('/')[2])] = [connection]
+        request = client.urllib2.Request(url + '?verb=Identify')
+        try:
+            return pool.urlopen(request).read()
+        finally:
+            pool.close()
+            self.assert_(connection.closed)
+
+    def test_dropped_idle_connection(self):
+        # the request is sent again on a new connection
+        self.assert_(self.openOnIdle(ConnectionResetError()))
+        self.assert_(self.openOnIdle(
+            client.http_client.RemoteDisconnected()))
+        self.assertEquals(2, len(self._httpserver.requests))
+
+    def test_timeout_on_idle_connection(self):
+        # left to the retry policy
+        self.assertRaises(socket.timeout, self.openOnIdle,
+                          socket.timeout('timed out'))
+        self.assertEquals(0, len(self._httpserver.requests))
+
+class CompressionTestCase(TestCase):
+    def setUp(self):
+        self._httpserver = FakeHTTPServer(
+            createOAIServer(CompressingFakeServer()))
+        self._httpserver.start()
+        registry = metadata.MetadataRegistry()
+        registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._client = client.Client(self._httpserver.url(), registry)
+
+    def tearDown(self):
+        self._httpserver.stop()
+
+    def test_negotiate(self):
+        self._httpserver.compression = ['deflate', 'gzip']
+        self._client.updateCompression()
+        records = list(self._client.listRecords(metadataPrefix='oai_dc'))
+        self.assertEquals(['Title %s' % i for i in range(100)],
+                          [metadata.getField('title')[0]
+                           for header, metadata, about in records])
+        kw, headers = self._httpserver.requests[-1]
+        self.assertEquals('gzip, deflate', headers['Accept-Encoding'])
+        self.assertEquals(['identity'] + ['deflate'] * 15,
+                          self._httpserver.encodings)
+
+    def test_not_advertised(self):
+        self._httpserver.oai_server = createOAIServer()
+        self._httpserver.compression = ['gzip']
+        self._client.updateCompression()
+        self._client.identify()
+        kw, headers = self._httpserver.requests[-1]
+        self.assert_(headers.get('Accept-Encoding') in (None, 'identity'))
+        self.assertEquals(['identity', 'identity'],
+                          self._httpserver.encodings)
+
+    def test_decodedChunks(self):
+        data = b'<OAI-PMH>' + b'x' * 100000 + b'</OAI-PMH>'
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw = compressor.compress(data) + compressor.flush()
+        for body, encoding in [(zlib.compress(data), 'deflate'),
+                               (raw, 'deflate'),
+                               (data, 'identity')]:
+            chunks = list(transport.decodedChunks(
+                FakeResponse(body, encoding), chunk_size=100))
+            self.assertEquals(data, b''.join(chunks))
+        self.assertRaises(transport.Error, list, transport.decodedChunks(
+            FakeResponse(data, 'compress')))
+
+class RetryTestCase(TestCase):
+    def setUp(self):
+        self._registry = metadata.MetadataRegistry()
+        self._registry.registerReader('oai_dc', metadata.oai_dc_reader)
+        self._httpserver = FakeHTTPServer(createOAIServer())
+        self._httpserver.start()
+
+    def tearDown(self):
+        self._httpserver.stop()
+
+    def test_retry(self):
+        self._httpserver.failures.extend([
+            (503, {}), (429, {'Retry-After': '0'}), (502, {})])
+        policy = client.RetryPolicy(backoff_base=0.01)
+        myclient = client.Client(self._httpserver.url(), self._registry,
+                                 retry_policy=policy)
+        self.assertEquals('Fake', myclient.identify().repositoryName())
+        self.assertEquals(3, policy.retries)
+        self.assert_(policy.waited < 0.05)
+        self.assertEquals(4, len(self._httpserver.requests))
+
+    def test_no_retry(self):
+        self._httpserver.failures.append((404, {}))
+        policy = client.RetryPolicy(backoff_base=0.01)
+        myclient = client.Client(self._httpserver.url(), self._registry,
+                                 retry_policy=policy)
+        self.assertRaises(client.urllib2.HTTPError, myclient.identify)
+        self.assertEquals(0, policy.retries)
+
+    def test_max_tries(self):
+        self._httpserver.failures.extend([(504, {})] * 3)
+        policy = client.RetryPolicy(max_tries=3, backoff_base=0.01)
+        myclient = client.Client(self._httpserver.url(), self._registry,
+                                 retry_policy=policy)
+        self.assertRaises(client.Error, myclient.identify)
+        self.assertEquals(2, policy.retries)
+
+    def test_max_wait(self):
+        self._httpserver.failures.append((503, {'Retry-After': '3600'}))
+        policy = client.RetryPolicy(max_wait=60)
+        myclient = client.Client(self._httpserver.url(), self._registry,
+                                 retry_policy=policy)
+        start = time.time()
+        self.assertRaises(client.Error, myclient.identify)
+        self.assert_(time.time() - start < 1)
+
+    def test_network_error(self):
+        opened = []
+        def opener(request, timeout=None):
+            opened.append(timeout)
+            if len(opened) == 1:
+                raise socket.timeout("timed out")
+            return FakeResponse(b'data', None)
+        policy = client.RetryPolicy(backoff_base=0.01, timeout=30)
+        self.assertEquals(b'data', client.retrieveFromUrlWaiting(
+            None, opener=opener, retry_policy=policy))
+        self.assertEquals([30, 30], opened)
+        self.assertEquals(1, policy.retries)
+
+    def test_backoff(self):
+        policy = client.RetryPolicy(backoff_base=2, backoff_max=10,
+                                    jitter=False)
+        self.assertEquals([2, 4, 8, 10],
+                          [policy.backoff(tries) for tries in range(1, 5)])
+        policy = client.RetryPolicy(backoff_base=2, backoff_max=10)
+        for i in range(20):
+            self.assert_(4 <= policy.backoff(3) <= 8)
+
+    def test_parseRetryAfter(self):
+        self.assertEquals(120, client.parseRetryAfter(' 120'))
+        self.assertEquals(None, client.parseRetryAfter(None))
+        self.assertEquals(None, client.parseRetryAfter('soon'))
+        self.assertEquals(0, client.parseRetryAfter(
+            'Wed, 21 Oct 2015 07:28:00 GMT'))
+        delay = client.parseRetryAfter(
+            time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                          time.gmtime(time.time() + 100)))
+        self.assert_(98 <= delay <= 100)
+
+def test_suite():
+    return TestSuite((makeSuite(ConnectionPoolTestCase),
+                      makeSuite(CompressionTestCase),
+                      makeSuite(RetryTestCase)))
+
+if __name__=='__main__':
+    main(defaultTest='test_suite')
@@ -0,0 +1,250 @@
+from __future__ import absolute_import
+
+import socket
+import threading
+import zlib
+from io import BytesIO
+
+from six.moves import http_client
+
+try:
+    import urllib.request as urllib2
+    from urllib.parse import urlsplit, urljoin
+except ImportError:
+    import urllib2
+    from urlparse import urlsplit, urljoin
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+POOL_MAXSIZE = 4
+CHUNK_SIZE = 64 * 1024
+# content codings we can decode, in order of preference
+SUPPORTED_ENCODINGS = ['gzip', 'deflate']
+
+# errors that mean the server closed a reused keep-alive connection while
+# it was idle; timeouts and other errors are left to the retry policy
+try:
+    DROPPED_ERRORS = (http_client.BadStatusLine, ConnectionResetError,
+                      BrokenPipeError)
+except NameError:
+    DROPPED_ERRORS = (http_client.BadStatusLine,)
+
+class Error(Exception):
+    pass
+
+class ConnectionPool(object):
+    """A pool of persistent (keep-alive) HTTP connections per host.
+
+    A connection is used by one request at a time and goes back into the
+    pool once its response has been read completely, so a single pool can
+    be shared by all pages of a resumption list, by different verbs and by
+    several threads.
+    """
+    def __init__(self, maxsize=POOL_MAXSIZE, timeout=None):
+        self._maxsize = maxsize
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def urlopen(self, request, timeout=None):
+        """Open a urllib Request over a pooled connection.
+
+        Behaves like urllib's urlopen: returns a file-like response,
+        follows redirects and raises HTTPError for error status codes.
+        """
+        for i in range(MAX_REDIRECTS + 1):
+            response = self._open(request, timeout)
+            location = response.getheader('Location')
+            if response.status in REDIRECT_CODES and location:
+                response.read()
+                response.close()
+                request = redirectRequest(request, response.status, location)
+                continue
+            if response.status >= 400:
+                # read the body so the connection can be reused
+                body = response.read()
+                response.close()
+                raise urllib2.HTTPError(
+                    request.get_full_url(), response.status,
+                    response.reason, response.msg, BytesIO(body))
+            return response
+        raise urllib2.HTTPError(
+            request.get_full_url(), response.status,
+            "Too many redirects", response.msg, BytesIO())
+
+    def close(self):
+        """Close all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _open(self, request, timeout):
+        scheme, netloc, path, query, fragment = urlsplit(
+            request.get_full_url())
+        selector = path or '/'
+        if query:
+            selector += '?' + query
+        data = request.data
+        headers = dict(request.header_items())
+        if data is not None:
+            headers.setdefault('Content-type',
+                               'application/x-www-form-urlencoded')
+        key = (scheme, netloc)
+        while 1:
+            connection, reused = self._get(key, timeout)
+            try:
+                connection.request(request.get_method(), selector,
+                                   data, headers)
+                response = connection.getresponse()
+            except (http_client.HTTPException, socket.error) as e:
+                connection.close()
+                if reused and isinstance(e, DROPPED_ERRORS):
+                    # the server dropped an idle keep-alive connection,
+                    # try again
+                    continue
+                raise
+            return PooledResponse(self, key, connection, response)
+
+    def _get(self, key, timeout):
+        if timeout is None:
+            timeout = self._timeout
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                connection = idle.pop()
+                if timeout is not None and connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+        scheme, netloc = key
+        if timeout is None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        if scheme == 'https':
+            connection = http_client.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            connection = http_client.HTTPConnection(netloc, timeout=timeout)
+        return connection, False
+
+    def _put(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._maxsize:
+                idle.append(connection)
+                return
+        connection.close()
+
+class PooledResponse(object):
+    """File-like HTTP response that returns its connection to the pool.
+    """
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.msg
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self._response.read()
+        else:
+            data = self._response.read(amt)
+        if self._response.isclosed():
+            self.close()
+        return data
+
+    def close(self):
+        connection = self._connection
+        if connection is None:
+            return
+        self._connection = None
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool._put(self._key, connection)
+        else:
+            # body not read completely, the connection can't be reused
+            self._response.close()
+            connection.close()
+
+def redirectRequest(request, code, location):
+    """Create the request to follow a redirect to location.
+    """
+    url = urljoin(request.get_full_url(), location)
+    headers = dict(request.header_items())
+    if code in (307, 308):
+        return urllib2.Request(url, data=request.data, headers=headers)
+    headers.pop('Content-type', None)
+    return urllib2.Request(url, headers=headers)
+
+def acceptedEncodings(compression):
+    """Get the encodings out of an Identify compression list we can decode.
+    """
+    compression = compression or []
+    return [encoding for encoding in SUPPORTED_ENCODINGS
+            if encoding in compression]
+
+def decodedChunks(f, chunk_size=CHUNK_SIZE):
+    """Iterate over the body of response f, decompressed.
+
+    The body is read and decompressed chunk by chunk according to the
+    Content-Encoding of the response, so the compressed body is never
+    held in memory as a whole.
+    """
+    decompressor = getDecompressor(f.info().get('Content-Encoding'))
+    while 1:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+    if decompressor is not None:
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+def getDecompressor(encoding):
+    """Get a decompressor for a Content-Encoding, None for identity.
+    """
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        return DeflateDecompressor()
+    elif encoding == 'identity':
+        return None
+    raise Error("Unsupported content encoding: %s" % encoding)
+
+class DeflateDecompressor(object):
+    """Decompress 'deflate' content coding.
+
+    This should be zlib wrapped deflate data, but some servers send raw
+    deflate data, so fall back to that if the zlib header is missing.
+    """
+    def __init__(self):
+        self._decompressor = zlib.decompressobj()
+        self._started = False
+
+    def decompress(self, data):
+        if not self._started:
+            self._started = True
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return self._decompressor.flush()
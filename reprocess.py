@@ -0,0 +1,30 @@
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from harvest import (ARCHIVE, COLUMNS, READ_FIELDS, article_filter, create_registry, selected,
+                     selects_records)
+from oaipmh.client import ReplayClient
+from oaipmh.sinks import ProgressSink, openSink
+
+
+def main():
+    # parse the pages harvest.py archived again, for instance after the readers,
+    # the filter or the columns changed, without downloading anything
+    if len(sys.argv) < 2:
+        print('usage: reprocess.py OUTPUT [ARCHIVE]')
+        sys.exit(1)
+    output = sys.argv[1]
+    archive = sys.argv[2] if len(sys.argv) > 2 else ARCHIVE
+    client = ReplayClient(archive, create_registry())
+    select = selects_records(output)
+
+    with ProcessPoolExecutor() as pool, ProgressSink(openSink(output, READ_FIELDS, COLUMNS)) as sink:
+        client.setParsePool(pool)
+        for record in client.listArchivedRecords(fields=READ_FIELDS, filter=article_filter):
+            if select and not selected(record):
+                continue
+            sink.write(record)
+
+
+if __name__ == '__main__':
+    main()